@@ -0,0 +1,93 @@
+# coding: utf-8
+"""Compares `ConsoleLogParser` with the per-line ``re.search`` approach
+previously used by `SteamClient.launch_tf2`, on a synthetic console.log.
+
+Usage, from the repository root:
+
+    python -m benchmarks.console_benchmark [size in MB]
+"""
+
+import io
+import random
+import re
+import sys
+import time
+
+from tf2idle.console import ConsoleLogParser
+
+
+SAMPLE_LINES = (
+    'Unknown command "cl_thirdperson"',
+    'Redownloading all lightmaps',
+    'maxplayers set to 24',
+    'Compact freed 1417216 bytes',
+    'ConVarRef mat_dxlevel doesn\'t point to an existing ConVar',
+    'Bob has found: Strange Shotgun',
+    'Map: itemtest',
+    'Network: IP 192.168.0.2, mode MP, dedicated No, ports 27015 SV / '
+    '27005 CL',
+    'Bob connected',
+)
+
+
+def build_log(size):
+    rng = random.Random(0)
+    lines = []
+    total = 0
+    while total < size:
+        # Mostly noise, like a real console.log.
+        if rng.random() < 0.02:
+            line = rng.choice(SAMPLE_LINES[5:])
+        else:
+            line = rng.choice(SAMPLE_LINES[:5])
+        lines.append(line)
+        total += len(line) + 2
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+
+# The same events, written the way launch_tf2 used to look for them.
+PER_LINE_PATTERNS = (
+    r'^.+? has found: .+',
+    r'^(?:Host_Error|Engine Error|FATAL ERROR|Fatal Error)',
+    r'^(?:Map: |Loading map ")',
+    r'IP ([0-9.]+|unknown), .+, ports (\d+) SV / (\d+) CL',
+)
+
+
+def per_line_search(data):
+    """The previous approach: decode, split, then re.search each pattern and
+    check for 'connected' on every line."""
+    count = 0
+    for line in io.StringIO(data.decode('utf-8')):
+        if (any(re.search(pattern, line) for pattern in PER_LINE_PATTERNS) or
+                'connected' in line):
+            count += 1
+    return count
+
+
+def streaming_parser(data, chunk_size=64 * 1024):
+    parser = ConsoleLogParser()
+    count = sum(1 for _ in parser.parse_file(io.BytesIO(data), chunk_size))
+    return count
+
+
+def bench(func, data):
+    start = time.perf_counter()
+    count = func(data)
+    return count, time.perf_counter() - start
+
+
+def main():
+    size = int(float(sys.argv[1]) * 1024 * 1024) if len(sys.argv) > 1 else \
+        8 * 1024 * 1024
+    data = build_log(size)
+    print('console.log size: {0:.1f} MB'.format(len(data) / 1024 / 1024))
+    for name, func in (('per-line re.search', per_line_search),
+                       ('ConsoleLogParser.feed', streaming_parser)):
+        count, elapsed = bench(func, data)
+        print('{0:>24}: {1:6.3f}s  {2:7.1f} MB/s  ({3} events)'.format(
+            name, elapsed, len(data) / 1024 / 1024 / elapsed, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,13 +7,40 @@ import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import time
 
 import psutil
 import sandboxie
 
-from tf2idle.steam import SteamClient, Tf2Installation, LinkedTf2Installation
-from tf2idle.util import get_process_windows, tail
+from tf2idle.contentstore import ContentStore
+from tf2idle.fsops import BulkFilesystem
+from tf2idle.logwatch import LogWatcher
+from tf2idle.memory import MemoryGovernor, PsutilMemoryBackend
+from tf2idle.metrics import PhaseMetrics
+from tf2idle.orchestrator import Orchestrator
+from tf2idle.placement import CpuPlacement
+from tf2idle.ports import PortAllocator
+from tf2idle.processes import ProcessIndex
+from tf2idle.provisioning import ProvisionRegistry
+from tf2idle.registry import Tf2RegistryProfile
+from tf2idle.sandboxes import SandboxConfigBatch, SandboxieConfigBackend
+from tf2idle.scheduler import LaunchScheduler
+from tf2idle.statestore import FleetStateStore
+from tf2idle.status import fleet_status
+from tf2idle.statuscache import InstallationStatusCache
+from tf2idle.steam import (SteamClient, Tf2Installation, LinkedTf2Installation,
+                           LoginResult, Tf2LaunchResult)
+from tf2idle.templates import Tf2Template
+from tf2idle.trash import TrashQueue
+from tf2idle.util import CancellationToken, Cancelled
+from tf2idle.watchdog import Watchdog
+from tf2idle.winevents import WindowMonitor
+
+
+def _built_on_first_use(name):
+    """A property returning the collaborator `name` of a `Tf2IdleApp`."""
+    return property(lambda app: app._collaborator(name))
 
 
 class Tf2IdleApp(object):
@@ -31,82 +58,525 @@ class Tf2IdleApp(object):
                               '-nosound -nomouse -noipx -nopreload '
                               '-nopreloadmodels -nod3d9ex -nodev -nodns '
                               '-nohltv -nojoy -nomessagebox -nominidumps '
-                              '+clientport 27100 +hostport 27400 '
-                              '-steamport 27700 +map itemtest')
+                              '+map itemtest')
+
+    # Set per account from `port_allocator`.
+    PORT_OPTIONS = ('+clientport', '+hostport', '-steamport')
 
     def __init__(self, steam_base_dir=None, working_dir=None,
-                 sandboxie_install_dir=None):
+                 sandboxie_install_dir=None, concurrency=None,
+                 max_workers=None, launch_options=None,
+                 phase_timeouts=None, fs_workers=8,
+                 trash_bytes_per_second=64 * 1024 * 1024,
+                 tf2_template_dir=None, registry_settings=None,
+                 cpu_cores=None, instance_memory_limit=None,
+                 fleet_memory_limit=None,
+                 memory_actions=MemoryGovernor.ACTIONS,
+                 watchdog_options=None, metrics_path=None,
+                 phase_log_path=None):
         self.steam_base_dir = steam_base_dir or self.DEFAULT_STEAM_BASE_DIR
-        self.base_installation = Tf2Installation(self.steam_base_dir)
         self.working_dir = working_dir or self.DEFAULT_WORKING_DIR
-        self.sbie = sandboxie.Sandboxie(install_dir=sandboxie_install_dir)
+        self.status_cache = InstallationStatusCache(
+            os.path.join(self.working_dir, '.status-cache.json'))
+        self.base_installation = Tf2Installation(
+            self.steam_base_dir, status_cache=self.status_cache)
+        self.provision_registry = ProvisionRegistry(
+            os.path.join(self.working_dir, '.provisioned.json'))
+        self.port_allocator = PortAllocator(
+            os.path.join(self.working_dir, '.ports.json'))
+        self.state_store = FleetStateStore(
+            os.path.join(self.working_dir, '.state.sqlite3'))
+        # Phase timings, as a Prometheus text file and a JSON lines log.
+        self.metrics = PhaseMetrics(
+            prometheus_path=(metrics_path or
+                             os.path.join(self.working_dir, 'tf2idle.prom')),
+            events_path=(phase_log_path or
+                         os.path.join(self.working_dir, 'phases.jsonl')),
+            state_path=os.path.join(self.working_dir, '.metrics.json'))
+        # Read-only game files of every idler are stored once and
+        # hardlinked; the store must be on the same volume as the idlers.
+        self.content_store = ContentStore(os.path.join(self.working_dir,
+                                                       '.content-store'))
+        self.bulk_fs = BulkFilesystem(max_workers=fs_workers)
+        # Must be on the same volume as the idler installations.
+        self.trash = TrashQueue(os.path.join(self.working_dir, '.trash'),
+                                max_bytes_per_second=trash_bytes_per_second)
+        # Overrides of `registry.DEFAULT_TF2_SETTINGS`.
+        self.registry_profile = Tf2RegistryProfile(
+            os.path.join(self.working_dir, '.registry'), registry_settings)
+        self.process_index = ProcessIndex()
+        self.window_monitor = WindowMonitor()
+        # The Steam client, launch options and autoexec of every running
+        # TF2 instance launched by this app, keyed by username.
+        self._instances = {}
+        # The account, Steam client, launch options and autoexec of every
+        # supervised account, keyed by username.
+        self._supervised = {}
+        # Collaborators that only provisioning and launches use are built
+        # on first use, so that e.g. `status` neither looks for Sandboxie
+        # nor samples the host load. See `_collaborator`.
+        self._collaborators = {}
+        self._collaborators_lock = threading.RLock()
+        self._factories = {
+            'sbie': partial(sandboxie.Sandboxie,
+                            install_dir=sandboxie_install_dir),
+            'sandbox_config': lambda: SandboxieConfigBackend(self.sbie),
+            # Game directories are materialized from an already extracted
+            # one, if there is one, instead of being extracted on every
+            # launch.
+            'tf2_template': lambda: self._build_tf2_template(
+                tf2_template_dir),
+            'log_watcher': LogWatcher,
+            'orchestrator': lambda: self._build_orchestrator(concurrency,
+                                                             max_workers),
+            # Keyword arguments of `LaunchScheduler`, such as the host load
+            # thresholds.
+            'launch_scheduler': partial(LaunchScheduler,
+                                        **(launch_options or {})),
+            'placement': partial(CpuPlacement, cores=cpu_cores),
+            'memory_governor': lambda: MemoryGovernor(
+                self._governed_instances,
+                PsutilMemoryBackend(restart=self._restart_tf2),
+                instance_limit=instance_memory_limit,
+                fleet_limit=fleet_memory_limit, actions=memory_actions,
+                launch_gate=self.launch_scheduler),
+            # Keyword arguments of `Watchdog`, such as timeouts and the
+            # restart budget.
+            'watchdog': lambda: Watchdog(self._recover, self.log_watcher,
+                                         **(watchdog_options or {})),
+        }
+        # Overrides the phase timeouts of logins and launches, keyed by
+        # state name (see `LoginStateMachine` and `Tf2LaunchStateMachine`).
+        self.phase_timeouts = phase_timeouts
+        self.cancel_token = CancellationToken()
 
-    def __run_async(self, tasks):
-        results = {}
-        jobs = {}
+    def _collaborator(self, name):
+        """Returns the collaborator `name`, built on first use by
+        `_factories[name]`."""
+        with self._collaborators_lock:
+            if name not in self._collaborators:
+                self._collaborators[name] = self._factories[name]()
+            return self._collaborators[name]
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-            for taskid, task_func in enumerate(tasks):
-                job = executor.submit(task_func)
-                jobs[job] = taskid
+    def _build_orchestrator(self, concurrency, max_workers):
+        # Launches are limited by `launch_scheduler`; launches waiting for
+        # it must not hold worker threads that other operations need.
+        concurrency = dict(concurrency or {})
+        concurrency['launch_tf2'] = self.launch_scheduler.max_in_flight
+        return Orchestrator(concurrency=concurrency, max_workers=max_workers)
 
-            for job in concurrent.futures.as_completed(jobs):
-                results[jobs[job]] = job.result()
+    def _build_tf2_template(self, source_dir):
+        source_dir = (source_dir or
+                      Tf2Template.find_source_dir(self.base_installation))
+        if source_dir is None:
+            return None
+        return Tf2Template(source_dir, self.content_store)
 
-        return results
+    sbie = _built_on_first_use('sbie')
+    sandbox_config = _built_on_first_use('sandbox_config')
+    tf2_template = _built_on_first_use('tf2_template')
+    log_watcher = _built_on_first_use('log_watcher')
+    orchestrator = _built_on_first_use('orchestrator')
+    launch_scheduler = _built_on_first_use('launch_scheduler')
+    placement = _built_on_first_use('placement')
+    memory_governor = _built_on_first_use('memory_governor')
+    watchdog = _built_on_first_use('watchdog')
 
-    def _create_tf2_installation(self, username):
-        installation = LinkedTf2Installation(os.path.join(self.working_dir,
-                                                          username))
-        installation.link(self.base_installation)
-        return installation
+    def cancel(self):
+        """Cancels every login and launch in progress. They finish with
+        `LoginResult.LOGIN_CANCELED` and `Tf2LaunchResult.LAUNCH_CANCELED`.
 
-    def _create_sandbox(self, username):
+        Logins and launches may also be given a `cancel_token` of their own,
+        which this does not cancel; the caller links it to `cancel_token` if
+        it should.
+        """
+        self.cancel_token.cancel()
+
+    def close(self):
+        """Stops supervising accounts and the background threads that act
+        on running instances or reap `trash`, and saves `state_store` and
+        `metrics`."""
+        # Operations still running record their outcomes before the stores
+        # are closed. Collaborators that were never built are skipped.
+        with self._collaborators_lock:
+            collaborators = dict(self._collaborators)
+        for name in ('orchestrator', 'watchdog', 'memory_governor',
+                     'placement', 'log_watcher'):
+            if name in collaborators:
+                collaborators[name].close()
+        self.window_monitor.close()
+        self.trash.close()
+        self.state_store.close()
+        self.metrics.close()
+
+    def _tf2_installation(self, username):
+        return LinkedTf2Installation(os.path.join(self.working_dir, username),
+                                     content_store=self.content_store,
+                                     status_cache=self.status_cache)
+
+    def _sandbox_options(self):
         options = dict(self.DEFAULT_SANDBOX_OPTIONS)
         options['OpenFilePath'] = os.path.splitdrive(self.steam_base_dir)[0]
         options['OpenPipePath'] = os.path.splitdrive(self.working_dir)[0]
-        self.sbie.create_sandbox(username, options)
+        return options
+
+    def provision(self, usernames, force=False):
+        """Creates the sandboxes of `usernames` and links their
+        installations in parallel, skipping accounts that are already
+        provisioned unless `force` is True. Returns a dict of installations
+        keyed by username."""
+        installations = {username: self._tf2_installation(username)
+                         for username in usernames}
+        options = self._sandbox_options()
+        provisioned = set()
+        if not force:
+            provisioned = self.provision_registry.provisioned(
+                installations, self.sandbox_config.read(), options)
+        pending = {username: installation
+                   for username, installation in installations.items()
+                   if username not in provisioned}
+        if not pending:
+            return installations
+
+        with self.metrics.timer('sandbox_create'):
+            with SandboxConfigBatch(self.sandbox_config) as batch:
+                for username in sorted(pending):
+                    batch.create_sandbox(username, options)
+        started = time.time()
+        results = self.bulk_fs.link(pending.values(), self.base_installation)
+        for username, installation in pending.items():
+            result = results[installation]
+            if isinstance(result, Exception):
+                # A failed link has no `FsStats`; it took at most as long as
+                # the whole batch.
+                self.metrics.observe('link', time.time() - started, 'failed',
+                                     username)
+            else:
+                self.metrics.observe('link', result.seconds, 'ok', username)
+                self.provision_registry.record(username, options)
+        self.provision_registry.save()
+        self.status_cache.save()
+        self._report_fs_results('linked', pending, results)
+        return installations
 
-    def _get_tf2installation(self, username):
-        tf2_installation = self._create_tf2_installation(username)
-        return tf2_installation
+    def _report_fs_results(self, action, installations, results):
+        """Prints the `FsStats` of a bulk operation for every account, and
+        raises the first error."""
+        errors = []
+        for username, installation in sorted(installations.items()):
+            result = results[installation]
+            if isinstance(result, Exception):
+                print('{}: {}'.format(username, result))
+                errors.append(result)
+            elif result.files:
+                print('{}: {} {} files ({:.1f} MB) in {:.1f}s'.format(
+                    username, action, result.files,
+                    result.bytes / (1024 * 1024), result.seconds))
+        if errors:
+            raise errors[0]
 
-    def _get_steam_client(self, username):
-        self._create_sandbox(username)
-        tf2_installation = self._get_tf2installation(username)
+    def _get_steam_clients(self, accounts, provision=True):
+        """Returns a list of `SteamClient` instances for `accounts`, in
+        order. If `provision` is True, accounts that are not provisioned
+        yet are provisioned first; commands that only act on running
+        processes pass False and touch neither Sandboxie nor the
+        filesystem."""
+        usernames = [account.username for account in accounts]
+        if provision:
+            installations = self.provision(usernames)
+        else:
+            installations = {username: self._tf2_installation(username)
+                             for username in usernames}
+        return [self._get_steam_client(account.username,
+                                       installations[account.username])
+                for account in accounts]
+
+    def _get_steam_client(self, username, tf2_installation):
         return SteamClient(tf2_installation,
                            shell_executer=partial(self.sbie.start,
-                                                  box=username, wait=False))
+                                                  box=username, wait=False),
+                           process_index=self.process_index,
+                           window_monitor=self.window_monitor,
+                           log_watcher=self.log_watcher,
+                           trash=self.trash,
+                           tf2_template=self.tf2_template,
+                           registry_profile=self.registry_profile,
+                           placement=self.placement,
+                           state_store=self.state_store,
+                           metrics=self.metrics)
+
+    def _record(self, username, operation, func, *args):
+        """Calls `func` and records its result and duration in
+        `state_store`."""
+        started = time.time()
+        result = func(*args)
+        self.state_store.record_outcome(username, operation, result,
+                                        time.time() - started)
+        return result
+
+    def _login(self, steam_client, username, password, cancel_token=None):
+        return self._record(username, 'login',
+                            partial(steam_client.login, username, password,
+                                    timeouts=self.phase_timeouts,
+                                    cancel_token=(cancel_token or
+                                                  self.cancel_token)))
 
-    def login(self, accounts):
-        tasks = [partial(self._get_steam_client(account.username).login,
-                         account.username, account.password)
-                 for account in accounts]
-        return self.__run_async(tasks)
+    def login(self, accounts, cancel_token=None):
+        tasks = [partial(self._login, client, account.username,
+                         account.password, cancel_token)
+                 for account, client in zip(accounts,
+                                            self._get_steam_clients(accounts))]
+        return self.orchestrator.run('login', tasks)
 
     def logout(self, accounts):
-        tasks = [partial(self._get_steam_client(account.username).logout)
-                 for account in accounts]
-        logout_results = self.__run_async(tasks)
-        for account in accounts:
-            self.cleanup(account.username)
+        clients = self._get_steam_clients(accounts, provision=False)
+        tasks = [partial(self._record, account.username, 'logout',
+                         client.logout)
+                 for account, client in zip(accounts, clients)]
+        logout_results = self.orchestrator.run('logout', tasks)
+        self.cleanup([account.username for account in accounts])
         return logout_results
 
-    def launch_tf2(self, accounts, launch_options=None, autoexec_cfg=None):
+    def _get_launch_options(self, launch_options):
         launch_options = launch_options or self.DEFAULT_LAUNCH_OPTIONS
-        launch_options = launch_options.split(' ')
-        tasks = [partial(self._get_steam_client(account.username).launch_tf2,
-                         account.username, launch_options, autoexec_cfg)
-                 for account in accounts]
-        return self.__run_async(tasks)
+        return launch_options.split(' ')
+
+    def _with_ports(self, launch_options, ports):
+        """Returns `launch_options` with any port options replaced by the
+        `PortSet` `ports`."""
+        options = []
+        option_iter = iter(launch_options)
+        for option in option_iter:
+            if option in self.PORT_OPTIONS:
+                next(option_iter, None)
+            else:
+                options.append(option)
+        return options + ['+clientport', str(ports.client_port),
+                          '+hostport', str(ports.host_port),
+                          '-steamport', str(ports.steam_port)]
+
+    def _check_ports(self, username, ports, result):
+        """Warns if TF2 connected using other ports than the ones allocated
+        to it, and releases them so that the next launch allocates ports
+        afresh."""
+        if (not isinstance(result, tuple) or
+                result[0] != Tf2LaunchResult.LAUNCH_SUCCEEDED):
+            return
+        _, _, server_port, client_port = result
+        if (server_port, client_port) != (str(ports.host_port),
+                                          str(ports.client_port)):
+            print('{}: TF2 uses ports {} SV / {} CL instead of the '
+                  'allocated {} / {}.'.format(username, server_port,
+                                              client_port, ports.host_port,
+                                              ports.client_port))
+            self.port_allocator.release(username)
+            self.port_allocator.save()
+
+    def _launch_tf2(self, steam_client, username, launch_options,
+                    autoexec_cfg, cancel_token=None):
+        """Launches TF2 with ports of its own once `launch_scheduler` admits
+        the launch. TF2 instances that are already running are not
+        queued. Running instances are governed by `memory_governor`."""
+        cancel_token = cancel_token or self.cancel_token
+        launch = partial(self._record, username, 'launch_tf2',
+                         partial(steam_client.launch_tf2, username,
+                                 timeouts=self.phase_timeouts,
+                                 cancel_token=cancel_token,
+                                 autoexec_cfg=autoexec_cfg))
+        if steam_client.get_hl2_process() is not None:
+            result = launch(launch_options)
+        else:
+            try:
+                with self.launch_scheduler.admit(
+                        username, cancel_token) as wait_time:
+                    print('{}: waited {:.1f}s for a launch slot.'.format(
+                        username, wait_time))
+                    try:
+                        ports = self.port_allocator.allocate(username)
+                    except RuntimeError as e:
+                        print(e)
+                        return Tf2LaunchResult.LAUNCH_FAILED
+                    self.port_allocator.save()
+                    result = launch(self._with_ports(launch_options, ports))
+                    self._check_ports(username, ports, result)
+            except Cancelled:
+                return Tf2LaunchResult.LAUNCH_CANCELED
+        if (isinstance(result, tuple) and
+                result[0] == Tf2LaunchResult.LAUNCH_SUCCEEDED):
+            self._instances[username] = (steam_client, launch_options,
+                                         autoexec_cfg)
+            _, ip, server_port, client_port = result
+            self.state_store.record_connection(username, ip, int(server_port),
+                                               int(client_port))
+            self.memory_governor.start()
+        return result
+
+    def _governed_instances(self):
+        """Returns the Steam and TF2 processes of every instance in
+        `_instances`, keyed by username."""
+        instances = {}
+        for username, (client, _, _) in list(self._instances.items()):
+            processes = [process for process in (client.get_steam_process(),
+                                                 client.get_hl2_process())
+                         if process is not None]
+            if processes:
+                instances[username] = processes
+        return instances
+
+    def _restart_tf2(self, username):
+        """Closes and relaunches the TF2 instance of `username` in the
+        background. Supervised accounts are restarted by `watchdog`, within
+        their restart budget."""
+        if self.watchdog.watching(username):
+            self.watchdog.request(username, 'memory')
+            return
+        instance = self._instances.pop(username, None)
+        if instance is None:
+            return
+        client, launch_options, autoexec_cfg = instance
+
+        def restart():
+            client.close_tf2(username)
+            return self._launch_tf2(client, username, launch_options,
+                                    autoexec_cfg)
+        self.orchestrator.submit('launch_tf2', restart)
+
+    def launch_tf2(self, accounts, launch_options=None, autoexec_cfg=None,
+                   cancel_token=None):
+        launch_options = self._get_launch_options(launch_options)
+        tasks = [partial(self._launch_tf2, client, account.username,
+                         launch_options, autoexec_cfg, cancel_token)
+                 for account, client in zip(accounts,
+                                            self._get_steam_clients(accounts))]
+        return self.orchestrator.run('launch_tf2', tasks)
+
+    def up(self, accounts, launch_options=None, autoexec_cfg=None,
+           cancel_token=None):
+        """Logs in to Steam and launches TF2 for every account. Each
+        account's TF2 launch starts as soon as its own login succeeds.
+
+        Returns an iterator of (account, login_result, launch_result) tuples
+        in the order the accounts finish. `launch_result` is None if the
+        login failed.
+        """
+        launch_options = self._get_launch_options(launch_options)
+
+        def login_succeeded(result):
+            return result == LoginResult.LOGIN_SUCCEEDED
+
+        jobs = {}
+        for account, client in zip(accounts,
+                                   self._get_steam_clients(accounts)):
+            steps = [('login',
+                      partial(self._login, client, account.username,
+                              account.password, cancel_token),
+                      login_succeeded),
+                     ('launch_tf2',
+                      partial(self._launch_tf2, client, account.username,
+                              launch_options, autoexec_cfg, cancel_token),
+                      None)]
+            jobs[self.orchestrator.submit_chain(steps)] = account
+        return self._iter_up_results(jobs)
+
+    def supervise(self, accounts, launch_options=None, autoexec_cfg=None,
+                  cancel_token=None):
+        """Brings `accounts` up, then has `watchdog` restart Steam and TF2
+        when they crash, hang or get disconnected. Returns an iterator of
+        the (account, login_result, launch_result) tuples of the bring-up,
+        like `up`; each account is supervised once its tuple is consumed,
+        until `close` is called. `cancel_token` only cancels the
+        bring-up."""
+        results = self.up(accounts, launch_options, autoexec_cfg,
+                          cancel_token)
+        launch_options = self._get_launch_options(launch_options)
+        clients = self._get_steam_clients(accounts, provision=False)
+        supervised = {
+            account.username: (account, client, launch_options, autoexec_cfg)
+            for account, client in zip(accounts, clients)}
+        self.watchdog.start()
+        return self._iter_supervised(results, supervised)
+
+    def _iter_supervised(self, results, supervised):
+        for account, login_result, launch_result in results:
+            supervision = supervised[account.username]
+            self._supervised[account.username] = supervision
+            self.watchdog.watch(account.username, supervision[1])
+            yield account, login_result, launch_result
+
+    def _recover(self, username, recovery):
+        """Restarts the TF2 instance of a supervised account in the
+        background, or its Steam client too if `recovery` is 'login'.
+        Returns a ``concurrent.futures.Future`` of the step results."""
+        account, client, launch_options, autoexec_cfg = (
+            self._supervised[username])
+
+        def login_succeeded(result):
+            return result == LoginResult.LOGIN_SUCCEEDED
+
+        steps = []
+        if recovery == 'login':
+            steps.append(('logout', partial(self.sbie.terminate_processes,
+                                            box=username), None))
+            steps.append(('login',
+                          partial(self._login, client, username,
+                                  account.password),
+                          login_succeeded))
+        else:
+            steps.append(('close_tf2', partial(client.close_tf2, username),
+                          None))
+        steps.append(('launch_tf2',
+                      partial(self._launch_tf2, client, username,
+                              launch_options, autoexec_cfg),
+                      None))
+        return self.orchestrator.submit_chain(steps)
+
+    def _iter_up_results(self, jobs):
+        for job in concurrent.futures.as_completed(jobs):
+            results = job.result() + [None]
+            yield jobs[job], results[0], results[1]
+
+    def status(self, usernames=None):
+        """Returns a list of the `status.AccountStatus` of `usernames`, or
+        of every provisioned account if None, from one scan of the process
+        table and one enumeration of the windows."""
+        if usernames is None:
+            usernames = self.provision_registry.usernames()
+        accounts = [(username, self._tf2_installation(username).steam_dir)
+                    for username in usernames]
+        return fleet_status(accounts, self.process_index.snapshot(),
+                            self.window_monitor.index.snapshot(),
+                            self.state_store, self.port_allocator)
 
     def close_tf2(self, accounts):
-        tasks = [partial(self._get_steam_client(account.username).close_tf2)
-                 for account in accounts]
-        return self.__run_async(tasks)
-
-    def cleanup(self, username):
-        tf2_installation = self._get_tf2installation(username)
-        self.sbie.terminate_processes(box=username)
-        self.sbie.destroy_sandbox(box=username)
-        tf2_installation.unlink()
+        clients = self._get_steam_clients(accounts, provision=False)
+        tasks = [partial(self._record, account.username, 'close_tf2',
+                         client.close_tf2, account.username)
+                 for account, client in zip(accounts, clients)]
+        results = self.orchestrator.run('close_tf2', tasks)
+        for account in accounts:
+            self._instances.pop(account.username, None)
+        self._release_ports([account.username for account in accounts])
+        return results
+
+    def _release_ports(self, usernames):
+        for username in usernames:
+            self.port_allocator.release(username)
+        self.port_allocator.save()
+
+    def cleanup(self, usernames):
+        """Destroys the sandboxes of `usernames` and removes their
+        installations, in parallel."""
+        with SandboxConfigBatch(self.sandbox_config) as batch:
+            for username in usernames:
+                self.provision_registry.remove(username)
+                self.sbie.terminate_processes(box=username)
+                batch.destroy_sandbox(username)
+        self.provision_registry.save()
+        self._release_ports(usernames)
+        installations = {username: self._tf2_installation(username)
+                         for username in usernames}
+        for username, installation in installations.items():
+            self.state_store.forget(username, installation.steam_dir)
+        results = self.bulk_fs.unlink(installations.values())
+        self.status_cache.save()
+        self._report_fs_results('removed', installations, results)
@@ -0,0 +1,154 @@
+import collections
+import re
+
+
+ServerInfo = collections.namedtuple('ServerInfo',
+                                    'ip server_port client_port')
+Connected = collections.namedtuple('Connected', 'line')
+FatalError = collections.namedtuple('FatalError', 'message')
+MapChange = collections.namedtuple('MapChange', 'map')
+ItemDrop = collections.namedtuple('ItemDrop', 'player item')
+
+
+# (event name, trigger, pattern) tuples. `trigger` is a cheap regular
+# expression, preferably a literal, that occurs in every line `pattern`
+# matches; only lines containing a trigger are matched against the patterns.
+# Patterns are matched at the start of a line, so patterns that may match
+# anywhere in a line start with .*?.
+CONSOLE_PATTERNS = (
+    ('item_drop', r' has found: ',
+     r'(?P<player>.+?) has found: (?P<item>.+)'),
+    ('fatal_error', r'Host_Error|Engine Error|FATAL ERROR|Fatal Error',
+     r'(?:Host_Error|Engine Error|FATAL ERROR|Fatal Error):? *'
+     r'(?P<message>.*)'),
+    ('map_change', r'Map: |Loading map "',
+     r'(?:Map: |Loading map ")(?P<map>[^"\s]+)'),
+    ('server_info', r'IP [0-9u]',
+     r'.*?IP (?P<ip>[0-9.]+|unknown), .+, '
+     r'ports (?P<server_port>\d+) SV / (?P<client_port>\d+) CL'),
+    ('connected', r'connected', r'.*?\bconnected\b'),
+)
+
+
+def _combine(patterns):
+    triggers = '|'.join(trigger for _, trigger, _ in patterns)
+    combined = '^(?:{0})'.format('|'.join(
+        '(?P<{0}>{1})'.format(name, pattern)
+        for name, _, pattern in patterns))
+    return triggers, combined
+
+
+class ConsoleLogParser(object):
+    """Turns TF2 console output into `ServerInfo`, `Connected`,
+    `FatalError`, `MapChange` and `ItemDrop` events.
+
+    All patterns are compiled into one regular expression, and their
+    triggers into another. `feed` accepts raw bytes in arbitrary chunks and
+    finds the triggers in all complete lines of a chunk with a single
+    ``finditer`` call, so the full patterns only run on the few lines that
+    can match. Only an incomplete trailing line, of at most
+    `max_line_length` bytes, is buffered between calls.
+    """
+
+    def __init__(self, patterns=CONSOLE_PATTERNS, encoding='utf-8',
+                 max_line_length=64 * 1024):
+        triggers, combined = _combine(patterns)
+        self._trigger_regex = re.compile(triggers)
+        self._line_regex = re.compile(combined)
+        self._bytes_trigger_regex = re.compile(triggers.encode('ascii'))
+        self._bytes_line_regex = re.compile(combined.encode('ascii'))
+        self.encoding = encoding
+        self.max_line_length = max_line_length
+        self._partial = b''
+        self._discarding = False
+
+    def _decode(self, value):
+        if isinstance(value, bytes):
+            return value.decode(self.encoding, 'replace')
+        return value
+
+    def _event(self, match, line):
+        def group(name):
+            return self._decode(match.group(name))
+
+        kind = match.lastgroup
+        if kind == 'server_info':
+            return ServerInfo(group('ip'), group('server_port'),
+                              group('client_port'))
+        if kind == 'connected':
+            return Connected(self._decode(line))
+        if kind == 'fatal_error':
+            return FatalError(group('message'))
+        if kind == 'map_change':
+            return MapChange(group('map'))
+        if kind == 'item_drop':
+            return ItemDrop(group('player'), group('item'))
+        return None
+
+    def parse_line(self, line):
+        """Returns the event for a single decoded line, or None."""
+        line = line.rstrip('\r\n')
+        if not self._trigger_regex.search(line):
+            return None
+        match = self._line_regex.match(line)
+        if match is None:
+            return None
+        return self._event(match, line)
+
+    def _scan(self, data):
+        events = []
+        line_start = -1
+        for trigger in self._bytes_trigger_regex.finditer(data):
+            start = data.rfind(b'\n', 0, trigger.start()) + 1
+            if start == line_start:
+                continue  # Another trigger in a line that was matched.
+            line_start = start
+            end = data.find(b'\n', trigger.end())
+            if end == -1:
+                end = len(data)
+            line = data[start:end].rstrip(b'\r')
+            match = self._bytes_line_regex.match(line)
+            if match is not None:
+                events.append(self._event(match, line))
+        return events
+
+    def feed(self, data):
+        """Parses a chunk of raw console output and returns a list of the
+        events found in the lines it completes."""
+        end = data.rfind(b'\n')
+        if end == -1:
+            if not self._discarding:
+                self._partial += data
+                if len(self._partial) > self.max_line_length:
+                    self._partial = b''
+                    self._discarding = True
+            return []
+
+        head, tail = data[:end + 1], data[end + 1:]
+        if self._discarding:
+            head = head[head.find(b'\n') + 1:]
+            self._discarding = False
+        elif self._partial:
+            head = self._partial + head
+        self._partial = b''
+        if len(tail) > self.max_line_length:
+            self._discarding = True
+        else:
+            self._partial = tail
+        return self._scan(head)
+
+    def flush(self):
+        """Parses and returns the events of a final line that has no line
+        terminator."""
+        partial, self._partial = self._partial, b''
+        self._discarding = False
+        return self._scan(partial) if partial else []
+
+    def parse_file(self, fileobj, chunk_size=1024 * 1024):
+        """Returns a generator of the events in a binary file object, using
+        at most about `chunk_size` bytes of memory."""
+        for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+            for event in self.feed(chunk):
+                yield event
+        for event in self.flush():
+            yield event
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+
+def read_manifest(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_manifest(path, manifest):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, path)
+
+
+class ContentStore(object):
+    """Stores files by the SHA-1 of their content, so that identical files
+    in many installations share one copy on disk.
+
+    Files are placed into installations as hardlinks to the stored copy
+    where the filesystem allows it (the store and the installation are on
+    the same volume), and as copies otherwise. Hardlinked files share one
+    inode, so writing one in place changes it in the store and in every
+    installation. Sandboxes open the drive of the base installation
+    (``OpenFilePath``), so their writes are not redirected: only files that
+    neither Steam nor TF2 write may be placed from the store, and anything
+    they may rewrite must be a private 'copy' (see `sync`).
+
+    The hashes of source files are cached by path, size and mtime in an
+    index that is persisted by `save`, so unchanged files are only hashed
+    once.
+    """
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, store_dir, chunk_size=1024 * 1024):
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, 'objects')
+        self.index_path = os.path.join(store_dir, self.INDEX_NAME)
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._index = None
+        self._dirty = False
+
+    def _load_index(self):
+        if self._index is None:
+            try:
+                with open(self.index_path, 'r') as f:
+                    self._index = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._index = {}
+        return self._index
+
+    def hash_file(self, path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def add(self, path, st=None):
+        """Adds the file at `path` to the store, if its content is not
+        stored yet. Returns its digest. `st` is the file's ``os.stat``
+        result, if already known."""
+        st = st or os.stat(path)
+        key = os.path.normcase(os.path.abspath(path))
+        with self._lock:
+            cached = self._load_index().get(key)
+        if (cached is not None and
+                cached[:2] == [st.st_size, st.st_mtime_ns] and
+                os.path.exists(self.object_path(cached[2]))):
+            return cached[2]
+
+        digest = self.hash_file(path)
+        object_path = self.object_path(digest)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            temp_path = '{0}.{1}.tmp'.format(object_path,
+                                             threading.get_ident())
+            shutil.copy2(path, temp_path)
+            os.replace(temp_path, object_path)
+
+        with self._lock:
+            self._load_index()[key] = [st.st_size, st.st_mtime_ns, digest]
+            self._dirty = True
+        return digest
+
+    def place(self, digest, dest):
+        """Replaces `dest` with the stored file `digest`."""
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        temp_path = dest + '.tf2idle-tmp'
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        try:
+            os.link(self.object_path(digest), temp_path)
+        except OSError:
+            shutil.copy2(self.object_path(digest), temp_path)
+        os.replace(temp_path, dest)
+
+    def sync(self, plan, root, manifest_path, counter):
+        """Brings the files beneath `root` up to date with `plan`, a list of
+        (source path, source stat, destination path, kind) tuples.
+
+        `kind` is 'file' for a file hardlinked from the store, 'copy' for a
+        private, writable copy, or 'symlink'. The manifest at
+        `manifest_path` records the size and mtime of every source file,
+        its hash, and the size and mtime of the destination. Files whose
+        source and destination are unchanged are skipped (copies are only
+        refreshed when their source changes, so that local changes are
+        kept), and files no longer in the plan are removed. Written files
+        are added to `counter`.
+        """
+        old_manifest = read_manifest(manifest_path)
+        manifest = {}
+        for src, st, dest, kind in plan:
+            key = os.path.relpath(dest, root)
+            manifest[key] = self._sync_file(src, st, dest, kind,
+                                            old_manifest.get(key), counter)
+
+        for key in set(old_manifest) - set(manifest):
+            try:
+                os.remove(os.path.join(root, key))
+            except OSError:
+                pass
+
+        write_manifest(manifest_path, manifest)
+        self.save()
+
+    def _sync_file(self, src, st, dest, kind, entry, counter):
+        """Writes `dest` unless the manifest `entry` shows that it is
+        current. Returns the new manifest entry."""
+        src = os.path.normpath(src)
+        if kind == 'symlink':
+            if (entry == {'symlink': src} and os.path.islink(dest) and
+                    os.readlink(dest) == src):
+                return entry
+            if os.path.lexists(dest):
+                os.remove(dest)
+            os.symlink(src, dest)
+            counter.add()
+            return {'symlink': src}
+
+        source = [st.st_size, st.st_mtime_ns]
+        if entry is not None and entry.get('source') == source:
+            try:
+                dest_st = os.lstat(dest)
+            except OSError:
+                pass
+            else:
+                if (kind == 'copy' or
+                        [dest_st.st_size, dest_st.st_mtime_ns] ==
+                        entry['dest']):
+                    return entry
+
+        if kind == 'copy':
+            # Replace rather than overwrite dest, which may be a hardlink.
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            temp_path = dest + '.tf2idle-tmp'
+            shutil.copy2(src, temp_path)
+            os.replace(temp_path, dest)
+            digest = None
+        else:
+            digest = self.add(src, st)
+            self.place(digest, dest)
+        dest_st = os.lstat(dest)
+        counter.add(dest_st.st_size)
+        return {'source': source, 'hash': digest,
+                'dest': [dest_st.st_size, dest_st.st_mtime_ns]}
+
+    def save(self):
+        """Persists the index of source file hashes."""
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(self.store_dir, exist_ok=True)
+            temp_path = self.index_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self._index, f)
+            os.replace(temp_path, self.index_path)
+            self._dirty = False
+
+    def prune(self):
+        """Removes stored files that are no longer linked into any
+        installation. Returns the number of bytes freed."""
+        freed = 0
+        for dirpath, _, filenames in os.walk(self.objects_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                    if st.st_nlink == 1:
+                        os.remove(path)
+                        freed += st.st_size
+                except OSError:
+                    pass
+        return freed
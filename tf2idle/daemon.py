@@ -0,0 +1,353 @@
+import hmac
+import json
+import os
+import secrets
+import socket
+import socketserver
+import threading
+
+from tf2idle.status import AccountStatus
+from tf2idle.steam import SteamAccount
+from tf2idle.util import CancellationToken
+
+
+STATE_NAME = '.daemon.json'
+
+
+def state_path(working_dir):
+    """The file in which a daemon serving `working_dir` records its port and
+    token."""
+    return os.path.join(working_dir, STATE_NAME)
+
+
+class DaemonError(Exception):
+    pass
+
+
+def _results(results):
+    """Returns a dict of task results keyed by task index as a list."""
+    return [results[index] for index in range(len(results))]
+
+
+def _accounts(accounts):
+    return [SteamAccount(username, password)
+            for username, password in accounts]
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            request = None
+        responses = self.server.tf2idle_daemon.handle(request)
+        try:
+            for response in responses:
+                self.wfile.write(json.dumps(response).encode('utf-8') +
+                                 b'\n')
+                self.wfile.flush()
+        finally:
+            responses.close()
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+
+class Tf2IdleDaemon(object):
+    """Serves the commands of `tf2idle.main` from one long-running
+    `Tf2IdleApp` `app`, whose process and window indexes, registries and
+    supervised accounts stay in memory between commands.
+
+    A request is a line of JSON, ``{"token": ..., "method": ...,
+    "params": {...}}``, sent over a TCP connection to `host`; the response is
+    a line of JSON, ``{"result": ...}`` or ``{"error": ...}``. Methods in
+    `STREAMING` first respond with a line ``{"item": ...}`` as each account
+    finishes. The port and a random token that requests must carry are
+    written to `path` while the daemon serves.
+
+    Each request is served on a thread of its own. Methods in `MUTATING`
+    change Sandboxie's config, the registries or the running instances, so
+    only one of them runs at a time; others are refused while it runs.
+
+    Methods in `CANCELABLE` run with a `util.CancellationToken` of their
+    own, which is cancelled by a ``cancel`` request with the ``id`` that the
+    request carried, when the client disconnects, or when the app is
+    cancelled.
+    """
+    METHODS = ('ping', 'provision', 'login', 'logout', 'launch_tf2', 'up',
+               'supervise', 'close_tf2', 'status', 'cancel')
+    MUTATING = ('provision', 'login', 'logout', 'launch_tf2', 'up',
+                'supervise', 'close_tf2')
+    STREAMING = ('up', 'supervise')
+    CANCELABLE = ('login', 'launch_tf2', 'up', 'supervise')
+
+    def __init__(self, app, path, host='127.0.0.1', port=0):
+        self.app = app
+        self.path = path
+        self.token = secrets.token_hex(16)
+        self.server = _Server((host, port), _RequestHandler)
+        self.server.tf2idle_daemon = self
+        self.host, self.port = self.server.server_address
+        self._mutating = threading.Lock()
+        self._running = None
+        self._lock = threading.Lock()
+        # The cancellation tokens of running requests, keyed by request id.
+        self._cancel_tokens = {}
+
+    def handle(self, request):
+        """Yields the responses to a decoded `request`."""
+        if not isinstance(request, dict):
+            yield {'error': 'Invalid request.'}
+            return
+        if not hmac.compare_digest(str(request.get('token')), self.token):
+            yield {'error': 'Invalid token.'}
+            return
+        method = request.get('method')
+        if method not in self.METHODS:
+            yield {'error': 'Unknown method: {}'.format(method)}
+            return
+        params = request.get('params', {})
+        if not isinstance(params, dict):
+            yield {'error': 'Invalid params.'}
+            return
+        params = dict(params)
+        if method in self.MUTATING:
+            if not self._mutating.acquire(blocking=False):
+                yield {'error': 'The daemon is busy running {}; try again '
+                                'once it has finished.'.format(self._running)}
+                return
+            self._running = method
+        cancel_token = None
+        try:
+            if method in self.CANCELABLE:
+                cancel_token = params['cancel_token'] = CancellationToken()
+                self.app.cancel_token.add_callback(cancel_token.cancel)
+                with self._lock:
+                    self._cancel_tokens[str(request.get('id'))] = cancel_token
+            result = getattr(self, '_' + method)(**params)
+            if method in self.STREAMING:
+                for item in result:
+                    yield {'item': item}
+                result = None
+        except Exception as e:
+            yield {'error': '{}: {}'.format(type(e).__name__, e)}
+            return
+        except GeneratorExit:
+            # The client has gone away.
+            if cancel_token is not None:
+                cancel_token.cancel()
+            raise
+        finally:
+            if cancel_token is not None:
+                self.app.cancel_token.remove_callback(cancel_token.cancel)
+                with self._lock:
+                    self._cancel_tokens.pop(str(request.get('id')), None)
+            if method in self.MUTATING:
+                self._running = None
+                self._mutating.release()
+        yield {'result': result}
+
+    def _ping(self):
+        return {'pid': os.getpid()}
+
+    def _provision(self, usernames, force=False):
+        return sorted(self.app.provision(usernames, force=force))
+
+    def _cancel(self, request_id):
+        """Cancels the running request `request_id`. Returns False if it is
+        not running."""
+        with self._lock:
+            cancel_token = self._cancel_tokens.get(request_id)
+        if cancel_token is None:
+            return False
+        cancel_token.cancel()
+        return True
+
+    def _login(self, accounts, cancel_token):
+        return _results(self.app.login(_accounts(accounts), cancel_token))
+
+    def _logout(self, accounts):
+        return _results(self.app.logout(_accounts(accounts)))
+
+    def _launch_tf2(self, accounts, cancel_token, launch_options=None,
+                    autoexec_cfg=None):
+        return _results(self.app.launch_tf2(_accounts(accounts),
+                                            launch_options, autoexec_cfg,
+                                            cancel_token))
+
+    def _up(self, accounts, cancel_token, launch_options=None,
+            autoexec_cfg=None):
+        return ([account.username, login_result, launch_result]
+                for account, login_result, launch_result in self.app.up(
+                    _accounts(accounts), launch_options, autoexec_cfg,
+                    cancel_token))
+
+    def _supervise(self, accounts, cancel_token, launch_options=None,
+                   autoexec_cfg=None):
+        return ([account.username, login_result, launch_result]
+                for account, login_result, launch_result in
+                self.app.supervise(_accounts(accounts), launch_options,
+                                   autoexec_cfg, cancel_token))
+
+    def _close_tf2(self, accounts):
+        return _results(self.app.close_tf2(_accounts(accounts)))
+
+    def _status(self, usernames=None):
+        return [list(status) for status in self.app.status(usernames)]
+
+    def serve_forever(self):
+        """Records the port and token in `path` and serves requests until
+        `shutdown` is called."""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'port': self.port, 'token': self.token,
+                       'pid': os.getpid()}, f)
+        os.replace(temp_path, self.path)
+        self.server.serve_forever(poll_interval=0.5)
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def close(self):
+        self.server.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def _result(value):
+    """Turns the lists that JSON made of result tuples back into tuples."""
+    return tuple(value) if isinstance(value, list) else value
+
+
+class DaemonClient(object):
+    """Runs commands in a `Tf2IdleDaemon`. Has the methods of `Tf2IdleApp`
+    that `tf2idle.main` uses, with the same return values, except that
+    `provision` returns a sorted list of usernames."""
+
+    def __init__(self, port, token, host='127.0.0.1'):
+        self.port = port
+        self.token = token
+        self.host = host
+        # The ids of requests sent that have not finished, so that `cancel`
+        # can cancel them after an interruption.
+        self._requests = set()
+
+    @classmethod
+    def find(cls, path):
+        """Returns a client of the daemon whose state is in `path`, or None
+        if no daemon is serving."""
+        try:
+            with open(path, 'r') as f:
+                state = json.load(f)
+            client = cls(state['port'], state['token'])
+            client.call('ping', timeout=1)
+        except (IOError, OSError, ValueError, KeyError, DaemonError):
+            return None
+        return client
+
+    def _responses(self, method, params=None, timeout=None):
+        """Calls `method` in the daemon and yields its responses, up to and
+        including the one with the result. Raises `DaemonError` if it
+        failed."""
+        request_id = secrets.token_hex(8)
+        request = {'token': self.token, 'id': request_id, 'method': method,
+                   'params': params or {}}
+        self._requests.add(request_id)
+        with socket.create_connection((self.host, self.port),
+                                      timeout) as sock:
+            with sock.makefile('rwb') as f:
+                f.write(json.dumps(request).encode('utf-8') + b'\n')
+                f.flush()
+                for line in f:
+                    try:
+                        response = json.loads(line.decode('utf-8'))
+                    except ValueError as e:
+                        raise DaemonError(
+                            'Invalid response from the daemon.') from e
+                    if 'error' in response:
+                        self._requests.discard(request_id)
+                        raise DaemonError(response['error'])
+                    if 'result' in response:
+                        self._requests.discard(request_id)
+                    yield response
+                    if 'result' in response:
+                        return
+        raise DaemonError('The daemon closed the connection.')
+
+    def call(self, method, params=None, timeout=None):
+        """Calls `method` in the daemon and returns its result. Raises
+        `DaemonError` if it failed."""
+        for response in self._responses(method, params, timeout):
+            if 'result' in response:
+                return response['result']
+
+    def _account_params(self, accounts, **params):
+        params['accounts'] = [list(account) for account in accounts]
+        if params.get('autoexec_cfg') is not None:
+            params['autoexec_cfg'] = os.path.abspath(params['autoexec_cfg'])
+        return params
+
+    def _results(self, method, accounts, **params):
+        results = self.call(method, self._account_params(accounts,
+                                                         **params))
+        return {index: _result(result)
+                for index, result in enumerate(results)}
+
+    def _up_results(self, method, accounts, **params):
+        """Yields the results of an account as soon as the daemon sends
+        them."""
+        for response in self._responses(
+                method, self._account_params(accounts, **params)):
+            if 'item' in response:
+                username, login_result, launch_result = response['item']
+                yield (SteamAccount(username, None), login_result,
+                       _result(launch_result))
+
+    def provision(self, usernames, force=False):
+        return self.call('provision', {'usernames': usernames,
+                                       'force': force})
+
+    def login(self, accounts):
+        return self._results('login', accounts)
+
+    def logout(self, accounts):
+        return self._results('logout', accounts)
+
+    def launch_tf2(self, accounts, launch_options=None, autoexec_cfg=None):
+        return self._results('launch_tf2', accounts,
+                             launch_options=launch_options,
+                             autoexec_cfg=autoexec_cfg)
+
+    def up(self, accounts, launch_options=None, autoexec_cfg=None):
+        return self._up_results('up', accounts,
+                                launch_options=launch_options,
+                                autoexec_cfg=autoexec_cfg)
+
+    def supervise(self, accounts, launch_options=None, autoexec_cfg=None):
+        return self._up_results('supervise', accounts,
+                                launch_options=launch_options,
+                                autoexec_cfg=autoexec_cfg)
+
+    def close_tf2(self, accounts):
+        return self._results('close_tf2', accounts)
+
+    def status(self, usernames=None):
+        return [AccountStatus(*status)
+                for status in self.call('status', {'usernames': usernames})]
+
+    def cancel(self):
+        """Cancels the logins and launches of the requests that were
+        interrupted, e.g. by Ctrl+C."""
+        for request_id in list(self._requests):
+            self._requests.discard(request_id)
+            try:
+                self.call('cancel', {'request_id': request_id}, timeout=5)
+            except (OSError, DaemonError):
+                pass
+
+    def close(self):
+        pass
@@ -0,0 +1,120 @@
+import collections
+import concurrent.futures
+import os
+import shutil
+import stat
+import time
+
+
+FsStats = collections.namedtuple('FsStats', 'files bytes seconds')
+
+
+class FsCounter(object):
+    """Counts the files and bytes handled by a filesystem operation."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.started = time.time()
+
+    def add(self, size=0):
+        self.files += 1
+        self.bytes += size
+
+    def stats(self):
+        return FsStats(self.files, self.bytes, time.time() - self.started)
+
+
+def iter_files(path):
+    """Yields a ``os.DirEntry`` for every file and symlink beneath `path`.
+    Directory symlinks are not followed."""
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            else:
+                yield entry
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except PermissionError:
+        # Read-only files cannot be removed on Windows.
+        os.chmod(path, stat.S_IWRITE)
+        os.remove(path)
+
+
+def remove_tree(path, counter=None):
+    """Removes `path` and everything beneath it without following
+    symlinks. Removed files are added to `counter`. Returns the counter."""
+    counter = counter or FsCounter()
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                remove_tree(entry.path, counter)
+            else:
+                # On Windows the size comes from the directory listing.
+                size = entry.stat(follow_symlinks=False).st_size
+                remove_file(entry.path)
+                counter.add(0 if entry.is_symlink() else size)
+    os.rmdir(path)
+    return counter
+
+
+def copy_tree(src, dest, counter=None):
+    """Copies `src` to `dest` like ``shutil.copytree(src, dest,
+    symlinks=True)``. Copied files are added to `counter`. Returns the
+    counter."""
+    counter = counter or FsCounter()
+    os.makedirs(dest)
+    with os.scandir(src) as entries:
+        for entry in entries:
+            target = os.path.join(dest, entry.name)
+            if entry.is_symlink():
+                os.symlink(os.readlink(entry.path), target)
+                counter.add()
+            elif entry.is_dir():
+                copy_tree(entry.path, target, counter)
+            else:
+                shutil.copy2(entry.path, target)
+                counter.add(entry.stat().st_size)
+    shutil.copystat(src, dest)
+    return counter
+
+
+class BulkFilesystem(object):
+    """Runs filesystem operations for many installations at once on a
+    bounded pool of `max_workers` threads. Linking and unlinking is mostly
+    waiting on the disk, so a handful of threads keeps it busy."""
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+
+    def run(self, func, items):
+        """Calls `func` with every item in `items`. Returns a dict of
+        results keyed by item; the result of a call that raised is the
+        exception."""
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers) as executor:
+            jobs = {executor.submit(func, item): item for item in items}
+            for job in concurrent.futures.as_completed(jobs):
+                try:
+                    results[jobs[job]] = job.result()
+                except Exception as e:
+                    results[jobs[job]] = e
+        return results
+
+    def link(self, installations, other_installation):
+        """Links every installation to `other_installation`. Returns a dict
+        of `FsStats` (or exceptions) keyed by installation."""
+        return self.run(lambda installation:
+                        installation.link(other_installation),
+                        installations)
+
+    def unlink(self, installations):
+        """Unlinks every installation. Returns a dict of `FsStats` (or
+        exceptions) keyed by installation."""
+        return self.run(lambda installation: installation.unlink(),
+                        installations)
@@ -0,0 +1,255 @@
+import ctypes
+import os
+import sys
+import threading
+
+
+def _nearest_existing_dir(path):
+    while path and not os.path.isdir(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+class StatPollingBackend(object):
+    """Wakes the watcher every `interval` seconds so that it can stat the
+    followed files."""
+
+    def __init__(self, interval=1):
+        self.interval = interval
+        self._wakeup = threading.Event()
+
+    def update(self, paths):
+        """Called before every wait with the paths of the followed files."""
+        pass
+
+    def wake(self):
+        self._wakeup.set()
+
+    def wait(self):
+        """Blocks until a followed file may have changed."""
+        self._wakeup.wait(self.interval)
+        self._wakeup.clear()
+
+    def close(self):
+        self.wake()
+
+
+class ChangeNotificationBackend(StatPollingBackend):
+    """Wakes the watcher when anything changes beneath the directories that
+    contain the followed files, using ``FindFirstChangeNotification``.
+
+    A file's directory may not exist yet (TF2 creates it on launch), so the
+    nearest existing ancestor is watched instead. Files are still stat'ed
+    every `interval` seconds in case a notification is missed.
+    """
+    FILE_NOTIFY_CHANGE_FILE_NAME = 0x01
+    FILE_NOTIFY_CHANGE_DIR_NAME = 0x02
+    FILE_NOTIFY_CHANGE_SIZE = 0x08
+    FILE_NOTIFY_CHANGE_LAST_WRITE = 0x10
+    MAXIMUM_WAIT_OBJECTS = 64
+    WAIT_OBJECT_0 = 0
+
+    def __init__(self, interval=5):
+        super(ChangeNotificationBackend, self).__init__(interval)
+        from ctypes import wintypes
+        self._kernel32 = ctypes.windll.kernel32
+        self._kernel32.CreateEventW.restype = wintypes.HANDLE
+        self._kernel32.FindFirstChangeNotificationW.restype = wintypes.HANDLE
+        self._handle_type = wintypes.HANDLE
+        self._invalid_handle = ctypes.c_void_p(-1).value
+        self._wakeup_handle = self._kernel32.CreateEventW(None, False, False,
+                                                          None)
+        if not self._wakeup_handle:
+            raise OSError('Could not create wakeup event.')
+        self._lock = threading.Lock()
+        self._handles = {}
+
+    def update(self, paths):
+        flags = (self.FILE_NOTIFY_CHANGE_FILE_NAME |
+                 self.FILE_NOTIFY_CHANGE_DIR_NAME |
+                 self.FILE_NOTIFY_CHANGE_SIZE |
+                 self.FILE_NOTIFY_CHANGE_LAST_WRITE)
+        dirs = {_nearest_existing_dir(os.path.dirname(path))
+                for path in paths}
+        with self._lock:
+            for d in set(self._handles) - dirs:
+                handle = self._handles.pop(d)
+                self._kernel32.FindCloseChangeNotification(handle)
+            for d in sorted(dirs - set(self._handles)):
+                # One wait slot is reserved for the wakeup event; the rest
+                # of the directories are only covered by polling.
+                if len(self._handles) >= self.MAXIMUM_WAIT_OBJECTS - 1:
+                    break
+                handle = self._kernel32.FindFirstChangeNotificationW(
+                    d, True, flags)
+                if handle and handle != self._invalid_handle:
+                    self._handles[d] = handle
+
+    def wake(self):
+        self._kernel32.SetEvent(self._wakeup_handle)
+
+    def wait(self):
+        with self._lock:
+            handles = [self._wakeup_handle] + list(self._handles.values())
+        array = (self._handle_type * len(handles))(*handles)
+        result = self._kernel32.WaitForMultipleObjects(
+            len(handles), array, False, int(self.interval * 1000))
+        index = result - self.WAIT_OBJECT_0
+        if 1 <= index < len(handles):
+            self._kernel32.FindNextChangeNotification(handles[index])
+
+    def close(self):
+        self.update([])
+        self.wake()
+
+
+def default_backend():
+    if sys.platform == 'win32':
+        try:
+            return ChangeNotificationBackend()
+        except OSError:
+            pass
+    return StatPollingBackend()
+
+
+class FollowedFile(object):
+    """The read state of one file followed by a `LogWatcher`."""
+
+    def __init__(self, path, consumer):
+        self.path = path
+        self.consumer = consumer
+        self.position = 0
+        self.identity = None
+        self.partial = b''
+        # True while skipping the rest of a line that is too long.
+        self.discarding = False
+        self.followed = True
+
+
+class LogWatcher(object):
+    """Follows many growing log files from a single thread, similar to
+    Unix's tail -F.
+
+    Complete lines are decoded and handed to each file's consumer, in order.
+    Files that do not exist yet are picked up once they are created, and
+    files that are truncated or replaced are read again from the start.
+    Lines longer than `max_line_length` bytes are discarded.
+    """
+
+    def __init__(self, backend=None, encoding='utf-8', chunk_size=64 * 1024,
+                 max_line_length=64 * 1024):
+        self.backend = backend or default_backend()
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.max_line_length = max_line_length
+        self._lock = threading.Lock()
+        self._files = []
+        self._active = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def follow(self, path, consumer):
+        """Calls `consumer` with every line written to `path`, starting at
+        the beginning of the file. Returns a handle for `unfollow`."""
+        followed = FollowedFile(path, consumer)
+        with self._lock:
+            self._files.append(followed)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='LogWatcher')
+                self._thread.daemon = True
+                self._thread.start()
+            self._active.set()
+        self.backend.wake()
+        return followed
+
+    def unfollow(self, followed):
+        with self._lock:
+            followed.followed = False
+            if followed in self._files:
+                self._files.remove(followed)
+
+    def close(self):
+        self._stopped.set()
+        self._active.set()
+        self.backend.close()
+
+    def poll(self):
+        """Reads whatever has been appended to every followed file since the
+        last poll. Returns the number of lines handed to consumers."""
+        with self._lock:
+            files = list(self._files)
+        return sum(self._read(followed) for followed in files)
+
+    def _read(self, followed):
+        try:
+            st = os.stat(followed.path)
+        except OSError:
+            followed.identity = None
+            return 0
+
+        # st_ctime is the creation time on Windows, where st_ino may be 0.
+        identity = (st.st_dev, st.st_ino) if st.st_ino else st.st_ctime
+        if identity != followed.identity or st.st_size < followed.position:
+            # New, replaced or truncated file: start over.
+            followed.identity = identity
+            followed.position = 0
+            followed.partial = b''
+            followed.discarding = False
+
+        if st.st_size == followed.position:
+            return 0
+
+        count = 0
+        try:
+            with open(followed.path, 'rb') as fileobj:
+                fileobj.seek(followed.position)
+                for chunk in iter(lambda: fileobj.read(self.chunk_size), b''):
+                    followed.position += len(chunk)
+                    count += self._feed(followed, chunk)
+        except (IOError, OSError):
+            pass
+        return count
+
+    def _feed(self, followed, chunk):
+        lines = (followed.partial + chunk).split(b'\n')
+        followed.partial = lines.pop()
+        if followed.discarding and lines:
+            lines.pop(0)
+            followed.discarding = False
+        if len(followed.partial) > self.max_line_length:
+            followed.partial = b''
+            followed.discarding = True
+
+        count = 0
+        for line in lines:
+            if not followed.followed:
+                break
+            if len(line) > self.max_line_length:
+                continue
+            line = line.rstrip(b'\r').decode(self.encoding, 'replace')
+            try:
+                followed.consumer(line)
+            except Exception as e:
+                print('Log consumer for', followed.path, 'failed:', e)
+                self.unfollow(followed)
+                break
+            count += 1
+        return count
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                if not self._files:
+                    self._active.clear()
+                paths = [followed.path for followed in self._files]
+            if not self._active.is_set():
+                self._active.wait()
+                continue
+
+            self.poll()
+            self.backend.update(paths)
+            self.backend.wait()
@@ -3,9 +3,14 @@
 import argparse
 import configparser
 import getpass
+import json
 import os
 
 import tf2idle.app
+from tf2idle.daemon import DaemonClient, Tf2IdleDaemon, state_path
+from tf2idle.memory import MemoryGovernor
+from tf2idle.placement import parse_cores
+from tf2idle.status import format_duration
 from tf2idle.steam import SteamAccount
 
 
@@ -21,6 +26,10 @@ def get_accounts(usernames, password_required=False):
     return accounts
 
 
+def provision(app, args):
+    app.provision(args.usernames, force=args.force)
+
+
 def login(app, args):
     accounts = get_accounts(args.usernames, password_required=True)
     app.login(accounts)
@@ -31,15 +40,144 @@ def logout(app, args):
     app.logout(accounts)
 
 
+def get_autoexec_cfg(args):
+    return args.autoexec.name if args.autoexec is not None else None
+
+
 def launch_tf2(app, args):
     accounts = get_accounts(args.usernames)
     app.launch_tf2(accounts, launch_options=args.launch_options,
-                   autoexec_cfg=args.autoexec)
+                   autoexec_cfg=get_autoexec_cfg(args))
+
+
+def print_up_results(results):
+    for account, login_result, launch_result in results:
+        print('{}: login result {}, launch result {}'.format(
+            account.username, login_result, launch_result))
+
+
+def up(app, args):
+    accounts = get_accounts(args.usernames, password_required=True)
+    print_up_results(app.up(accounts, launch_options=args.launch_options,
+                            autoexec_cfg=get_autoexec_cfg(args)))
+
+
+def supervise(app, args):
+    accounts = get_accounts(args.usernames, password_required=True)
+    print_up_results(app.supervise(accounts,
+                                   launch_options=args.launch_options,
+                                   autoexec_cfg=get_autoexec_cfg(args)))
+    if isinstance(app, DaemonClient):
+        print('The daemon supervises the accounts.')
+        return
+    while not app.cancel_token.wait(1):
+        pass
 
 
 def close_tf2(app, args):
     accounts = get_accounts(args.usernames)
     app.close_tf2(accounts)
+    if isinstance(app, DaemonClient):
+        return  # The daemon deletes TF2 directories in the background.
+    items, _ = app.trash.pending()
+    if items:
+        print('{} TF2 directories are left in the trash; they are deleted '
+              'in the background by the daemon or later commands.'.format(
+                  items))
+
+
+STATUS_FORMAT = '{:<20} {:<5} {:<9} {:<5} {:<9} {:>9} {:>6} {:>8}  {}'
+
+
+def status(app, args):
+    statuses = app.status(None if args.all else args.usernames)
+    if args.json:
+        print(json.dumps([status._asdict() for status in statuses]))
+        return
+
+    def yes_no(value):
+        return 'yes' if value else 'no'
+
+    print(STATUS_FORMAT.format('USERNAME', 'STEAM', 'LOGGED IN', 'HL2',
+                               'CONNECTED', 'UPTIME', 'CPU %', 'RSS MB',
+                               'SV / CL PORTS'))
+    for status in statuses:
+        ports = ''
+        if status.server_port is not None:
+            ports = '{} / {}'.format(status.server_port, status.client_port)
+        print(STATUS_FORMAT.format(
+            status.username, yes_no(status.steam_running),
+            yes_no(status.logged_in), yes_no(status.hl2_running),
+            yes_no(status.connected),
+            '-' if status.uptime is None else format_duration(status.uptime),
+            '-' if status.cpu_percent is None else
+            '{:.1f}'.format(status.cpu_percent),
+            '-' if status.rss is None else
+            '{:.0f}'.format(status.rss / (1024 * 1024)),
+            ports))
+
+
+def daemon(app, args):
+    server = Tf2IdleDaemon(app, state_path(app.working_dir),
+                           port=args.daemon_port)
+    print('Serving commands on {}:{}.'.format(server.host, server.port))
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+
+
+def concurrency_limit(value):
+    """Parses an 'OPERATION=LIMIT' string into an (operation, limit)
+    tuple."""
+    operation, _, limit = value.partition('=')
+    if operation == 'launch_tf2':
+        raise argparse.ArgumentTypeError(
+            'TF2 launches are limited by --max-launches.')
+    try:
+        return operation, int(limit)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Invalid concurrency limit: {}'.format(value))
+
+
+def phase_timeout(value):
+    """Parses a 'PHASE=SECONDS' string into a (phase, seconds) tuple."""
+    phase, _, seconds = value.partition('=')
+    try:
+        return phase, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Invalid phase timeout: {}'.format(value))
+
+
+def core_list(value):
+    try:
+        return parse_cores(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Invalid core list: {}'.format(value))
+
+
+def memory_actions(value):
+    actions = tuple(action.strip() for action in value.split(','))
+    if not set(actions) <= set(MemoryGovernor.ACTIONS):
+        raise argparse.ArgumentTypeError(
+            'Invalid memory actions: {}'.format(value))
+    return actions
+
+
+def registry_setting(value):
+    """Parses a 'NAME=VALUE' string into a (name, value) tuple. Integer
+    values are DWORDs, anything else a string."""
+    name, sep, value = value.partition('=')
+    if not name or not sep:
+        raise argparse.ArgumentTypeError(
+            'Invalid registry setting: {}'.format(value))
+    try:
+        return name, int(value, 0)
+    except ValueError:
+        return name, value
 
 
 def build_arg_parser():
@@ -55,6 +193,117 @@ def build_arg_parser():
     parser.add_argument('--sandboxie-install-dir',
                         dest='sandboxie_install_dir',
                         help='Path to Sandboxie installation.')
+    parser.add_argument('--local', action='store_true',
+                        help=('Run the command in this process even if a '
+                              'daemon is running. Otherwise commands are run '
+                              'by the daemon, with its options.'))
+    parser.add_argument('--max-workers', dest='max_workers', type=int,
+                        help=('Maximum number of threads performing blocking '
+                              'work for all accounts.'))
+    parser.add_argument('--fs-workers', dest='fs_workers', type=int,
+                        default=8,
+                        help=('Number of threads linking and removing idler '
+                              'installations.'))
+    parser.add_argument('--tf2-template-dir', dest='tf2_template_dir',
+                        help=('Extracted "team fortress 2" directory that '
+                              'idler game directories are hardlinked from. '
+                              'Defaults to the first one in the base Steam '
+                              'installation.'))
+    parser.add_argument('--cpu-cores', metavar='CORES', dest='cpu_cores',
+                        type=core_list,
+                        help=('Cores that Steam and TF2 are pinned to, e.g. '
+                              '2-7. Defaults to all but the first.'))
+    parser.add_argument('--registry-setting', metavar='NAME=VALUE',
+                        dest='registry_settings', type=registry_setting,
+                        action='append',
+                        help=('Override a TF2 registry setting applied in '
+                              'every sandbox, e.g. mat_picmip=2 or '
+                              'ScreenWidth=640. May be repeated.'))
+    parser.add_argument('--trash-rate', dest='trash_rate', type=float,
+                        default=64,
+                        help=('Maximum rate (in MB/s) at which closed TF2 '
+                              'directories are deleted.'))
+    parser.add_argument('--concurrency', metavar='OPERATION=LIMIT',
+                        type=concurrency_limit, action='append',
+                        help=('Maximum number of accounts concurrently '
+                              'running an operation (login, logout or '
+                              'close_tf2), e.g. login=4. May be repeated. '
+                              'TF2 launches are limited by '
+                              '--max-launches.'))
+    parser.add_argument('--timeout', metavar='PHASE=SECONDS',
+                        dest='timeouts', type=phase_timeout,
+                        action='append',
+                        help=('Give up on a login or launch that spends '
+                              'longer in a phase (steam_process, login, '
+                              'updating, restart, hl2_process or '
+                              'connection), e.g. connection=120. May be '
+                              'repeated.'))
+
+    launches = parser.add_argument_group(
+        'launch admission',
+        'TF2 launches are admitted one at a time while the host has spare '
+        'capacity.')
+    launches.add_argument('--max-launches', dest='max_launches', type=int,
+                          default=4,
+                          help='Maximum number of TF2 launches in progress.')
+    launches.add_argument('--launch-ramp-up', dest='launch_ramp_up',
+                          type=float, default=10,
+                          help='Minimum number of seconds between launches.')
+    launches.add_argument('--max-cpu-percent', dest='max_cpu_percent',
+                          type=float, default=80,
+                          help='Do not launch while CPU usage is higher.')
+    launches.add_argument('--min-free-memory', dest='min_free_memory',
+                          type=int, default=512,
+                          help=('Do not launch while less memory (in MB) is '
+                                'available.'))
+    launches.add_argument('--max-disk-queue', dest='max_disk_queue',
+                          type=float, default=2,
+                          help=('Do not launch while more disk I/Os are '
+                                'outstanding on average.'))
+
+    memory = parser.add_argument_group(
+        'memory budget',
+        'Running Steam and TF2 instances are kept within a memory budget.')
+    memory.add_argument('--max-instance-memory', dest='max_instance_memory',
+                        type=int,
+                        help=('Memory (in MB) that the Steam and TF2 '
+                              'processes of one account may use.'))
+    memory.add_argument('--max-fleet-memory', dest='max_fleet_memory',
+                        type=int,
+                        help=('Memory (in MB) that the Steam and TF2 '
+                              'processes of all accounts may use.'))
+    memory.add_argument('--memory-actions', metavar='ACTIONS',
+                        dest='memory_actions', type=memory_actions,
+                        default=MemoryGovernor.ACTIONS,
+                        help=('Comma-separated actions taken when over '
+                              'budget: trim (the working set), restart (TF2) '
+                              'and refuse (new launches). Defaults to all.'))
+
+    supervision = parser.add_argument_group(
+        'supervision',
+        'The supervise command restarts Steam and TF2 when they crash, hang '
+        'or get disconnected.')
+    supervision.add_argument('--silence-timeout', dest='silence_timeout',
+                             type=float, default=30,
+                             help=('Restart TF2 when its console has been '
+                                   'silent for this many minutes.'))
+    supervision.add_argument('--max-restarts', dest='max_restarts',
+                             type=int, default=5,
+                             help=('Give up on an account that needs more '
+                                   'restarts within an hour.'))
+
+    metrics = parser.add_argument_group(
+        'metrics',
+        'How long provisioning, logins and launches spend in each phase.')
+    metrics.add_argument('--metrics-file', dest='metrics_path',
+                         help=('Prometheus text file to write phase '
+                               'histograms to, e.g. in the directory of '
+                               "node_exporter's textfile collector. Defaults "
+                               'to tf2idle.prom in the working directory.'))
+    metrics.add_argument('--phase-log', dest='phase_log_path',
+                         help=('File to append every phase timing to as a '
+                               'line of JSON. Defaults to phases.jsonl in '
+                               'the working directory.'))
 
     subparsers = parser.add_subparsers(title='commands')
 
@@ -63,6 +312,16 @@ def build_arg_parser():
     accounts_group.add_argument('--usernames', metavar='USERNAME', nargs='+',
                                 help='Steam account usernames')
 
+    provision_parser = subparsers.add_parser(
+        'provision', parents=[accounts],
+        help=('Create sandboxes and link installations. Other commands do '
+              'this on demand for accounts that are not provisioned yet.'))
+    provision_parser.add_argument('--force', action='store_true',
+                                  help=('Update accounts that are already '
+                                        'provisioned, e.g. after the base '
+                                        'Steam installation was updated.'))
+    provision_parser.set_defaults(func=provision)
+
     login_parser = subparsers.add_parser('login', parents=[accounts],
                                          help='Login to Steam')
     login_parser.set_defaults(func=login)
@@ -71,17 +330,53 @@ def build_arg_parser():
                                           help='Logout of Steam')
     logout_parser.set_defaults(func=logout)
 
+    tf2_options = argparse.ArgumentParser('TF2 Options', add_help=False)
+    tf2_options.add_argument('--launch-options', dest='launch_options',
+                             default=None,
+                             help=('TF2 launch options.'))
+    tf2_options.add_argument('--autoexec',
+                             type=argparse.FileType('r'),
+                             help=('Path to the .cfg file that will be '
+                                   'executed upon launching TF2.'))
+
     launchtf2_parser = subparsers.add_parser('launchtf2', help='Launch TF2',
-                                             parents=[accounts])
-    launchtf2_parser.add_argument('--launch-options', dest='launch_options',
-                                  default=None,
-                                  help=('TF2 launch options.'))
-    launchtf2_parser.add_argument('--autoexec',
-                                  type=argparse.FileType('r'),
-                                  help=('Path to the .cfg file that will be '
-                                        'executed upon launching TF2.'))
+                                             parents=[accounts, tf2_options])
     launchtf2_parser.set_defaults(func=launch_tf2)
 
+    up_parser = subparsers.add_parser(
+        'up', parents=[accounts, tf2_options],
+        help=('Login to Steam and launch TF2, launching each account as '
+              'soon as it is logged in'))
+    up_parser.set_defaults(func=up)
+
+    supervise_parser = subparsers.add_parser(
+        'supervise', parents=[accounts, tf2_options],
+        help=('Login to Steam, launch TF2 and keep both running until '
+              'interrupted'))
+    supervise_parser.set_defaults(func=supervise)
+
+    status_parser = subparsers.add_parser(
+        'status', help='Show whether accounts are logged in and idling')
+    status_accounts = status_parser.add_mutually_exclusive_group(
+        required=True)
+    status_accounts.add_argument('--usernames', metavar='USERNAME',
+                                 nargs='+', help='Steam account usernames')
+    status_accounts.add_argument('--all', action='store_true',
+                                 help='All provisioned accounts')
+    status_parser.add_argument('--json', action='store_true',
+                               help='Print a JSON list, e.g. for monitoring')
+    status_parser.set_defaults(func=status)
+
+    daemon_parser = subparsers.add_parser(
+        'daemon',
+        help=('Keep running and serve the other commands, so that they do '
+              'not rediscover Steam, TF2 and Sandboxie every time'))
+    daemon_parser.add_argument('--port', dest='daemon_port', type=int,
+                               default=0,
+                               help=('Local TCP port to serve commands on. '
+                                     'Defaults to any free port.'))
+    daemon_parser.set_defaults(func=daemon)
+
     closetf2_parser = subparsers.add_parser('closetf2', help='Close TF2',
                                             parents=[accounts])
     closetf2_parser.set_defaults(func=close_tf2)
@@ -89,13 +384,95 @@ def build_arg_parser():
     return parser
 
 
-def main():
-    args = build_arg_parser().parse_args()
-    app = tf2idle.app.Tf2IdleApp(
+# Options that configure the app, as (dest, option) tuples. A running
+# daemon uses the options it was started with.
+APP_OPTIONS = (
+    ('steam_base_dir', '--steam-base-dir'),
+    ('sandboxie_install_dir', '--sandboxie-install-dir'),
+    ('max_workers', '--max-workers'),
+    ('fs_workers', '--fs-workers'),
+    ('tf2_template_dir', '--tf2-template-dir'),
+    ('cpu_cores', '--cpu-cores'),
+    ('registry_settings', '--registry-setting'),
+    ('trash_rate', '--trash-rate'),
+    ('concurrency', '--concurrency'),
+    ('timeouts', '--timeout'),
+    ('max_launches', '--max-launches'),
+    ('launch_ramp_up', '--launch-ramp-up'),
+    ('max_cpu_percent', '--max-cpu-percent'),
+    ('min_free_memory', '--min-free-memory'),
+    ('max_disk_queue', '--max-disk-queue'),
+    ('max_instance_memory', '--max-instance-memory'),
+    ('max_fleet_memory', '--max-fleet-memory'),
+    ('memory_actions', '--memory-actions'),
+    ('silence_timeout', '--silence-timeout'),
+    ('max_restarts', '--max-restarts'),
+    ('metrics_path', '--metrics-file'),
+    ('phase_log_path', '--phase-log'),
+)
+
+
+def given_app_options(parser, args):
+    """Returns the `APP_OPTIONS` that are not at their defaults."""
+    return [option for dest, option in APP_OPTIONS
+            if getattr(args, dest) != parser.get_default(dest)]
+
+
+def megabytes(value):
+    return None if value is None else value * 1024 * 1024
+
+
+def build_app(args):
+    return tf2idle.app.Tf2IdleApp(
         steam_base_dir=args.steam_base_dir,
         working_dir=args.working_dir,
-        sandboxie_install_dir=args.sandboxie_install_dir)
-    args.func(app, args)
+        sandboxie_install_dir=args.sandboxie_install_dir,
+        concurrency=dict(args.concurrency or ()),
+        max_workers=args.max_workers,
+        launch_options={
+            'max_in_flight': args.max_launches,
+            'ramp_up': args.launch_ramp_up,
+            'max_cpu_percent': args.max_cpu_percent,
+            'min_available_memory': args.min_free_memory * 1024 * 1024,
+            'max_disk_queue': args.max_disk_queue},
+        phase_timeouts=dict(args.timeouts or ()),
+        fs_workers=args.fs_workers,
+        trash_bytes_per_second=args.trash_rate * 1024 * 1024,
+        tf2_template_dir=args.tf2_template_dir,
+        registry_settings=dict(args.registry_settings or ()),
+        cpu_cores=args.cpu_cores,
+        instance_memory_limit=megabytes(args.max_instance_memory),
+        fleet_memory_limit=megabytes(args.max_fleet_memory),
+        memory_actions=args.memory_actions,
+        watchdog_options={'silence_timeout': args.silence_timeout * 60,
+                          'max_restarts': args.max_restarts},
+        metrics_path=args.metrics_path,
+        phase_log_path=args.phase_log_path)
+
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+    app = None
+    if args.func is not daemon and not args.local:
+        app = DaemonClient.find(state_path(
+            args.working_dir or tf2idle.app.Tf2IdleApp.DEFAULT_WORKING_DIR))
+        options = given_app_options(parser, args)
+        if app is not None and options:
+            parser.error('A daemon is running with its own options, which '
+                         'ignore {}. Pass --local to run the command with '
+                         'them.'.format(', '.join(options)))
+    if app is None:
+        app = build_app(args)
+        # Deletes trash left over by earlier commands while this one runs.
+        app.trash.start()
+    try:
+        args.func(app, args)
+    except KeyboardInterrupt:
+        print('Canceling...')
+        app.cancel()
+    finally:
+        app.close()
 
 
 if __name__ == '__main__':
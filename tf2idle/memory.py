@@ -0,0 +1,171 @@
+import ctypes
+import sys
+import threading
+
+import psutil
+
+
+class PsutilMemoryBackend(object):
+    """Measures and acts on real processes.
+
+    `restart` is called with a username to restart that account's TF2
+    instance.
+    """
+
+    def __init__(self, restart=None):
+        self._restart = restart
+
+    def memory(self, process):
+        """Returns the memory used by `process`, in bytes. On Windows, this
+        is the working set."""
+        return process.memory_info().rss
+
+    def trim(self, process):
+        """Asks Windows to trim the working set of `process`. Returns False
+        where that is not supported."""
+        if sys.platform != 'win32':
+            return False
+        PROCESS_SET_QUOTA = 0x0100
+        PROCESS_QUERY_INFORMATION = 0x0400
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(
+            PROCESS_SET_QUOTA | PROCESS_QUERY_INFORMATION, False,
+            process.pid)
+        if not handle:
+            return False
+        try:
+            minus_one = ctypes.c_size_t(-1)
+            return bool(kernel32.SetProcessWorkingSetSize(handle, minus_one,
+                                                          minus_one))
+        finally:
+            kernel32.CloseHandle(handle)
+
+    def restart(self, username):
+        if self._restart is not None:
+            self._restart(username)
+
+
+class MemoryGovernor(object):
+    """Keeps the memory of long-running idlers within budget.
+
+    Every `interval` seconds the memory of each instance's processes (as
+    returned by the `instances` callable, a dict of process lists keyed by
+    username) is sampled through `backend`. An instance is over budget if
+    it uses more than `instance_limit` bytes, or if the fleet uses more than
+    `fleet_limit` bytes and it is one of the largest instances making up
+    the excess. `actions` says what is done about it:
+
+    - 'trim': trim the instance's working set, once;
+    - 'restart': restart the instance if it is still over budget after
+      being trimmed (or right away without 'trim');
+    - 'refuse': refuse new launches through `launch_gate` while the fleet
+      is over budget, until it is below `resume_fraction` of it.
+
+    A limit of None is not enforced.
+    """
+    ACTIONS = ('trim', 'restart', 'refuse')
+
+    def __init__(self, instances, backend, instance_limit=None,
+                 fleet_limit=None, actions=ACTIONS, launch_gate=None,
+                 interval=60, resume_fraction=0.9):
+        self.instances = instances
+        self.backend = backend
+        self.instance_limit = instance_limit
+        self.fleet_limit = fleet_limit
+        self.actions = set(actions)
+        self.launch_gate = launch_gate
+        self.interval = interval
+        self.resume_fraction = resume_fraction
+        self.usage = {}
+        self.refusing = False
+        self._trimmed = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.instance_limit is not None or self.fleet_limit is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or not self.enabled:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='MemoryGovernor')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+
+    def _sample(self, processes):
+        total = 0
+        for process in processes:
+            try:
+                total += self.backend.memory(process)
+            except psutil.Error:
+                pass
+        return total
+
+    def _set_refusing(self, refusing):
+        if refusing == self.refusing or 'refuse' not in self.actions:
+            return
+        self.refusing = refusing
+        if self.launch_gate is not None:
+            if refusing:
+                self.launch_gate.refuse('memory')
+            else:
+                self.launch_gate.allow('memory')
+        print('Memory budget exceeded; holding new launches.' if refusing
+              else 'Memory back within budget; resuming launches.')
+
+    def _relieve(self, username, processes):
+        if 'trim' in self.actions and username not in self._trimmed:
+            self._trimmed.add(username)
+            for process in processes:
+                try:
+                    self.backend.trim(process)
+                except psutil.Error:
+                    pass
+        elif 'restart' in self.actions:
+            print('{}: restarting TF2 to free {:.0f} MB.'.format(
+                username, self.usage[username] / (1024 * 1024)))
+            self._trimmed.discard(username)
+            self.backend.restart(username)
+
+    def tick(self):
+        """Samples every instance once and acts on the ones over budget.
+        Returns the list of usernames that were over budget."""
+        instances = self.instances()
+        self.usage = usage = {username: self._sample(processes)
+                              for username, processes in instances.items()}
+        fleet = sum(usage.values())
+
+        over = [username for username in sorted(usage)
+                if self.instance_limit is not None and
+                usage[username] > self.instance_limit]
+        if self.fleet_limit is not None and fleet > self.fleet_limit:
+            self._set_refusing(True)
+            excess = fleet - self.fleet_limit
+            for username in sorted(usage, key=usage.get, reverse=True):
+                if excess <= 0:
+                    break
+                if username not in over:
+                    over.append(username)
+                excess -= usage[username]
+        elif (self.fleet_limit is None or
+              fleet < self.fleet_limit * self.resume_fraction):
+            self._set_refusing(False)
+
+        for username in over:
+            self._relieve(username, instances[username])
+        self._trimmed &= set(over)
+        return over
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.tick()
+            except Exception as e:
+                print('Memory governor failed:', e)
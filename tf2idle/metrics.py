@@ -0,0 +1,162 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Phases timed across provisioning, login and launch.
+PHASES = ('sandbox_create', 'link', 'steam_spawn', 'login_windows',
+          'steam_update', 'registry_apply', 'hl2_spawn', 'ip_line',
+          'connected')
+
+
+def _write_atomic(path, text):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+class PhaseMetrics(object):
+    """Times the phases of provisioning, logins and launches (see
+    `PHASES`).
+
+    Every observation is counted in a histogram per phase and outcome
+    ('ok', 'failed', 'timeout' or 'canceled'), and logged as a line of JSON
+    with its username. `save` rewrites the histograms as a Prometheus text
+    file at `prometheus_path` (for node_exporter's textfile collector), and
+    appends the logged lines to `events_path`. The histograms are kept in
+    `state_path` so that they keep counting across runs. `save` is also
+    called every `flush_interval` seconds while observations come in.
+    """
+    METRIC = 'tf2idle_phase_seconds'
+
+    def __init__(self, prometheus_path=None, events_path=None,
+                 state_path=None, buckets=DEFAULT_BUCKETS, flush_interval=10):
+        self.prometheus_path = prometheus_path
+        self.events_path = events_path
+        self.state_path = state_path
+        self.buckets = list(buckets)
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._histograms = None
+        self._events = []
+        self._dirty = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _load(self):
+        """Called with the lock held."""
+        if self._histograms is None:
+            self._histograms = {}
+            if self.state_path is not None:
+                try:
+                    with open(self.state_path, 'r') as f:
+                        state = json.load(f)
+                    if state['buckets'] == self.buckets:
+                        self._histograms = state['histograms']
+                except (IOError, OSError, ValueError, KeyError):
+                    pass
+        return self._histograms
+
+    def observe(self, phase, seconds, outcome='ok', username=None):
+        with self._lock:
+            key = '{0}/{1}'.format(phase, outcome)
+            histogram = self._load().get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': [0] * len(self.buckets), 'sum': 0.0,
+                    'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+            self._events.append({'time': time.time(), 'phase': phase,
+                                 'outcome': outcome, 'seconds': seconds,
+                                 'username': username})
+            self._dirty = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='PhaseMetrics')
+                self._thread.daemon = True
+                self._thread.start()
+
+    @contextlib.contextmanager
+    def timer(self, phase, username=None):
+        """A context manager that observes the time spent in its block, with
+        the outcome 'failed' if it raises."""
+        started = time.time()
+        try:
+            yield
+        except BaseException:
+            self.observe(phase, time.time() - started, 'failed', username)
+            raise
+        self.observe(phase, time.time() - started, 'ok', username)
+
+    def histogram(self, phase, outcome='ok'):
+        """Returns (cumulative bucket counts, sum, count) of a phase."""
+        with self._lock:
+            histogram = self._load().get('{0}/{1}'.format(phase, outcome))
+        if histogram is None:
+            return [0] * len(self.buckets), 0.0, 0
+        return (list(histogram['buckets']), histogram['sum'],
+                histogram['count'])
+
+    def _render(self):
+        """Called with the lock held."""
+        lines = ['# HELP {0} Time spent in each phase of provisioning, '
+                 'logins and launches.'.format(self.METRIC),
+                 '# TYPE {0} histogram'.format(self.METRIC)]
+        bounds = ['{0:g}'.format(bound) for bound in self.buckets] + ['+Inf']
+        for key, histogram in sorted(self._load().items()):
+            phase, outcome = key.split('/')
+            labels = 'phase="{0}",outcome="{1}"'.format(phase, outcome)
+            counts = histogram['buckets'] + [histogram['count']]
+            for bound, count in zip(bounds, counts):
+                lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                    self.METRIC, labels, bound, count))
+            lines.append('{0}_sum{{{1}}} {2}'.format(
+                self.METRIC, labels, histogram['sum']))
+            lines.append('{0}_count{{{1}}} {2}'.format(
+                self.METRIC, labels, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def render(self):
+        """Returns the histograms in the Prometheus text format."""
+        with self._lock:
+            return self._render()
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            events, self._events = self._events, []
+            if self.events_path is not None and events:
+                os.makedirs(os.path.dirname(self.events_path) or '.',
+                            exist_ok=True)
+                with open(self.events_path, 'a') as f:
+                    for event in events:
+                        f.write(json.dumps(event) + '\n')
+            if self.state_path is not None:
+                _write_atomic(self.state_path, json.dumps(
+                    {'buckets': self.buckets,
+                     'histograms': self._histograms}))
+            if self.prometheus_path is not None:
+                _write_atomic(self.prometheus_path, self._render())
+            self._dirty = False
+
+    def close(self):
+        self._stopped.set()
+        self.save()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.save()
+            except (IOError, OSError) as e:
+                print('Failed to save phase metrics:', e)
@@ -0,0 +1,114 @@
+import asyncio
+import concurrent.futures
+import functools
+import threading
+
+
+class Orchestrator(object):
+    """Drives account operations for the whole fleet from one asyncio event
+    loop.
+
+    Every operation type (login, logout, close_tf2) has its own concurrency
+    limit, so a batch of slow logins cannot starve logouts. Operations
+    without a limit, such as launch_tf2, whose owner sets it from its
+    `LaunchScheduler`, are limited by `max_workers` only.
+    The blocking work itself (psutil, Sandboxie, window and file polling)
+    runs on a bounded thread pool of `max_workers` threads; the event loop
+    never blocks.
+    """
+    DEFAULT_CONCURRENCY = {
+        'login': 8,
+        'logout': 16,
+        'close_tf2': 16,
+    }
+    DEFAULT_MAX_WORKERS = 32
+
+    def __init__(self, concurrency=None, max_workers=None):
+        self.concurrency = dict(self.DEFAULT_CONCURRENCY)
+        self.concurrency.update(concurrency or {})
+        self.max_workers = max_workers or self.DEFAULT_MAX_WORKERS
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._executor = None
+        self._semaphores = {}
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers)
+            self._loop = asyncio.new_event_loop()
+            self._loop.set_default_executor(self._executor)
+            self._thread = threading.Thread(target=self._loop.run_forever,
+                                            name='Orchestrator')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _semaphore(self, operation):
+        """Returns the semaphore limiting `operation`. Must be called from
+        the event loop."""
+        semaphore = self._semaphores.get(operation)
+        if semaphore is None:
+            limit = self.concurrency.get(operation, self.max_workers)
+            semaphore = self._semaphores[operation] = asyncio.Semaphore(limit)
+        return semaphore
+
+    async def run_blocking(self, operation, func, *args):
+        """Runs the blocking `func` on the thread pool once a slot for
+        `operation` is available."""
+        async with self._semaphore(operation):
+            return await self._loop.run_in_executor(
+                self._executor, functools.partial(func, *args))
+
+    async def run_chain(self, steps):
+        """Runs a sequence of (operation, func, proceed) steps for one
+        account, each step as soon as the previous one has finished. Stops
+        early if `proceed` is not None and returns False for a step's result.
+        Returns the list of results of the steps that ran."""
+        results = []
+        for operation, func, proceed in steps:
+            result = await self.run_blocking(operation, func)
+            results.append(result)
+            if proceed is not None and not proceed(result):
+                break
+        return results
+
+    def submit_coroutine(self, coroutine):
+        """Schedules `coroutine` on the event loop. Returns a
+        ``concurrent.futures.Future``."""
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def submit(self, operation, func, *args):
+        """Schedules the blocking `func` as an `operation`. Returns a
+        ``concurrent.futures.Future``."""
+        return self.submit_coroutine(self.run_blocking(operation, func,
+                                                       *args))
+
+    def submit_chain(self, steps):
+        """Schedules a sequence of (operation, func, proceed) steps. Returns
+        a ``concurrent.futures.Future`` of the list of step results."""
+        return self.submit_coroutine(self.run_chain(steps))
+
+    def run(self, operation, tasks):
+        """Runs a list of blocking `tasks` as `operation` and waits for all
+        of them. Returns a dict of results keyed by task index."""
+        jobs = {self.submit(operation, task): taskid
+                for taskid, task in enumerate(tasks)}
+        results = {}
+        for job in concurrent.futures.as_completed(jobs):
+            results[jobs[job]] = job.result()
+        return results
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._executor.shutdown(wait=True)
+            self._loop = self._thread = self._executor = None
+            self._semaphores = {}
@@ -0,0 +1,149 @@
+import threading
+
+import psutil
+
+
+# Windows priority classes, with nice values elsewhere.
+BELOW_NORMAL_PRIORITY = getattr(psutil, 'BELOW_NORMAL_PRIORITY_CLASS', 10)
+IDLE_PRIORITY = getattr(psutil, 'IDLE_PRIORITY_CLASS', 19)
+
+
+def parse_cores(value):
+    """Parses a core list such as '1-3,6' into a sorted list of core
+    numbers."""
+    cores = set()
+    for part in value.split(','):
+        first, _, last = part.strip().partition('-')
+        cores.update(range(int(first), int(last or first) + 1))
+    return sorted(cores)
+
+
+def default_cores():
+    """All cores but the first, which is left free for other work, unless
+    there is only one."""
+    count = psutil.cpu_count() or 1
+    return list(range(1 if count > 1 else 0, count))
+
+
+class PlacedProcess(object):
+    def __init__(self, process, kind, core):
+        self.process = process
+        self.kind = kind
+        self.core = core
+        self.priority = BELOW_NORMAL_PRIORITY
+
+
+class CpuPlacement(object):
+    """Pins steam.exe and hl2.exe processes to single cores of `cores` and
+    adjusts their priority.
+
+    A new process goes to the core with the least weight, hl2.exe weighing
+    `WEIGHTS['hl2']` and steam.exe `WEIGHTS['steam']`, so that idlers are
+    packed evenly onto `cores` and the other cores stay free. Every
+    `interval` seconds exited processes are dropped and, if the cores have
+    become uneven, processes are moved from the heaviest core to the
+    lightest. Processes using more than `high_cpu_percent` of a core are
+    lowered to idle priority, and raised back to below normal once they use
+    less than `low_cpu_percent`.
+    """
+    WEIGHTS = {'hl2': 1.0, 'steam': 0.25}
+
+    def __init__(self, cores=None, interval=5, high_cpu_percent=50,
+                 low_cpu_percent=10):
+        self.cores = list(cores or default_cores())
+        self.interval = interval
+        self.high_cpu_percent = high_cpu_percent
+        self.low_cpu_percent = low_cpu_percent
+        self._lock = threading.Lock()
+        self._placed = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _loads(self):
+        """Returns a dict of the weight on every core. Called with the lock
+        held."""
+        loads = {core: 0.0 for core in self.cores}
+        for placed in self._placed.values():
+            loads[placed.core] += self.WEIGHTS[placed.kind]
+        return loads
+
+    def add(self, process, kind):
+        """Places the `psutil.Process` `process`, of `kind` 'steam' or
+        'hl2'. Raises ``psutil.NoSuchProcess`` if it has exited."""
+        with self._lock:
+            placed = self._placed.get(process.pid)
+            if placed is not None and placed.process.is_running():
+                return
+            loads = self._loads()
+            core = min(self.cores, key=lambda core: (loads[core], core))
+            placed = PlacedProcess(process, kind, core)
+            process.nice(placed.priority)
+            process.cpu_affinity([core])
+            self._placed[process.pid] = placed
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='CpuPlacement')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def remove(self, pid):
+        with self._lock:
+            self._placed.pop(pid, None)
+
+    def assignments(self):
+        """Returns a dict of the core of every placed pid."""
+        with self._lock:
+            return {pid: placed.core for pid, placed in self._placed.items()}
+
+    def close(self):
+        self._stopped.set()
+
+    def _rebalance(self):
+        """Moves processes from the heaviest to the lightest core while that
+        makes them more even. Called with the lock held."""
+        while True:
+            loads = self._loads()
+            heaviest = max(self.cores, key=lambda core: (loads[core], -core))
+            lightest = min(self.cores, key=lambda core: (loads[core], core))
+            candidates = sorted(
+                (placed for placed in self._placed.values()
+                 if placed.core == heaviest and
+                 loads[lightest] + self.WEIGHTS[placed.kind] <
+                 loads[heaviest]),
+                key=lambda placed: -self.WEIGHTS[placed.kind])
+            if not candidates:
+                return
+            placed = candidates[0]
+            try:
+                placed.process.cpu_affinity([lightest])
+            except psutil.Error:
+                del self._placed[placed.process.pid]
+                continue
+            placed.core = lightest
+
+    def _adjust_priority(self, placed):
+        cpu_percent = placed.process.cpu_percent(None)
+        priority = placed.priority
+        if cpu_percent > self.high_cpu_percent:
+            priority = IDLE_PRIORITY
+        elif cpu_percent < self.low_cpu_percent:
+            priority = BELOW_NORMAL_PRIORITY
+        if priority != placed.priority:
+            placed.process.nice(priority)
+            placed.priority = priority
+
+    def tick(self):
+        """Drops exited processes, rebalances and adjusts priorities."""
+        with self._lock:
+            for pid, placed in list(self._placed.items()):
+                try:
+                    if not placed.process.is_running():
+                        raise psutil.NoSuchProcess(pid)
+                    self._adjust_priority(placed)
+                except psutil.Error:
+                    del self._placed[pid]
+            self._rebalance()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.tick()
@@ -0,0 +1,104 @@
+import collections
+import json
+import os
+import socket
+import threading
+
+
+PortSet = collections.namedtuple('PortSet',
+                                 'client_port host_port steam_port')
+
+
+def port_is_free(port):
+    """Returns True if `port` can be bound for both UDP and TCP."""
+    for kind in (socket.SOCK_DGRAM, socket.SOCK_STREAM):
+        sock = socket.socket(socket.AF_INET, kind)
+        try:
+            sock.bind(('', port))
+        except OSError:
+            return False
+        finally:
+            sock.close()
+    return True
+
+
+class PortAllocator(object):
+    """Gives every account its own `PortSet`, so that TF2 instances do not
+    collide on +clientport, +hostport and -steamport.
+
+    Slot n is (`client_base` + n, `host_base` + n, `steam_base` + n) for n
+    below `slots`, so the ranges of the three ports never overlap. An
+    account keeps its slot across runs (assignments are persisted to
+    `path` by `save`) as long as the ports are free when it launches.
+    """
+
+    def __init__(self, path=None, client_base=27100, host_base=27400,
+                 steam_base=27700, slots=300, is_free=port_is_free):
+        self.path = path
+        self.client_base = client_base
+        self.host_base = host_base
+        self.steam_base = steam_base
+        self.slots = slots
+        self.is_free = is_free
+        self._lock = threading.Lock()
+        self._slots = None
+        self._dirty = False
+
+    def _load(self):
+        """Called with the lock held."""
+        if self._slots is None:
+            self._slots = {}
+            if self.path is not None:
+                try:
+                    with open(self.path, 'r') as f:
+                        self._slots = json.load(f)
+                except (IOError, OSError, ValueError):
+                    pass
+        return self._slots
+
+    def ports(self, slot):
+        return PortSet(self.client_base + slot, self.host_base + slot,
+                       self.steam_base + slot)
+
+    def _slot_is_free(self, slot):
+        return all(self.is_free(port) for port in self.ports(slot))
+
+    def allocate(self, username):
+        """Returns the `PortSet` of `username`, assigning free ports if it
+        has none or its ports are taken. Raises ``RuntimeError`` if no slot
+        is free."""
+        with self._lock:
+            slots = self._load()
+            slot = slots.get(username)
+            if slot is not None and self._slot_is_free(slot):
+                return self.ports(slot)
+
+            taken = set(slots.values())
+            for candidate in range(self.slots):
+                if candidate not in taken and self._slot_is_free(candidate):
+                    slots[username] = candidate
+                    self._dirty = True
+                    return self.ports(candidate)
+        raise RuntimeError('No free ports for {0}.'.format(username))
+
+    def get(self, username):
+        """Returns the `PortSet` assigned to `username`, or None."""
+        with self._lock:
+            slot = self._load().get(username)
+        return None if slot is None else self.ports(slot)
+
+    def release(self, username):
+        with self._lock:
+            if self._load().pop(username, None) is not None:
+                self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if self.path is None or not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self._slots, f)
+            os.replace(temp_path, self.path)
+            self._dirty = False
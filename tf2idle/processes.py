@@ -0,0 +1,115 @@
+import collections
+import os
+import threading
+import time
+
+import psutil
+
+
+def normalize_dir(path):
+    """Returns `path` in a form suitable for comparing directories."""
+    return os.path.normcase(os.path.normpath(path))
+
+
+class ProcessSnapshot(object):
+    """An immutable view of the steam.exe and hl2.exe processes that were
+    running when the snapshot was taken, indexed by Steam directory."""
+
+    def __init__(self, steam_processes, hl2_processes, timestamp):
+        self._steam_processes = steam_processes
+        self._hl2_processes = hl2_processes
+        self.timestamp = timestamp
+
+    def get_steam_process(self, steam_dir, default=None):
+        return self._steam_processes.get(normalize_dir(steam_dir), default)
+
+    def get_hl2_process(self, steam_dir, default=None):
+        return self._hl2_processes.get(normalize_dir(steam_dir), default)
+
+    def steam_dirs(self):
+        return list(self._steam_processes)
+
+
+class ProcessIndex(object):
+    """A fleet-wide index of Steam processes shared by every `SteamClient`.
+
+    The process table is scanned at most once every `max_age` seconds no
+    matter how many clients query the index. Only the cheap attributes
+    (name, ppid, create_time) are fetched for every process; the working
+    directory is fetched for steam.exe processes only, and is remembered for
+    the lifetime of the process.
+    """
+    STEAM_EXE = 'steam.exe'
+    HL2_EXE = 'hl2.exe'
+    PROCESS_ATTRS = ['name', 'ppid', 'create_time']
+
+    def __init__(self, max_age=1, process_iter=psutil.process_iter):
+        self.max_age = max_age
+        self._process_iter = process_iter
+        self._lock = threading.Lock()
+        self._snapshot = None
+        # (pid, create_time) -> normalized cwd of known steam.exe processes
+        self._cwds = {}
+
+    def _get_cwd(self, process):
+        key = (process.pid, process.info['create_time'])
+        if key not in self._cwds:
+            try:
+                self._cwds[key] = normalize_dir(process.cwd())
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                return None
+        return self._cwds[key]
+
+    def _scan(self):
+        steam_processes = {}
+        hl2_by_ppid = collections.defaultdict(list)
+        live_keys = set()
+
+        for process in self._process_iter(attrs=self.PROCESS_ATTRS,
+                                          ad_value=None):
+            name = (process.info['name'] or '').lower()
+            if name == self.STEAM_EXE:
+                live_keys.add((process.pid, process.info['create_time']))
+                cwd = self._get_cwd(process)
+                if cwd is not None:
+                    steam_processes[cwd] = process
+            elif name == self.HL2_EXE:
+                hl2_by_ppid[process.info['ppid']].append(process)
+
+        # Forget the working directories of processes that have exited.
+        for key in set(self._cwds) - live_keys:
+            del self._cwds[key]
+
+        hl2_processes = {}
+        for steam_dir, steam_process in steam_processes.items():
+            children = hl2_by_ppid.get(steam_process.pid)
+            if children:
+                hl2_processes[steam_dir] = children[0]
+
+        return ProcessSnapshot(steam_processes, hl2_processes, time.time())
+
+    def refresh(self):
+        """Rescans the process table and returns the new snapshot."""
+        with self._lock:
+            self._snapshot = self._scan()
+            return self._snapshot
+
+    def invalidate(self):
+        """Forces the next query to rescan the process table."""
+        self._snapshot = None
+
+    def snapshot(self):
+        """Returns a `ProcessSnapshot` that is at most `max_age` seconds
+        old."""
+        with self._lock:
+            snapshot = self._snapshot
+            if (snapshot is None or
+                    time.time() - snapshot.timestamp >= self.max_age):
+                snapshot = self._snapshot = self._scan()
+            return snapshot
+
+    def get_steam_process(self, steam_dir, default=None):
+        return self.snapshot().get_steam_process(steam_dir, default)
+
+    def get_hl2_process(self, steam_dir, default=None):
+        return self.snapshot().get_hl2_process(steam_dir, default)
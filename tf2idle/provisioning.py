@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+
+
+class ProvisionRegistry(object):
+    """Remembers which accounts already have a sandbox and a linked
+    installation, so that commands do not recreate them every time.
+
+    A registered account is only trusted while it was created with the
+    current sandbox options, its sandbox still exists in the Sandboxie
+    config with those options, and its installation is still installed.
+    The registry is persisted to `path` by `save`, if given.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._accounts = None
+        self._dirty = False
+
+    def _load(self):
+        """Called with the lock held."""
+        if self._accounts is None:
+            self._accounts = {}
+            if self.path is not None:
+                try:
+                    with open(self.path, 'r') as f:
+                        self._accounts = json.load(f)
+                except (IOError, OSError, ValueError):
+                    pass
+        return self._accounts
+
+    def record(self, username, sandbox_options):
+        with self._lock:
+            self._load()[username] = {'sandbox_options': sandbox_options}
+            self._dirty = True
+
+    def remove(self, username):
+        with self._lock:
+            if self._load().pop(username, None) is not None:
+                self._dirty = True
+
+    def registered(self, username):
+        with self._lock:
+            return username in self._load()
+
+    def usernames(self):
+        """Returns a sorted list of the registered usernames."""
+        with self._lock:
+            return sorted(self._load())
+
+    def _sandbox_matches(self, sandbox_config, username, options):
+        if not sandbox_config.has_section(username):
+            return False
+        # configparser lowercases option names.
+        section = sandbox_config[username]
+        return all(section.get(key.lower()) == value
+                   for key, value in options.items())
+
+    def provisioned(self, installations, sandbox_config, sandbox_options):
+        """Returns the set of usernames in the dict `installations` of
+        installations keyed by username that are provisioned with
+        `sandbox_options`. `sandbox_config` is the parsed Sandboxie
+        config."""
+        with self._lock:
+            accounts = dict(self._load())
+        provisioned = set()
+        for username, installation in installations.items():
+            account = accounts.get(username)
+            if (account is not None and
+                    account['sandbox_options'] == sandbox_options and
+                    self._sandbox_matches(sandbox_config, username,
+                                          sandbox_options) and
+                    installation.installed()):
+                provisioned.add(username)
+        return provisioned
+
+    def save(self):
+        with self._lock:
+            if self.path is None or not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self._accounts, f)
+            os.replace(temp_path, self.path)
+            self._dirty = False
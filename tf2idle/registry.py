@@ -0,0 +1,111 @@
+import collections
+import hashlib
+import json
+import os
+
+
+TF2_SETTINGS_KEY = 'HKEY_CURRENT_USER\\Software\\Valve\\Source\\tf\\Settings'
+
+# Video settings that minimize TF2's resource consumption. Integers are
+# written as DWORDs, strings as strings.
+DEFAULT_TF2_SETTINGS = collections.OrderedDict([
+    ('AutoConfigVersion', 1),
+    ('DXLevel_V1', 0x51),
+    ('mat_aaquality', 0),
+    ('mat_antialias', 0),
+    ('mat_bumpmap', 0),
+    ('mat_colorcorrection', 0),
+    ('mat_forceaniso', 0),
+    ('mat_forcehardwaresync', 0),
+    ('mat_hdr_level', 0),
+    ('mat_parallaxmap', 0),
+    ('mat_picmip', 2),
+    ('mat_reducefillrate', 1),
+    ('mat_specular', 0),
+    ('mat_trilinear', 0),
+    ('mat_vsync', 0),
+    ('MotionBlur', 0),
+    ('r_rootlod', 2),
+    ('r_shadowrendertotexture', 0),
+    ('r_waterforceexpensive', 0),
+    ('r_waterforcereflectentities', 0),
+    ('ScreenHeight', 600),
+    ('ScreenMonitorGamma', '2.2'),
+    ('ScreenMSAA', 0),
+    ('ScreenMSAAQuality', 0),
+    ('ScreenWidth', 800),
+    ('ScreenWindowed', 1),
+    ('ShadowDepthTexture', 0),
+    ('User Token 2', ''),
+    ('User Token 3', ''),
+])
+
+
+def _reg_string(value):
+    return '"{0}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+class Tf2RegistryProfile(object):
+    """The TF2 registry settings applied in every sandbox:
+    `DEFAULT_TF2_SETTINGS` updated with `overrides`.
+
+    The .reg payload is generated once and written to `store_dir` under its
+    SHA-1, so that it is only written again when the settings change.
+    """
+
+    def __init__(self, store_dir, overrides=None):
+        self.store_dir = store_dir
+        self.settings = collections.OrderedDict(DEFAULT_TF2_SETTINGS)
+        self.settings.update(overrides or {})
+        self.payload = self._render()
+        self.digest = hashlib.sha1(self.payload.encode('utf-8')).hexdigest()
+        self.reg_path = os.path.join(store_dir,
+                                     '{0}.reg'.format(self.digest))
+
+    def _render(self):
+        lines = ['REGEDIT4', '', '[{0}]'.format(TF2_SETTINGS_KEY)]
+        for name, value in self.settings.items():
+            if isinstance(value, int):
+                value = 'dword:{0:08x}'.format(value)
+            else:
+                value = _reg_string(value)
+            lines.append('{0}={1}'.format(_reg_string(name), value))
+        return '\r\n'.join(lines) + '\r\n'
+
+    def write(self):
+        """Writes the .reg file, unless it exists. Returns its path."""
+        if not os.path.exists(self.reg_path):
+            os.makedirs(self.store_dir, exist_ok=True)
+            temp_path = self.reg_path + '.tmp'
+            with open(temp_path, 'w', newline='') as f:
+                f.write(self.payload)
+            os.replace(temp_path, self.reg_path)
+        return self.reg_path
+
+
+class RegistryMarker(object):
+    """Records in `path` which registry profile was applied to a sandbox,
+    and in which Steam session. Sandboxes are emptied, registry included,
+    once their last process exits, so the settings only stay applied while
+    the same Steam process runs."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _value(self, digest, steam_process):
+        return {'digest': digest,
+                'steam_process': [steam_process.pid,
+                                  steam_process.create_time()]}
+
+    def is_current(self, digest, steam_process):
+        try:
+            with open(self.path, 'r') as f:
+                marker = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        return marker == self._value(digest, steam_process)
+
+    def update(self, digest, steam_process):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(self._value(digest, steam_process), f)
@@ -0,0 +1,119 @@
+import configparser
+import io
+import os
+
+
+class SandboxieConfigBackend(object):
+    """Reads, writes and reloads the Sandboxie.ini config of a
+    ``sandboxie.Sandboxie`` instance."""
+
+    def __init__(self, sbie):
+        self.sbie = sbie
+
+    def read(self):
+        """Returns a ``configparser.ConfigParser`` of the config."""
+        return self.sbie.get_config()
+
+    def write(self, config):
+        """Replaces the config file with `config`, in the UTF-16-LE
+        encoding that Sandboxie uses."""
+        path = self.sbie.config_path
+        temp_path = path + '.tmp'
+        with io.open(temp_path, 'w', encoding='utf-16-le') as f:
+            config.write(f)
+        os.replace(temp_path, path)
+
+    def reload(self):
+        """Makes Sandboxie pick up the written config."""
+        self.sbie.reload_config()
+
+
+class MemoryConfigBackend(object):
+    """A `SandboxieConfigBackend` that keeps the config in memory, and
+    counts writes and reloads."""
+
+    def __init__(self, text=''):
+        self.text = text
+        self.writes = 0
+        self.reloads = 0
+
+    def read(self):
+        config = configparser.ConfigParser(strict=False)
+        config.read_string(self.text)
+        return config
+
+    def write(self, config):
+        f = io.StringIO()
+        config.write(f)
+        self.text = f.getvalue()
+        self.writes += 1
+
+    def reload(self):
+        self.reloads += 1
+
+
+class SandboxConfigBatch(object):
+    """Collects sandbox creations, option changes and deletions, and applies
+    them with a single config write and a single reload.
+
+    Changes are applied in the order they were made by `commit`, or on
+    leaving a ``with`` block without an exception. Nothing is written if no
+    change was made.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._changes = []
+
+    def create_sandbox(self, box, options):
+        """Creates (or replaces) the sandbox `box` with a dict of
+        `options`."""
+        self._changes.append(('create', box, dict(options)))
+
+    def set_options(self, box, options):
+        """Updates options of the existing sandbox `box`. Options with a
+        value of None are removed."""
+        self._changes.append(('set', box, dict(options)))
+
+    def destroy_sandbox(self, box):
+        self._changes.append(('destroy', box, None))
+
+    def apply(self, config):
+        """Applies the pending changes to a ``configparser.ConfigParser``
+        `config`."""
+        for change, box, options in self._changes:
+            if change == 'create':
+                config[box] = options
+            elif change == 'destroy':
+                config.remove_section(box)
+            elif config.has_section(box):
+                for key, value in options.items():
+                    if value is None:
+                        config.remove_option(box, key)
+                    else:
+                        config.set(box, key, value)
+
+    def commit(self):
+        """Writes and reloads the config once. Returns the number of changes
+        applied."""
+        if not self._changes:
+            return 0
+        config = self.backend.read()
+        self.apply(config)
+        self.backend.write(config)
+        self.backend.reload()
+        count = len(self._changes)
+        self._changes = []
+        return count
+
+    def discard(self):
+        self._changes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
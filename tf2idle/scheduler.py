@@ -0,0 +1,141 @@
+import collections
+import contextlib
+import threading
+import time
+
+import psutil
+
+
+HostLoad = collections.namedtuple('HostLoad',
+                                  'cpu_percent available_memory disk_queue')
+
+
+class HostLoadSampler(object):
+    """Samples host load with psutil.
+
+    CPU usage and disk queue length are averaged over the time since the
+    previous sample. The disk queue length is the average number of
+    outstanding disk I/Os: the total time spent on I/Os divided by the wall
+    time elapsed (Little's law).
+    """
+
+    def __init__(self):
+        self._last_disk = None
+        psutil.cpu_percent(interval=None)
+
+    def _disk_queue(self):
+        counters = psutil.disk_io_counters()
+        if counters is None:
+            return 0.0
+        now = time.time()
+        busy_ms = counters.read_time + counters.write_time
+        last, self._last_disk = self._last_disk, (now, busy_ms)
+        if last is None or now <= last[0]:
+            return 0.0
+        return max(0.0, (busy_ms - last[1]) / ((now - last[0]) * 1000))
+
+    def sample(self):
+        return HostLoad(psutil.cpu_percent(interval=None),
+                        psutil.virtual_memory().available,
+                        self._disk_queue())
+
+
+class LaunchScheduler(object):
+    """Admits TF2 launches one at a time, only while the host has capacity
+    for another instance.
+
+    A launch is admitted once it is at the head of the queue, fewer than
+    `max_in_flight` launches are in progress, at least `ramp_up` seconds
+    have passed since the previous admission (so that the previous launch's
+    load shows up in the samples), and host CPU usage, available memory and
+    disk queue length are within their thresholds. A threshold of None is
+    not checked. No launch is admitted while launches are refused (see
+    `refuse`).
+
+    The time each account spent queued is recorded in `wait_times`.
+    """
+
+    def __init__(self, max_in_flight=4, ramp_up=10, max_cpu_percent=80,
+                 min_available_memory=512 * 1024 * 1024, max_disk_queue=2,
+                 poll_interval=1, sampler=None):
+        self.max_in_flight = max_in_flight
+        self.ramp_up = ramp_up
+        self.max_cpu_percent = max_cpu_percent
+        self.min_available_memory = min_available_memory
+        self.max_disk_queue = max_disk_queue
+        self.poll_interval = poll_interval
+        self.sampler = sampler or HostLoadSampler()
+        self.wait_times = {}
+        self._condition = threading.Condition()
+        self._queue = collections.deque()
+        self._in_flight = 0
+        self._last_admission = None
+        self._refusals = set()
+
+    def overloaded(self, load):
+        """Returns True if `load` exceeds any threshold."""
+        return ((self.max_cpu_percent is not None and
+                 load.cpu_percent > self.max_cpu_percent) or
+                (self.min_available_memory is not None and
+                 load.available_memory < self.min_available_memory) or
+                (self.max_disk_queue is not None and
+                 load.disk_queue > self.max_disk_queue))
+
+    def refuse(self, reason):
+        """Holds every launch until `allow` is called with the same
+        `reason`."""
+        with self._condition:
+            self._refusals.add(reason)
+
+    def allow(self, reason):
+        with self._condition:
+            self._refusals.discard(reason)
+            self._condition.notify_all()
+
+    def _can_admit(self, ticket):
+        if self._queue[0] is not ticket or self._refusals:
+            return False
+        if self._in_flight >= self.max_in_flight:
+            return False
+        if (self._last_admission is not None and
+                time.time() - self._last_admission < self.ramp_up):
+            return False
+        return not self.overloaded(self.sampler.sample())
+
+    def acquire(self, username, cancel_token=None):
+        """Blocks until a launch for `username` is admitted. Returns the
+        number of seconds spent waiting. Raises `Cancelled` if
+        `cancel_token` is cancelled while waiting."""
+        ticket = object()
+        started = time.time()
+        with self._condition:
+            self._queue.append(ticket)
+            try:
+                while not self._can_admit(ticket):
+                    if cancel_token is not None:
+                        cancel_token.raise_if_cancelled()
+                    self._condition.wait(self.poll_interval)
+            finally:
+                self._queue.remove(ticket)
+                self._condition.notify_all()
+            self._in_flight += 1
+            self._last_admission = time.time()
+            wait_time = self._last_admission - started
+            self.wait_times[username] = wait_time
+        return wait_time
+
+    def release(self, username):
+        """Marks the launch for `username` as finished."""
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def admit(self, username, cancel_token=None):
+        """A context manager that acquires a launch slot for `username`,
+        yields the time spent waiting, and releases the slot on exit."""
+        wait_time = self.acquire(username, cancel_token)
+        try:
+            yield wait_time
+        finally:
+            self.release(username)
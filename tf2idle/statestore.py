@@ -0,0 +1,250 @@
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import psutil
+
+from tf2idle.processes import normalize_dir
+
+
+Outcome = collections.namedtuple('Outcome',
+                                 'username operation result seconds finished')
+Connection = collections.namedtuple(
+    'Connection', 'username ip server_port client_port updated')
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS processes (
+    steam_dir TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    create_time REAL NOT NULL,
+    PRIMARY KEY (steam_dir, kind)
+);
+CREATE TABLE IF NOT EXISTS connections (
+    username TEXT PRIMARY KEY,
+    ip TEXT,
+    server_port INTEGER,
+    client_port INTEGER,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outcomes (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    result TEXT,
+    seconds REAL NOT NULL,
+    finished REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outcomes_by_account
+    ON outcomes (username, operation, id);
+'''
+
+
+def _json_result(result):
+    """Results are ints, bools, None or tuples, which JSON turns into
+    lists."""
+    result = json.loads(result)
+    return tuple(result) if isinstance(result, list) else result
+
+
+class FleetStateStore(object):
+    """Keeps fleet state across runs in the SQLite database `path`: the
+    pid and create time of every steam.exe and hl2.exe, the server each TF2
+    connected to, and the result and duration of every operation.
+
+    The current state is read once and then served from memory. Changes are
+    applied to memory right away and written to the database in batches, in
+    one transaction every `flush_interval` seconds, on `flush` and on
+    `close`. Changes made after `close` are written right away. The
+    database is in WAL mode, so that readers such as another process
+    reading the status do not block the writes.
+    """
+
+    def __init__(self, path, flush_interval=2):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._db = None
+        self._processes = None
+        self._connections = None
+        self._last_outcomes = None
+        self._pending = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        """Returns the open database. Called with the lock held."""
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(SCHEMA)
+            self._db = db
+        return self._db
+
+    def _load(self):
+        """Reads the current state. Called with the lock held."""
+        if self._processes is not None:
+            return
+        self._processes, self._connections, self._last_outcomes = {}, {}, {}
+        if not os.path.exists(self.path):
+            # Nothing was recorded yet; the database is created on the first
+            # write.
+            return
+        db = self._connect()
+        self._processes = {
+            (steam_dir, kind): (pid, create_time)
+            for steam_dir, kind, pid, create_time in db.execute(
+                'SELECT steam_dir, kind, pid, create_time FROM processes')}
+        self._connections = {
+            row[0]: Connection(*row) for row in db.execute(
+                'SELECT username, ip, server_port, client_port, updated '
+                'FROM connections')}
+        for row in db.execute(
+                'SELECT username, operation, result, seconds, finished '
+                'FROM outcomes WHERE id IN (SELECT MAX(id) FROM outcomes '
+                'GROUP BY username, operation)'):
+            outcome = Outcome(row[0], row[1], _json_result(row[2]), row[3],
+                              row[4])
+            self._last_outcomes[outcome.username, outcome.operation] = outcome
+
+    def _write(self, statement, parameters):
+        """Queues a write. Called with the lock held."""
+        self._pending.append((statement, parameters))
+        if self._stopped.is_set():
+            # There is no flusher any more, e.g. for an operation that
+            # finished after `close`.
+            self._flush()
+            self._disconnect()
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='FleetStateStore')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def process(self, steam_dir, kind):
+        """Returns the running ``psutil.Process`` recorded for `steam_dir`
+        of `kind` 'steam' or 'hl2', or None if there is none or it has
+        exited. The pid and create time are checked against the process
+        table, so a reused pid is not mistaken for the recorded process."""
+        with self._lock:
+            self._load()
+            recorded = self._processes.get((normalize_dir(steam_dir), kind))
+        if recorded is None:
+            return None
+        pid, create_time = recorded
+        try:
+            process = psutil.Process(pid)
+            if process.create_time() == create_time:
+                return process
+        except psutil.Error:
+            pass
+        return None
+
+    def record_process(self, steam_dir, kind, process):
+        """Records `process`, or that there is none if it is None."""
+        key = (normalize_dir(steam_dir), kind)
+        value = None
+        if process is not None:
+            try:
+                value = (process.pid, process.create_time())
+            except psutil.Error:
+                pass
+        with self._lock:
+            self._load()
+            if self._processes.get(key) == value:
+                return
+            if value is None:
+                del self._processes[key]
+                self._write('DELETE FROM processes WHERE steam_dir = ? AND '
+                            'kind = ?', key)
+            else:
+                self._processes[key] = value
+                self._write('INSERT OR REPLACE INTO processes VALUES '
+                            '(?, ?, ?, ?)', key + value)
+
+    def record_connection(self, username, ip, server_port, client_port):
+        connection = Connection(username, ip, server_port, client_port,
+                                time.time())
+        with self._lock:
+            self._load()
+            self._connections[username] = connection
+            self._write('INSERT OR REPLACE INTO connections VALUES '
+                        '(?, ?, ?, ?, ?)', connection)
+
+    def connection(self, username):
+        """Returns the last `Connection` of `username`, or None."""
+        with self._lock:
+            self._load()
+            return self._connections.get(username)
+
+    def record_outcome(self, username, operation, result, seconds):
+        outcome = Outcome(username, operation, result, seconds, time.time())
+        with self._lock:
+            self._load()
+            self._last_outcomes[username, operation] = outcome
+            self._write('INSERT INTO outcomes (username, operation, result, '
+                        'seconds, finished) VALUES (?, ?, ?, ?, ?)',
+                        (username, operation, json.dumps(result), seconds,
+                         outcome.finished))
+
+    def last_outcome(self, username, operation):
+        """Returns the last `Outcome` of `operation` for `username`, or
+        None."""
+        with self._lock:
+            self._load()
+            return self._last_outcomes.get((username, operation))
+
+    def forget(self, username, steam_dir):
+        """Removes the processes and connection of an account whose
+        installation is removed. Its outcomes are kept."""
+        steam_dir = normalize_dir(steam_dir)
+        with self._lock:
+            self._load()
+            for kind in ('steam', 'hl2'):
+                if self._processes.pop((steam_dir, kind), None) is not None:
+                    self._write('DELETE FROM processes WHERE steam_dir = ? '
+                                'AND kind = ?', (steam_dir, kind))
+            if self._connections.pop(username, None) is not None:
+                self._write('DELETE FROM connections WHERE username = ?',
+                            (username,))
+
+    def _flush(self):
+        """Called with the lock held."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        db = self._connect()
+        with db:
+            for statement, parameters in pending:
+                db.execute(statement, parameters)
+
+    def _disconnect(self):
+        """Called with the lock held."""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def flush(self):
+        """Writes the queued changes in one transaction."""
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self._stopped.set()
+        with self._lock:
+            self._flush()
+            self._disconnect()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print('Failed to save the fleet state:', e)
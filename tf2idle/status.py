@@ -0,0 +1,93 @@
+import collections
+import time
+
+import psutil
+
+from tf2idle.steam import SteamClient
+
+
+AccountStatus = collections.namedtuple(
+    'AccountStatus',
+    'username steam_running logged_in hl2_running connected uptime '
+    'cpu_percent rss ip server_port client_port')
+
+
+def _usage(process, now):
+    """Returns the start time, the average CPU usage since then (in percent
+    of one core) and the RSS of `process`, or None if it has exited."""
+    try:
+        with process.oneshot():
+            create_time = process.create_time()
+            cpu_times = process.cpu_times()
+            rss = process.memory_info().rss
+    except psutil.Error:
+        return None
+    elapsed = max(now - create_time, 1e-6)
+    cpu_percent = 100 * (cpu_times.user + cpu_times.system) / elapsed
+    return create_time, cpu_percent, rss
+
+
+def account_status(username, steam_process, hl2_process, windows,
+                   connection, ports, now):
+    """Returns the `AccountStatus` of `username`.
+
+    `windows` is the list of windows of `steam_process`, `connection` the
+    last `statestore.Connection` of the account or None, and `ports` its
+    allocated `ports.PortSet` or None. CPU usage and RSS add up Steam and
+    TF2; CPU usage is averaged over the lifetime of each process, so that
+    no second sample is needed.
+    """
+    steam = hl2 = None
+    if steam_process is not None:
+        steam = _usage(steam_process, now)
+    if hl2_process is not None:
+        hl2 = _usage(hl2_process, now)
+    titles = set(window.title for window in windows)
+    logged_in = steam is not None and all(
+        title in titles for title in SteamClient.LOGGED_IN_WINDOWS)
+    usages = [usage for usage in (steam, hl2) if usage is not None]
+
+    connected = (hl2 is not None and connection is not None and
+                 connection.updated >= hl2[0])
+    ip = server_port = client_port = None
+    if connected:
+        ip, server_port, client_port = connection[1:4]
+    elif ports is not None:
+        server_port, client_port = ports.host_port, ports.client_port
+
+    return AccountStatus(
+        username=username,
+        steam_running=steam is not None,
+        logged_in=logged_in,
+        hl2_running=hl2 is not None,
+        connected=connected,
+        uptime=None if hl2 is None else now - hl2[0],
+        cpu_percent=sum(usage[1] for usage in usages) if usages else None,
+        rss=sum(usage[2] for usage in usages) if usages else None,
+        ip=ip, server_port=server_port, client_port=client_port)
+
+
+def fleet_status(accounts, process_snapshot, window_snapshot, state_store,
+                 port_allocator, now=None):
+    """Returns a list of the `AccountStatus` of every (username, steam_dir)
+    in `accounts`, from one `processes.ProcessSnapshot` and one pid ->
+    windows `window_snapshot`."""
+    now = time.time() if now is None else now
+    statuses = []
+    for username, steam_dir in accounts:
+        steam_process = process_snapshot.get_steam_process(steam_dir)
+        windows = ()
+        if steam_process is not None:
+            windows = window_snapshot.get(steam_process.pid, ())
+        statuses.append(account_status(
+            username, steam_process,
+            process_snapshot.get_hl2_process(steam_dir), windows,
+            state_store.connection(username), port_allocator.get(username),
+            now))
+    return statuses
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '{}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60,
+                                   seconds % 60)
@@ -0,0 +1,102 @@
+import collections
+import json
+import os
+import threading
+
+
+class InstallationStatus(collections.namedtuple(
+        'InstallationStatus', 'has_steam_exe missing dangling')):
+    """Whether steam.exe exists, and which required files are missing or
+    are symlinks whose target does not exist."""
+
+    @property
+    def installed(self):
+        return self.has_steam_exe and not self.missing and not self.dangling
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class InstallationStatusCache(object):
+    """Caches `InstallationStatus` results by installation directory.
+
+    Each result is stored with the mtimes of the directories it was
+    computed from: the Steam and steamapps directories and the directories
+    that symlinked files point into. Creating, removing or renaming a file
+    in any of them changes its mtime, so a cached result is still valid
+    while the mtimes are unchanged, which costs a few stats instead of one
+    per required file. The cache is persisted to `path` by `save`, if
+    given.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = None
+        self._dirty = False
+
+    def _load(self):
+        """Called with the lock held."""
+        if self._entries is None:
+            self._entries = {}
+            if self.path is not None:
+                try:
+                    with open(self.path, 'r') as f:
+                        self._entries = json.load(f)
+                except (IOError, OSError, ValueError):
+                    pass
+        return self._entries
+
+    def _key(self, installation):
+        # Installation types differ in the files they require.
+        return '{0}:{1}'.format(
+            type(installation).__name__,
+            os.path.normcase(os.path.abspath(installation.steam_dir)))
+
+    def get(self, installation):
+        """Returns the `InstallationStatus` of `installation`, computing it
+        only if the cached result is stale."""
+        key = self._key(installation)
+        with self._lock:
+            entry = self._load().get(key)
+        if entry is not None and all(_mtime(path) == mtime
+                                     for path, mtime in entry['validators']):
+            has_steam_exe, missing, dangling = entry['status']
+            return InstallationStatus(has_steam_exe, tuple(missing),
+                                      tuple(dangling))
+
+        # Take the mtimes before looking at the files, so that a concurrent
+        # change invalidates the entry.
+        dirs = [installation.steam_dir, installation.steamapps_dir]
+        validators = [[path, _mtime(path)] for path in dirs]
+        status, target_dirs = installation.compute_status()
+        validators.extend([path, _mtime(path)]
+                          for path in sorted(set(target_dirs) - set(dirs)))
+        with self._lock:
+            self._load()[key] = {'status': list(status),
+                                 'validators': validators}
+            self._dirty = True
+        return status
+
+    def invalidate(self, installation=None):
+        with self._lock:
+            if installation is None:
+                self._entries = {}
+            else:
+                self._load().pop(self._key(installation), None)
+            self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if self.path is None or not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(temp_path, self.path)
+            self._dirty = False
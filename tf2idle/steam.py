@@ -2,7 +2,7 @@ import collections
 import fnmatch
 import functools
 import os
-import re
+import queue
 import shutil
 import subprocess
 import tempfile
@@ -10,7 +10,15 @@ import time
 
 import psutil
 
-from tf2idle.util import get_process_windows, tail
+from tf2idle.console import (ConsoleLogParser, Connected, FatalError,
+                             ServerInfo)
+from tf2idle.fsops import FsCounter, copy_tree, iter_files, remove_tree
+from tf2idle.logwatch import LogWatcher
+from tf2idle.processes import ProcessIndex
+from tf2idle.registry import RegistryMarker, Tf2RegistryProfile
+from tf2idle.statuscache import InstallationStatus
+from tf2idle.util import StateMachine
+from tf2idle.winevents import WindowMonitor
 
 
 SteamAccount = collections.namedtuple('SteamAccount', 'username password')
@@ -21,6 +29,7 @@ class LoginResult(object):
     LOGIN_FAILED = 0x2
     LOGIN_CANCELED = 0x3
     ACCOUNT_SUSPENDED = 0x4
+    TIMEOUT = 0x5
 
 
 class Tf2LaunchResult(object):
@@ -30,12 +39,38 @@ class Tf2LaunchResult(object):
     LAUNCH_CANCELED = 0x4
     UNKNOWN_VIDEO_CARD = 0x5
     FATAL_ERROR = 0x6
+    TIMEOUT = 0x7
 
 
 class SteamClient(object):
-    def __init__(self, tf2_installation, shell_executer):
+    # Steam has these windows while it is logged in.
+    LOGGED_IN_WINDOWS = ('Steam', 'Friends', 'Servers')
+
+    def __init__(self, tf2_installation, shell_executer, process_index=None,
+                 window_monitor=None, log_watcher=None, trash=None,
+                 tf2_template=None, registry_profile=None, placement=None,
+                 state_store=None, metrics=None):
         self.tf2_installation = tf2_installation
         self.shell_executer = shell_executer
+        self.process_index = process_index or ProcessIndex()
+        self.window_monitor = window_monitor or WindowMonitor()
+        self.log_watcher = log_watcher or LogWatcher()
+        # A `TrashQueue` that deletes TF2 directories in the background.
+        self.trash = trash
+        # A `Tf2Template` that game directories are materialized from.
+        self.tf2_template = tf2_template
+        self.registry_profile = registry_profile or Tf2RegistryProfile(
+            os.path.join(tempfile.gettempdir(), 'tf2idle'))
+        # A `CpuPlacement` that pins Steam and TF2 to cores.
+        self.placement = placement
+        # A `FleetStateStore` remembering the Steam and TF2 processes, so
+        # that they are found without scanning the process table.
+        self.state_store = state_store
+        # A `PhaseMetrics` that times the phases of logins and launches.
+        self.metrics = metrics
+        self.registry_marker = RegistryMarker(os.path.join(
+            tf2_installation.steam_dir, 'tf2idle_registry.json'))
+        self.console_parser = ConsoleLogParser()
 
     def _run_steam_command(self, *args):
         command = '"{steam_exe}" -silent {args}'.format(
@@ -43,94 +78,68 @@ class SteamClient(object):
             args=' '.join(args))
         self.shell_executer(command)
 
+    def _place(self, process, kind):
+        """Lowers the priority of `process`, of `kind` 'steam' or 'hl2',
+        and pins it to a core if there is a `placement`."""
+        if self.placement is not None:
+            self.placement.add(process, kind)
+        else:
+            process.nice(psutil.BELOW_NORMAL_PRIORITY_CLASS)
+
+    def _get_windows(self, pid):
+        """Returns a dict of the top-level windows owned by `pid`, keyed by
+        window title."""
+        return {window.title: window
+                for window in self.window_monitor.get_process_windows(pid)}
+
+    def is_logged_in(self, steam_process):
+        """Returns True if `steam_process` shows the windows of a logged in
+        Steam client."""
+        windows = self._get_windows(steam_process.pid)
+        return all(title in windows for title in self.LOGGED_IN_WINDOWS)
+
+    def is_responding(self, process):
+        """Returns False if any window of `process` is not responding."""
+        return not any(window.is_hung() for window in
+                       self.window_monitor.get_process_windows(process.pid))
+
+    def tf2_dir(self, username):
+        return os.path.join(self.tf2_installation.steam_dir, 'steamapps',
+                            username, 'team fortress 2')
+
+    def console_log_path(self, username):
+        """The console.log that TF2 writes with -condebug."""
+        return os.path.join(self.tf2_dir(username), 'tf', 'console.log')
+
+    def _get_process(self, kind, lookup, default):
+        """Returns the process of `kind` recorded in `state_store` if it is
+        still running, or else looks it up with `lookup` and records it."""
+        steam_dir = self.tf2_installation.steam_dir
+        if self.state_store is None:
+            return lookup(steam_dir, default)
+        process = self.state_store.process(steam_dir, kind)
+        if process is None:
+            process = lookup(steam_dir, None)
+            self.state_store.record_process(steam_dir, kind, process)
+        return default if process is None else process
+
     def get_steam_process(self, default=None):
-        for process in psutil.process_iter():
-            if (process.name == 'steam.exe' and
-                    process.getcwd() == self.tf2_installation.steam_dir):
-                return process
-        return default
+        return self._get_process('steam', self.process_index.get_steam_process,
+                                 default)
 
     def get_hl2_process(self, default=None):
-        steam_process = self.get_steam_process()
-        if steam_process is not None:
-            for child_process in steam_process.get_children():
-                if child_process.name == 'hl2.exe':
-                    return child_process
-        return None
-
-    def login(self, username, password=None):
-        def wait_for_steam_process(timeout=10, poll_interval=1):
-            endtime = time.time() + timeout
-            while True:
-                steam_process = self.get_steam_process()
-                if steam_process is not None:
-                    break
-
-                if time.time() > endtime:
-                    raise Exception('Could not launch steam.exe.')
-                time.sleep(poll_interval)
-            return steam_process
+        return self._get_process('hl2', self.process_index.get_hl2_process,
+                                 default)
 
-        steam_process = self.get_steam_process()
-
-        if steam_process is None:
-            login_command = '-login "{}" "{}"'.format(username, password)
-            self._run_steam_command(login_command)
-            steam_process = wait_for_steam_process()
+    def login(self, username, password=None, timeouts=None,
+              cancel_token=None):
+        """Logs in to Steam. Returns a `LoginResult`.
 
-        try:
-            steam_process.nice = psutil.BELOW_NORMAL_PRIORITY_CLASS
-            # set affinity too?
-
-            is_update = steam_guard_required = False
-
-            # Consider the login to be successful if the following Steam
-            # windows exist: 'Steam', 'Friends', 'Servers'.
-            while True:
-                windows = {window.title: window for window in
-                           get_process_windows(steam_process.pid)}
-
-                if any(title.startswith('Steam - Updating')
-                       for title in windows) and not is_update:
-                    print('Steam update detected.')
-                    is_update = True
-
-                # If there are no Steam windows and an update was detected,
-                # assume the Steam client has been updated and restarted.
-                if not windows and is_update:
-                    print('Waiting for Steam to restart after update...')
-                    steam_process = wait_for_steam_process(timeout=30)
-
-                error = None
-                if any(title in windows for title in ('Steam - Error',
-                                                      'Steam - Warning')):
-                    print('Login failed.')
-                    error = LoginResult.LOGIN_FAILED
-
-                if 'Steam - Contact us' in windows:
-                    print('Steam account suspended!')
-                    error = LoginResult.ACCOUNT_SUSPENDED
-
-                if ('Steam Guard - Computer Authorization Required' in windows
-                        and not steam_guard_required):
-                    print('Steam Guard Authorization required.')
-                    steam_guard_required = True
-
-                if error:
-                    steam_process.terminate()
-                    return error
-
-                if all(title in windows
-                       for title in ('Steam', 'Friends', 'Servers')):
-                    print('Login succeeded.')
-                    return LoginResult.LOGIN_SUCCEEDED
-
-                if not steam_process.is_running():
-                    return LoginResult.LOGIN_CANCELED
-
-                time.sleep(1)
-        except psutil.NoSuchProcess:
-            return LoginResult.LOGIN_CANCELED
+        `timeouts` overrides `LoginStateMachine.PHASE_TIMEOUTS`; the login
+        returns `LoginResult.TIMEOUT` when a phase takes longer.
+        """
+        return LoginStateMachine(self, username, password, timeouts,
+                                 cancel_token).run()
 
     def logout(self):
         steam_process = self.get_steam_process()
@@ -145,185 +154,472 @@ class SteamClient(object):
 
         return True
 
-    def _apply_tf2_registry_settings(self):
-        # apply registry settings to minimize resource consumption
-        tf2idle_reg = '''\
-        REGEDIT4
-
-        [HKEY_CURRENT_USER\\Software\\Valve\\Source\\tf\\Settings]
-        "AutoConfigVersion"="dword:00000001"
-        "DXLevel_V1"="dword:00000051"
-        "mat_aaquality"="dword:00000000"
-        "mat_antialias"="dword:00000000"
-        "mat_bumpmap"="dword:00000000"
-        "mat_colorcorrection"="dword:00000000"
-        "mat_forceaniso"="dword:00000000"
-        "mat_forcehardwaresync"="dword:00000000"
-        "mat_hdr_level"="dword:00000000"
-        "mat_parallaxmap"="dword:00000000"
-        "mat_picmip"="dword:00000002"
-        "mat_reducefillrate"="dword:00000001"
-        "mat_specular"="dword:00000000"
-        "mat_trilinear"="dword:00000000"
-        "mat_vsync"="dword:00000000"
-        "MotionBlur"="dword:00000000"
-        "r_rootlod"="dword:00000002"
-        "r_shadowrendertotexture"="dword:00000000"
-        "r_waterforceexpensive"="dword:00000000"
-        "r_waterforcereflectentities"="dword:00000000"
-        "ScreenHeight"="dword:00000258"
-        "ScreenMonitorGamma"="2.2""
-        "ScreenMSAA"="dword:00000000"
-        "ScreenMSAAQuality"="dword:00000000"
-        "ScreenWidth"="dword:00000320"
-        "ScreenWindowed"="dword:00000001"
-        "ShadowDepthTexture"="dword:00000000"
-        "User Token 2"=""
-        "User Token 3"=""'''
-        with tempfile.NamedTemporaryFile('wt', suffix='.reg',
-                                         delete=False) as temp:
-            temp.write(tf2idle_reg)
-            temp.close()
-            self.shell_executer(' '.join(['regedit', '/s', temp.name]))
-            try:
-                os.unlink(temp.name)
-            except OSError:
-                pass
+    def _apply_tf2_registry_settings(self, steam_process):
+        """Applies the registry settings of `registry_profile`, which
+        minimize TF2's resource consumption, unless they are already
+        applied in this sandbox. Returns True if regedit imported them.
+
+        The sandbox is only marked as applied once regedit has exited
+        successfully, so that a failed import is retried on the next
+        launch."""
+        if self.registry_marker.is_current(self.registry_profile.digest,
+                                           steam_process):
+            return False
+        reg_path = self.registry_profile.write()
+        try:
+            self.shell_executer('regedit /s "{0}"'.format(reg_path),
+                                wait=True)
+        except (subprocess.CalledProcessError, OSError) as e:
+            print('Could not apply TF2 registry settings:', e)
+            return False
+        self.registry_marker.update(self.registry_profile.digest,
+                                    steam_process)
+        return True
 
-    def launch_tf2(self, username, launch_options, autoexec_cfg=None):
-        steam_process = self.get_steam_process()
-        if steam_process is None:
-            print('Not logged in.')
-            return Tf2LaunchResult.NOT_LOGGED_IN
+    def launch_tf2(self, username, launch_options, autoexec_cfg=None,
+                   timeouts=None, cancel_token=None):
+        """Launches TF2 and waits until it has connected to its server.
 
-        tf2_dir = os.path.join(self.tf2_installation.steam_dir,
-                               'steamapps', username, 'team fortress 2')
-        tf2_console_log = os.path.join(tf2_dir, 'tf', 'console.log')
+        Returns a (`Tf2LaunchResult.LAUNCH_SUCCEEDED`, ip, server_port,
+        client_port) tuple on success, or another `Tf2LaunchResult`.
+        `timeouts` overrides `Tf2LaunchStateMachine.PHASE_TIMEOUTS`; the
+        launch returns `Tf2LaunchResult.TIMEOUT` when a phase takes longer.
+        """
+        return Tf2LaunchStateMachine(self, username, launch_options,
+                                     autoexec_cfg, timeouts,
+                                     cancel_token).run()
 
+    def close_tf2(self, username):
         hl2_process = self.get_hl2_process()
-        if hl2_process is None:
-            self._apply_tf2_registry_settings()
+        try:
+            if hl2_process is not None:
+                hl2_process.terminate()
+                # The directory cannot be moved while files are open.
+                hl2_process.wait(10)
+        except (psutil.NoSuchProcess, psutil.TimeoutExpired):
+            pass
+
+        # A directory materialized from a template takes little space of
+        # its own, and is kept so that relaunching is fast.
+        if self.tf2_template is not None:
+            return True
+
+        # Free up ~800MB of disk space by removing the tf2 directory. With a
+        # trash queue it is only moved aside here and deleted later.
+        tf2_dir = self.tf2_dir(username)
+        try:
+            if self.trash is not None:
+                self.trash.trash(tf2_dir)
+            else:
+                shutil.rmtree(tf2_dir)
+        except OSError as e:
+            print('Could not remove', tf2_dir, e)
 
-            if autoexec_cfg is not None and os.path.exists(autoexec_cfg):
-                cfg_dir = os.path.join(tf2_dir, 'tf', 'cfg')
+        return True
+
+
+class SteamClientStateMachine(StateMachine):
+    """A `StateMachine` that drives a `SteamClient`. It waits on window
+    events for the process it is watching, so that it wakes up as soon as
+    something changes; the backoff only bounds how long a missed event can
+    go unnoticed.
+
+    The time spent in each state is observed by the client's `metrics` as
+    the phase in `PHASES`, if any, with the outcome of the machine for the
+    last phase.
+    """
+    PHASES = {}
+    SUCCEEDED = None
+
+    def __init__(self, steam_client, username, timeouts=None,
+                 cancel_token=None):
+        self.client = steam_client
+        self.username = username
+        self.events = None
+        self.phase = None
+        self.phase_started = None
+        super(SteamClientStateMachine, self).__init__(timeouts, cancel_token)
+        self.cancel_token.add_callback(self.wake)
+
+    def observe(self, phase, seconds, outcome='ok'):
+        if self.client.metrics is not None:
+            self.client.metrics.observe(phase, seconds, outcome,
+                                        self.username)
+
+    def begin_phase(self, phase, outcome='ok'):
+        """Ends the current phase with `outcome` and starts `phase`, which
+        may be None."""
+        now = time.time()
+        if self.phase is not None:
+            self.observe(self.phase, now - self.phase_started, outcome)
+        self.phase = phase
+        self.phase_started = now
+
+    def enter(self, state):
+        super(SteamClientStateMachine, self).enter(state)
+        phase = self.PHASES.get(state)
+        if phase != self.phase:
+            self.begin_phase(phase)
+
+    def _outcome(self, result):
+        if result == self.TIMEOUT:
+            return 'timeout'
+        if result == self.CANCELED:
+            return 'canceled'
+        if isinstance(result, tuple):
+            result = result[0]
+        return 'ok' if result == self.SUCCEEDED else 'failed'
+
+    def finish(self, result):
+        self.begin_phase(None, self._outcome(result))
+        super(SteamClientStateMachine, self).finish(result)
+
+    def wake(self):
+        events = self.events
+        if events is not None:
+            events.wake()
+
+    def subscribe(self, pid=None):
+        """Waits on window events of `pid` (or of every window, if `pid` is
+        None) between steps."""
+        if self.events is not None:
+            self.events.close()
+        self.events = self.client.window_monitor.subscribe(pid)
+
+    def wait(self):
+        if self.events is None:
+            return super(SteamClientStateMachine, self).wait()
+        if self.events.wait(timeout=self.wait_interval()):
+            self.backoff.reset()
+
+    def cleanup(self):
+        self.cancel_token.remove_callback(self.wake)
+        if self.events is not None:
+            self.events.close()
+            self.events = None
+
+    def on_timeout(self):
+        print('Timed out in state:', self.state)
+
+
+class LoginStateMachine(SteamClientStateMachine):
+    """Logs in to Steam.
+
+    start -> steam_process -> login [-> updating -> restart -> login]
+    """
+    PHASE_TIMEOUTS = {
+        'steam_process': 10,
+        'login': 120,
+        'updating': 600,
+        'restart': 30,
+    }
+    PHASES = {
+        'steam_process': 'steam_spawn',
+        'login': 'login_windows',
+        'updating': 'steam_update',
+        'restart': 'steam_update',
+    }
+    TIMEOUT = LoginResult.TIMEOUT
+    CANCELED = LoginResult.LOGIN_CANCELED
+    SUCCEEDED = LoginResult.LOGIN_SUCCEEDED
+
+    def __init__(self, steam_client, username, password=None, timeouts=None,
+                 cancel_token=None):
+        super(LoginStateMachine, self).__init__(steam_client, username,
+                                                timeouts, cancel_token)
+        self.password = password
+        self.steam_process = None
+        self.steam_guard_required = False
+
+    def _adopt(self, steam_process):
+        try:
+            self.client._place(steam_process, 'steam')
+        except psutil.NoSuchProcess:
+            self.finish(LoginResult.LOGIN_CANCELED)
+            return
+        self.steam_process = steam_process
+        self.subscribe(steam_process.pid)
+        self.enter('login')
+
+    def step_start(self):
+        steam_process = self.client.get_steam_process()
+        if steam_process is None:
+            login_command = '-login "{}" "{}"'.format(self.username,
+                                                      self.password)
+            self.client._run_steam_command(login_command)
+            self.enter('steam_process')
+        else:
+            self._adopt(steam_process)
+
+    def step_steam_process(self):
+        steam_process = self.client.get_steam_process()
+        if steam_process is not None:
+            self._adopt(steam_process)
+
+    def step_restart(self):
+        # Wait for a new steam.exe, or for the old one to show its windows
+        # again.
+        steam_process = self.client.get_steam_process()
+        if steam_process is not None and (
+                steam_process.pid != self.steam_process.pid or
+                self.client._get_windows(steam_process.pid)):
+            self._adopt(steam_process)
+
+    def step_login(self):
+        try:
+            self._check_login_windows()
+        except psutil.NoSuchProcess:
+            self.finish(LoginResult.LOGIN_CANCELED)
+
+    step_updating = step_login
+
+    def _check_login_windows(self):
+        windows = self.client._get_windows(self.steam_process.pid)
+
+        if self.state == 'login' and any(title.startswith('Steam - Updating')
+                                         for title in windows):
+            print('Steam update detected.')
+            self.enter('updating')
+            return
+
+        # If there are no Steam windows and an update was detected,
+        # assume the Steam client has been updated and restarted.
+        if self.state == 'updating' and not windows:
+            print('Waiting for Steam to restart after update...')
+            self.subscribe()
+            self.enter('restart')
+            return
+
+        error = None
+        if any(title in windows for title in ('Steam - Error',
+                                              'Steam - Warning')):
+            print('Login failed.')
+            error = LoginResult.LOGIN_FAILED
+
+        if 'Steam - Contact us' in windows:
+            print('Steam account suspended!')
+            error = LoginResult.ACCOUNT_SUSPENDED
+
+        if ('Steam Guard - Computer Authorization Required' in windows and
+                not self.steam_guard_required):
+            print('Steam Guard Authorization required.')
+            self.steam_guard_required = True
+
+        if error:
+            self.steam_process.terminate()
+            self.finish(error)
+            return
+
+        # Consider the login to be successful if the Steam windows in
+        # `SteamClient.LOGGED_IN_WINDOWS` exist.
+        if all(title in windows
+               for title in self.client.LOGGED_IN_WINDOWS):
+            print('Login succeeded.')
+            self.finish(LoginResult.LOGIN_SUCCEEDED)
+            return
+
+        if not self.steam_process.is_running():
+            self.finish(LoginResult.LOGIN_CANCELED)
+
+
+class Tf2LaunchStateMachine(SteamClientStateMachine):
+    """Launches TF2 and waits until it has connected to its server.
+
+    start -> hl2_process -> connection
+    """
+    PHASE_TIMEOUTS = {
+        # Includes updating TF2.
+        'hl2_process': 600,
+        'connection': 300,
+    }
+    PHASES = {
+        'hl2_process': 'hl2_spawn',
+        # Until the server IP is logged; then 'connected' until TF2 has
+        # connected.
+        'connection': 'ip_line',
+    }
+    TIMEOUT = Tf2LaunchResult.TIMEOUT
+    CANCELED = Tf2LaunchResult.LAUNCH_CANCELED
+    SUCCEEDED = Tf2LaunchResult.LAUNCH_SUCCEEDED
+
+    def __init__(self, steam_client, username, launch_options,
+                 autoexec_cfg=None, timeouts=None, cancel_token=None):
+        super(Tf2LaunchStateMachine, self).__init__(
+            steam_client, username, timeouts, cancel_token)
+        self.launch_options = launch_options
+        self.autoexec_cfg = autoexec_cfg
+        self.tf2_dir = steam_client.tf2_dir(username)
+        self.console_log = steam_client.console_log_path(username)
+        self.steam_process = self.hl2_process = None
+        self.lines = queue.Queue()
+        self.followed_log = None
+        self.server_info = None
+        self.notices = set()
+
+    def _notice(self, message):
+        if message not in self.notices:
+            self.notices.add(message)
+            print(message)
+
+    def _on_console_line(self, line):
+        self.lines.put(line)
+        self.wake()
+
+    def step_start(self):
+        self.steam_process = self.client.get_steam_process()
+        if self.steam_process is None:
+            print('Not logged in.')
+            self.finish(Tf2LaunchResult.NOT_LOGGED_IN)
+            return
+
+        if self.client.get_hl2_process() is None:
+            started = time.time()
+            try:
+                applied = self.client._apply_tf2_registry_settings(
+                    self.steam_process)
+            except psutil.NoSuchProcess:
+                self.finish(Tf2LaunchResult.NOT_LOGGED_IN)
+                return
+            if applied:
+                self.observe('registry_apply', time.time() - started)
+
+            if self.client.tf2_template is not None:
+                stats = self.client.tf2_template.materialize(self.tf2_dir)
+                print('Materialized {} TF2 files ({:.1f} MB) in '
+                      '{:.1f}s'.format(stats.files,
+                                       stats.bytes / (1024 * 1024),
+                                       stats.seconds))
+
+            if (self.autoexec_cfg is not None and
+                    os.path.exists(self.autoexec_cfg)):
+                cfg_dir = os.path.join(self.tf2_dir, 'tf', 'cfg')
                 try:
                     os.makedirs(cfg_dir)
                 except OSError:
                     pass
-                shutil.copy(autoexec_cfg, os.path.join(cfg_dir,
-                                                       'autoexec.cfg'))
+                shutil.copy(self.autoexec_cfg, os.path.join(cfg_dir,
+                                                            'autoexec.cfg'))
 
             # TF2 console output will be logged to
             # steam_dir/steamapps/username/team fortress 2/tf2/console.log
+            launch_options = list(self.launch_options)
             if '-condebug' not in launch_options:
                 launch_options.append('-condebug')
 
             # Remove a pre-existing console.log
             try:
-                os.unlink(tf2_console_log)
+                os.unlink(self.console_log)
             except OSError:
                 pass
 
-            self._run_steam_command('-applaunch 440', *launch_options)
-
-        # Wait for hl2.exe to launch.
-        while True:
-            try:
-                windows = {window.title: window for window in
-                           get_process_windows(steam_process.pid)}
-
-                if 'Unknown Video Card' in windows:
-                    print('Unknown video card')
-                    windows['Unknown Video Card'].close()
-                    return Tf2LaunchResult.UNKNOWN_VIDEO_CARD
-
-                for title in ['Steam - Error', 'Steam - Warning',
-                              'Ready - Team Fortress 2']:
-                    if title in windows:
-                        windows[title].close()
-                        print('Launch error:', title)
-                        return Tf2LaunchResult.LAUNCH_FAILED
+            self.client._run_steam_command('-applaunch 440', *launch_options)
 
-                if 'Team Fortress 2 - Steam' in windows:
-                    print('Preparing to launch TF2...')
+        # The pid of hl2.exe is not known yet, so wake up on any window
+        # event.
+        self.subscribe()
+        self.enter('hl2_process')
 
-                if 'Updatng Team Fortress 2' in windows:
-                    print('Updating TF2...')
-
-                hl2_process = self.get_hl2_process()
-                if hl2_process is not None:
-                    break
-
-                time.sleep(5)
-            except psutil.NoSuchProcess:
-                return Tf2LaunchResult.NOT_LOGGED_IN
-
-        print('hl2.exe launched')
+    def step_hl2_process(self):
         try:
-            hl2_process.nice = psutil.BELOW_NORMAL_PRIORITY_CLASS
-            # set affinity too?
+            windows = self.client._get_windows(self.steam_process.pid)
+
+            if 'Unknown Video Card' in windows:
+                print('Unknown video card')
+                windows['Unknown Video Card'].close()
+                self.finish(Tf2LaunchResult.UNKNOWN_VIDEO_CARD)
+                return
+
+            for title in ['Steam - Error', 'Steam - Warning',
+                          'Ready - Team Fortress 2']:
+                if title in windows:
+                    windows[title].close()
+                    print('Launch error:', title)
+                    self.finish(Tf2LaunchResult.LAUNCH_FAILED)
+                    return
+
+            if 'Team Fortress 2 - Steam' in windows:
+                self._notice('Preparing to launch TF2...')
+
+            if 'Updatng Team Fortress 2' in windows:
+                self._notice('Updating TF2...')
+
+            if not self.steam_process.is_running():
+                self.finish(Tf2LaunchResult.NOT_LOGGED_IN)
+                return
         except psutil.NoSuchProcess:
-            return Tf2LaunchResult.LAUNCH_CANCELED
-
-        # Tail the console.log to obtain the server IP, server port, and client
-        # port. Stop when a "connected" string is found.
-        ip = server_port = client_port = None
-        connected = False
-        while not connected:
-            try:
-                windows = {window.title: window for window in
-                           get_process_windows(hl2_process.pid)}
-                if any(title in windows for title in
-                       ['Error!', 'ERROR',
-                        'Microsoft Visual C++ Runtime Library']):
-                    print('Fatal error')
-                    return Tf2LaunchResult.FATAL_ERROR
-
-                with open(tf2_console_log) as console_log:
-                    for line in tail(console_log, start=os.SEEK_CUR):
-                        if ip is None:
-                            regex = ('IP ([0-9.]+|unknown), .+, '
-                                     'ports (\d+) SV / (\d+) CL')
-                            match = re.search(regex, line)
-                            if match:
-                                ip, server_port, client_port = match.groups()
-                        elif 'connected' in line:
-                            connected = True
-                            break
-            except IOError:
-                pass
-            except psutil.NoSuchProcess:
-                return Tf2LaunchResult.LAUNCH_CANCELED
-            time.sleep(1)
+            self.finish(Tf2LaunchResult.NOT_LOGGED_IN)
+            return
 
-        if ip == 'unknown':
-            ip = None
-        print('Tf2 launch succeeded:', ip, server_port, client_port)
-        return Tf2LaunchResult.LAUNCH_SUCCEEDED, ip, server_port, client_port
+        hl2_process = self.client.get_hl2_process()
+        if hl2_process is None:
+            return
 
-    def close_tf2(self):
-        hl2_process = self.get_hl2_process()
+        print('hl2.exe launched')
         try:
-            if hl2_process is not None:
-                hl2_process.terminate()
+            self.client._place(hl2_process, 'hl2')
         except psutil.NoSuchProcess:
-            pass
+            self.finish(Tf2LaunchResult.LAUNCH_CANCELED)
+            return
 
-        # Free up ~800MB of disk space by removing the tf2 directory.
-        tf2_dir = os.path.join(self.tf2_installation.steam_dir, 'steamapps',
-                               username, 'team fortress 2')
-        try:
-            shutil.rmtree(tf2_dir)
-        except OSError:
-            pass
+        self.hl2_process = hl2_process
+        self.subscribe(hl2_process.pid)
+        self.followed_log = self.client.log_watcher.follow(
+            self.console_log, self._on_console_line)
+        self.enter('connection')
+
+    def step_connection(self):
+        """Follows the console.log to obtain the server IP, server port, and
+        client port. Finishes when a "connected" string is found."""
+        windows = self.client._get_windows(self.hl2_process.pid)
+        if any(title in windows for title in
+               ['Error!', 'ERROR', 'Microsoft Visual C++ Runtime Library']):
+            print('Fatal error')
+            self.finish(Tf2LaunchResult.FATAL_ERROR)
+            return
 
-        return True
+        while True:
+            try:
+                line = self.lines.get_nowait()
+            except queue.Empty:
+                break
+
+            event = self.client.console_parser.parse_line(line)
+            if isinstance(event, ServerInfo) and self.server_info is None:
+                self.server_info = event
+                self.begin_phase('connected')
+            elif isinstance(event, Connected) and self.server_info:
+                ip, server_port, client_port = self.server_info
+                if ip == 'unknown':
+                    ip = None
+                print('Tf2 launch succeeded:', ip, server_port, client_port)
+                self.finish((Tf2LaunchResult.LAUNCH_SUCCEEDED, ip,
+                             server_port, client_port))
+                return
+            elif isinstance(event, FatalError):
+                print('Fatal error:', event.message)
+                self.finish(Tf2LaunchResult.FATAL_ERROR)
+                return
+
+        if not self.hl2_process.is_running():
+            self.finish(Tf2LaunchResult.LAUNCH_CANCELED)
+
+    def cleanup(self):
+        if self.followed_log is not None:
+            self.client.log_watcher.unfollow(self.followed_log)
+            self.followed_log = None
+        super(Tf2LaunchStateMachine, self).cleanup()
 
 
 class LinkedInstallationError(Exception):
     pass
 
 
+def _fnmatch_any(name, patterns):
+    """Returns True if `name` string matches any pattern string in the
+    list of `patterns`."""
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
 class LinkRules(object):
     def __init__(self, symlinks=set(), copy_dirs=set(), copy_files=set()):
         self.symlinks = set(symlinks)
@@ -332,13 +628,47 @@ class LinkRules(object):
 
 
 class SteamInstallation(object):
-    def __init__(self, steam_dir):
+    REQUIRED_GCFS = ()
+
+    def __init__(self, steam_dir, status_cache=None):
         self.steam_dir = steam_dir
         self.steamapps_dir = os.path.join(steam_dir, 'steamapps')
         self.steam_exe_path = os.path.join(steam_dir, 'steam.exe')
+        self.status_cache = status_cache
+
+    def compute_status(self):
+        """Returns an (`InstallationStatus`, directories) tuple, where
+        directories are the directories that symlinked GCFs point into."""
+        missing = []
+        dangling = []
+        target_dirs = set()
+        for gcf in self.REQUIRED_GCFS:
+            gcf_path = os.path.join(self.steamapps_dir, gcf)
+            if os.path.islink(gcf_path):
+                target = os.path.join(self.steamapps_dir,
+                                      os.readlink(gcf_path))
+                target_dirs.add(os.path.dirname(os.path.normpath(target)))
+                if not os.path.exists(gcf_path):
+                    dangling.append(gcf)
+            elif not os.path.exists(gcf_path):
+                missing.append(gcf)
+        status = InstallationStatus(os.path.exists(self.steam_exe_path),
+                                    tuple(missing), tuple(dangling))
+        return status, sorted(target_dirs)
+
+    def status(self):
+        """Returns an `InstallationStatus`, from `status_cache` if it is
+        still valid."""
+        if self.status_cache is not None:
+            return self.status_cache.get(self)
+        return self.compute_status()[0]
 
     def installed(self):
-        return os.path.exists(self.steam_exe_path)
+        return self.status().installed
+
+    def invalidate_status(self):
+        if self.status_cache is not None:
+            self.status_cache.invalidate(self)
 
 
 class Tf2Installation(SteamInstallation):
@@ -354,13 +684,6 @@ class Tf2Installation(SteamInstallation):
                      'team fortress 2 content.gcf',
                      'team fortress 2 materials.gcf')
 
-    def installed(self):
-        for gcf in self.REQUIRED_GCFS:
-            gcf_path = os.path.join(self.steamapps_dir, gcf)
-            if not os.path.exists(gcf_path):
-                return False
-        return super(Tf2Installation, self).installed()
-
 
 class IdlerTf2Installation(Tf2Installation):
     def __init__(self, steam_dir, username):
@@ -374,19 +697,34 @@ class LinkedSteamInstallation(SteamInstallation):
     STEAM_DIR_LINK_RULES = LinkRules(copy_dirs={'bin'},
                                      copy_files={'*.dll', '*.exe'})
     STEAMAPPS_DIR_LINK_RULES = LinkRules(symlinks={'*.gcf'})
+    MANIFEST_NAME = 'tf2idle_manifest.json'
+
+    def __init__(self, steam_dir, content_store=None, status_cache=None):
+        super(LinkedSteamInstallation, self).__init__(steam_dir,
+                                                      status_cache)
+        self.content_store = content_store
+        self.manifest_path = os.path.join(steam_dir, self.MANIFEST_NAME)
 
     def link(self, other_installation, remove_existing=False,
              steam_dir_link_rules=STEAM_DIR_LINK_RULES,
              steamapps_dir_link_rules=STEAMAPPS_DIR_LINK_RULES):
-        """Links this installation to `other_installation`.
+        """Links this installation to `other_installation`. Returns an
+        `FsStats` of the files written.
 
         If `remove_existing` is True, the currently linked installation will
         be removed before linking.
 
+        With a `content_store`, an installation that is already linked is
+        brought up to date incrementally instead of being left alone: only
+        files that changed since the last link are replaced (see `_sync`).
+
         Raises ``LinkedInstallationError`` if there is a problem linking.
         """
-        if self.installed() and not remove_existing:
-            return
+        counter = FsCounter()
+        incremental = self.content_store is not None
+        if (self.installed() and not remove_existing and
+                not (incremental and other_installation.installed())):
+            return counter.stats()
 
         if not other_installation.installed():
             error = 'Steam is not installed at {0}'.format(
@@ -394,14 +732,20 @@ class LinkedSteamInstallation(SteamInstallation):
             raise LinkedInstallationError(error)
 
         try:
-            self.unlink()
+            if remove_existing or not incremental:
+                self.unlink()
 
-            self._link_dir(other_installation.steam_dir, self.steam_dir,
-                           steam_dir_link_rules)
+            if incremental:
+                self._sync(other_installation, steam_dir_link_rules,
+                           steamapps_dir_link_rules, counter)
+            else:
+                self._link_dir(other_installation.steam_dir, self.steam_dir,
+                               steam_dir_link_rules, counter)
 
-            self._link_dir(other_installation.steamapps_dir,
-                           self.steamapps_dir,
-                           steamapps_dir_link_rules)
+                self._link_dir(other_installation.steamapps_dir,
+                               self.steamapps_dir,
+                               steamapps_dir_link_rules, counter)
+            self.invalidate_status()
         except LinkedInstallationError as e:
             error = 'Could not unlink existing installation.'
             raise LinkedInstallationError(error) from e
@@ -413,48 +757,85 @@ class LinkedSteamInstallation(SteamInstallation):
             else:
                 error = 'Could not link installation.'
                 raise LinkedInstallationError(error) from e
+        return counter.stats()
 
     def unlink(self):
-        """Unlinks this installation."""
+        """Unlinks this installation. Returns an `FsStats` of the files
+        removed."""
+        counter = FsCounter()
         try:
             # order is important
-            self._unlink_dir(self.steamapps_dir)
-            self._unlink_dir(self.steam_dir)
+            self._unlink_dir(self.steamapps_dir, counter)
+            self._unlink_dir(self.steam_dir, counter)
         except Exception as e:
             error = 'Could not unlink installation.'
             raise LinkedInstallationError(error) from e
-
-    def _link_dir(self, source_dir, dest_dir, rules):
+        finally:
+            self.invalidate_status()
+        return counter.stats()
+
+    def _plan(self, source_dir, dest_dir, rules):
+        """Returns a list of (source path, source stat, destination path,
+        kind) tuples for the files `rules` link from `source_dir`, as
+        expected by `ContentStore.sync`.
+
+        Copied files are private copies rather than hardlinks from the
+        store: the sandboxes open the drive of the base installation
+        (``OpenFilePath``), so Steam updating its binaries in one sandbox
+        writes to the real files.
+        """
+        plan = []
+        with os.scandir(source_dir) as entries:
+            for entry in entries:
+                src = os.path.normpath(entry.path)
+                dest = os.path.join(dest_dir, entry.name)
+                if _fnmatch_any(entry.name, rules.symlinks):
+                    plan.append((src, None, dest, 'symlink'))
+                elif _fnmatch_any(entry.name, rules.copy_dirs):
+                    plan.extend(
+                        (file_entry.path, file_entry.stat(),
+                         os.path.join(dest, os.path.relpath(file_entry.path,
+                                                            entry.path)),
+                         'copy')
+                        for file_entry in iter_files(entry.path))
+                elif _fnmatch_any(entry.name, rules.copy_files):
+                    plan.append((src, entry.stat(), dest, 'copy'))
+        return plan
+
+    def _sync(self, other_installation, steam_dir_link_rules,
+              steamapps_dir_link_rules, counter):
+        """Brings this installation up to date with `other_installation`
+        using the content store and a manifest in the installation."""
+        os.makedirs(self.steamapps_dir, exist_ok=True)
+        plan = (self._plan(other_installation.steam_dir, self.steam_dir,
+                           steam_dir_link_rules) +
+                self._plan(other_installation.steamapps_dir,
+                           self.steamapps_dir, steamapps_dir_link_rules))
+        self.content_store.sync(plan, self.steam_dir, self.manifest_path,
+                                counter)
+
+    def _link_dir(self, source_dir, dest_dir, rules, counter):
         """Copy or symlink files and directories from source_dir to
         dest_dir according to link `rules`."""
-        def fnmatch_any(name, patterns):
-            """Returns True if `name` string matches any pattern string in the
-            list of `patterns`."""
-            return any(fnmatch.fnmatch(entry, pattern) for pattern in patterns)
-
         os.makedirs(dest_dir)
 
-        for entry in os.listdir(source_dir):
-            src = os.path.normpath(os.path.join(source_dir, entry))
-            dest = os.path.join(dest_dir, entry)
-            if fnmatch_any(entry, rules.symlinks):
-                os.symlink(src, dest)
-            elif fnmatch_any(entry, rules.copy_dirs):
-                shutil.copytree(src, dest, symlinks=True)
-            elif fnmatch_any(entry, rules.copy_files):
-                shutil.copy2(src, dest)
-
-    def _unlink_dir(self, linked_dir):
+        with os.scandir(source_dir) as entries:
+            for entry in entries:
+                src = os.path.normpath(entry.path)
+                dest = os.path.join(dest_dir, entry.name)
+                if _fnmatch_any(entry.name, rules.symlinks):
+                    os.symlink(src, dest)
+                    counter.add()
+                elif _fnmatch_any(entry.name, rules.copy_dirs):
+                    copy_tree(src, dest, counter)
+                elif _fnmatch_any(entry.name, rules.copy_files):
+                    shutil.copy2(src, dest)
+                    counter.add(entry.stat().st_size)
+
+    def _unlink_dir(self, linked_dir, counter):
         """Remove files, directories, and symlinks from `linked_dir`."""
-        if not os.path.exists(linked_dir):
-            return
-        for entry in os.listdir(linked_dir):
-            entry_path = os.path.normpath(os.path.join(linked_dir, entry))
-            if os.path.islink(entry_path) or os.path.isfile(entry_path):
-                os.remove(entry_path)
-            elif os.path.isdir(entry_path):
-                shutil.rmtree(entry_path)
-        os.rmdir(linked_dir)
+        if os.path.isdir(linked_dir):
+            remove_tree(linked_dir, counter)
 
 
 class LinkedTf2Installation(LinkedSteamInstallation, Tf2Installation):
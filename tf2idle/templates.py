@@ -0,0 +1,110 @@
+import fnmatch
+import glob
+import os
+import threading
+
+from tf2idle.fsops import FsCounter, iter_files
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Tf2Template(object):
+    """A prepared 'team fortress 2' game directory that is materialized for
+    every account instead of being extracted by Steam on each launch.
+
+    The template is taken from `source_dir`, a game directory that Steam
+    has already extracted (usually the one in the base installation).
+    Read-only game files are hardlinked from `content_store`; files that
+    TF2 or Steam write to (`WRITABLE_PATTERNS`) are copied, and
+    `EXCLUDE_PATTERNS` are left out. Patterns match paths relative to the
+    game directory, with forward slashes. Sandboxes open the drive of the
+    base installation, so a write to a hardlinked file is not redirected
+    but changes it for every account.
+
+    Materializing is incremental, so an account whose directory is current
+    (after a crash, say) is relaunched without rebuilding it. The list of
+    template files is read again when the mtime of one of its directories
+    changes.
+    """
+    WRITABLE_PATTERNS = ('tf/cfg/*', 'tf/custom/*', 'tf/download/*',
+                         'tf/media/*', 'tf/*.cache', '*.cfg', '*.inf',
+                         '*.log', '*.txt', '*.vdf')
+    EXCLUDE_PATTERNS = ('tf/console.log', 'tf/screenshots/*',
+                        'tf/downloadlists/*')
+    MANIFEST_NAME = 'tf2idle_manifest.json'
+
+    def __init__(self, source_dir, content_store,
+                 writable_patterns=WRITABLE_PATTERNS,
+                 exclude_patterns=EXCLUDE_PATTERNS):
+        self.source_dir = source_dir
+        self.content_store = content_store
+        self.writable_patterns = writable_patterns
+        self.exclude_patterns = exclude_patterns
+        self._lock = threading.Lock()
+        self._files = None
+        # (path, mtime) of every directory of the listed files.
+        self._validators = None
+
+    @classmethod
+    def find_source_dir(cls, installation):
+        """Returns the first 'team fortress 2' game directory of the Steam
+        `installation`, or None."""
+        pattern = os.path.join(glob.escape(installation.steamapps_dir), '*',
+                               'team fortress 2')
+        for path in sorted(glob.glob(pattern)):
+            if os.path.isdir(path):
+                return path
+        return None
+
+    def _matches(self, relpath, patterns):
+        return any(fnmatch.fnmatch(relpath, pattern) for pattern in patterns)
+
+    def _current(self):
+        """Called with the lock held."""
+        return self._files is not None and all(
+            _mtime(path) == mtime for path, mtime in self._validators)
+
+    def prepare(self):
+        """Lists the template's files and adds the read-only ones to the
+        content store, unless the list is current. Called by
+        `materialize`."""
+        with self._lock:
+            if self._current():
+                return
+            dirs = {self.source_dir: _mtime(self.source_dir)}
+            files = []
+            for entry in iter_files(self.source_dir):
+                parent = os.path.dirname(entry.path)
+                if parent not in dirs:
+                    dirs[parent] = _mtime(parent)
+                relpath = os.path.relpath(entry.path, self.source_dir)
+                match_path = relpath.replace(os.sep, '/')
+                if self._matches(match_path, self.exclude_patterns):
+                    continue
+                st = entry.stat()
+                if self._matches(match_path, self.writable_patterns):
+                    files.append((entry.path, st, relpath, 'copy'))
+                else:
+                    self.content_store.add(entry.path, st)
+                    files.append((entry.path, st, relpath, 'file'))
+            self.content_store.save()
+            self._files = files
+            self._validators = sorted(dirs.items())
+
+    def materialize(self, dest_dir):
+        """Brings the game directory `dest_dir` up to date with the
+        template. Returns an `FsStats` of the files written."""
+        self.prepare()
+        counter = FsCounter()
+        os.makedirs(dest_dir, exist_ok=True)
+        plan = [(src, st, os.path.join(dest_dir, relpath), kind)
+                for src, st, relpath, kind in self._files]
+        self.content_store.sync(plan, dest_dir,
+                                os.path.join(dest_dir, self.MANIFEST_NAME),
+                                counter)
+        return counter.stats()
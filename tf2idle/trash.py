@@ -0,0 +1,191 @@
+import collections
+import os
+import threading
+import time
+import uuid
+
+from tf2idle.fsops import remove_file
+
+
+class TrashItem(object):
+    """A directory or file that has been moved into the trash."""
+
+    def __init__(self, path):
+        self.path = path
+        # Set once the reaper has measured the item.
+        self.size = None
+        self.deleted = 0
+        self.done = False
+        self.entries = None
+
+    @property
+    def pending(self):
+        return max(0, (self.size or 0) - self.deleted)
+
+
+def _iter_tree(path):
+    """Yields (path, is_dir, size) tuples for `path` and everything beneath
+    it, children before their directory. Symlinks are not followed."""
+    if not os.path.isdir(path) or os.path.islink(path):
+        yield path, False, os.lstat(path).st_size
+        return
+    with os.scandir(path) as entries:
+        entries = list(entries)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from _iter_tree(entry.path)
+        else:
+            yield (entry.path, False,
+                   0 if entry.is_symlink() else
+                   entry.stat(follow_symlinks=False).st_size)
+    yield path, True, 0
+
+
+class TrashQueue(object):
+    """Deletes directories in the background.
+
+    `trash` atomically renames a directory into `trash_dir`, which must be on
+    the same volume, and returns right away. A single reaper thread then
+    deletes the trash in batches of `batch_files` files, at no more than
+    `max_bytes_per_second`, so that deletes do not starve running idlers of
+    disk I/O. Trash left over by a previous run is picked up on start.
+    """
+
+    def __init__(self, trash_dir, max_bytes_per_second=64 * 1024 * 1024,
+                 batch_files=256):
+        self.trash_dir = trash_dir
+        self.max_bytes_per_second = max_bytes_per_second
+        self.batch_files = batch_files
+        self._lock = threading.Lock()
+        self._items = collections.deque()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopped = False
+        self._thread = None
+        self._loaded = False
+
+    def _load(self):
+        """Queues trash left over by a previous run. Called with the lock
+        held."""
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            names = sorted(os.listdir(self.trash_dir))
+        except OSError:
+            return
+        self._items.extend(TrashItem(os.path.join(self.trash_dir, name))
+                           for name in names)
+
+    def _ensure_started(self):
+        """Called with the lock held."""
+        self._load()
+        if self._thread is None and self._items:
+            self._thread = threading.Thread(target=self._run,
+                                            name='TrashQueue')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def start(self):
+        """Starts deleting trash left over by a previous run."""
+        with self._lock:
+            self._ensure_started()
+
+    def trash(self, path):
+        """Moves `path` into the trash. Returns False if `path` does not
+        exist. Raises ``OSError`` if it could not be moved."""
+        if not os.path.lexists(path):
+            return False
+        os.makedirs(self.trash_dir, exist_ok=True)
+        name = '{0:.0f}-{1}-{2}'.format(time.time() * 1000,
+                                        uuid.uuid4().hex[:8],
+                                        os.path.basename(path))
+        trash_path = os.path.join(self.trash_dir, name)
+        os.rename(path, trash_path)
+        with self._lock:
+            self._load()
+            if not any(item.path == trash_path for item in self._items):
+                self._items.append(TrashItem(trash_path))
+            self._ensure_started()
+            self._wakeup.notify_all()
+        return True
+
+    def pending(self):
+        """Returns a (items, bytes) tuple of the trash not yet deleted.
+        Bytes only include items the reaper has measured so far."""
+        with self._lock:
+            self._load()
+            return (len(self._items),
+                    sum(item.pending for item in self._items))
+
+    def drain(self, timeout=None):
+        """Blocks until all trash is deleted or `timeout` seconds elapse.
+        Returns True if the trash is empty."""
+        with self._lock:
+            self._ensure_started()
+            return self._wakeup.wait_for(lambda: not self._items, timeout)
+
+    def close(self):
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify_all()
+
+    def _measure(self, item):
+        size = 0
+        try:
+            for _, _, entry_size in _iter_tree(item.path):
+                size += entry_size
+        except OSError:
+            pass
+        item.size = size
+
+    def _delete_batch(self, item):
+        """Deletes up to `batch_files` files of `item`, and sets
+        `item.done` once it is gone. Returns the number of bytes
+        deleted."""
+        if item.entries is None:
+            item.entries = _iter_tree(item.path)
+        deleted = 0
+        files = 0
+        try:
+            for path, is_dir, size in item.entries:
+                if is_dir:
+                    os.rmdir(path)
+                else:
+                    remove_file(path)
+                    deleted += size
+                    files += 1
+                    if files >= self.batch_files:
+                        return deleted
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # Left in the trash directory until the next run.
+            print('Could not delete', item.path, e)
+        item.done = True
+        return deleted
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._wakeup.wait_for(lambda: self._items or self._stopped)
+                if self._stopped:
+                    return
+                items = list(self._items)
+            for unmeasured in items:
+                if unmeasured.size is None:
+                    self._measure(unmeasured)
+
+            item = items[0]
+            started = time.time()
+            deleted = self._delete_batch(item)
+            item.deleted += deleted
+            if item.done:
+                with self._lock:
+                    self._items.remove(item)
+                    self._wakeup.notify_all()
+
+            if self.max_bytes_per_second:
+                delay = (deleted / self.max_bytes_per_second -
+                         (time.time() - started))
+                if delay > 0:
+                    time.sleep(delay)
@@ -1,26 +1,226 @@
+import collections
 import ctypes
 import os
+import random
 import re
+import threading
 import time
 
 
-def wait_until(predicate, timeout, poll_interval=1, exception=None):
-    mustend = time.time() + timeout
-    while time.time() < mustend:
+class Cancelled(Exception):
+    pass
+
+
+class CancellationToken(object):
+    """A flag shared by a caller and the operations it may want to cancel.
+    Operations check it cooperatively; callbacks registered with
+    `add_callback` are called on cancellation so that blocked operations
+    can wake up."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        """Calls `callback` on cancellation, or right away if already
+        cancelled."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def wait(self, timeout=None):
+        """Blocks for up to `timeout` seconds. Returns True if cancelled."""
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise Cancelled()
+
+
+class Deadline(object):
+    """A point in time `timeout` seconds from now. A `timeout` of None never
+    expires."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires = None if timeout is None else time.time() + timeout
+
+    def remaining(self):
+        """Returns the number of seconds left, or None if there is no
+        deadline."""
+        if self.expires is None:
+            return None
+        return max(0, self.expires - time.time())
+
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
+
+
+class Backoff(object):
+    """Generates poll intervals that start at `initial` seconds and grow by
+    `factor` up to `maximum`. Each interval is randomized by up to
+    +/- `jitter` (a fraction) so that many pollers do not stay in step."""
+
+    def __init__(self, initial=1, factor=1, maximum=None, jitter=0):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+        self._interval = initial
+
+    def reset(self):
+        self._interval = self.initial
+
+    def next(self):
+        interval = self._interval
+        self._interval *= self.factor
+        if self.maximum is not None:
+            self._interval = min(self._interval, self.maximum)
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+
+def wait_until(predicate, timeout, poll_interval=1, exception=None,
+               backoff=1, max_interval=None, jitter=0, cancel_token=None):
+    """Polls `predicate` until it returns True or `timeout` seconds elapse.
+
+    The poll interval starts at `poll_interval` and is multiplied by
+    `backoff` after every poll, up to `max_interval`, with `jitter` as in
+    `Backoff`. Returns True if the predicate was satisfied. Otherwise raises
+    `exception` if given, or returns False. Also returns False as soon as
+    `cancel_token` is cancelled.
+    """
+    deadline = Deadline(timeout)
+    intervals = Backoff(poll_interval, backoff, max_interval, jitter)
+    while not deadline.expired():
         if predicate():
             return True
-        time.sleep(poll_interval)
+        delay = min(intervals.next(), deadline.remaining())
+        if cancel_token is None:
+            time.sleep(delay)
+        elif cancel_token.wait(delay):
+            return False
     if exception is not None:
         raise exception
     return False
 
 
+class StateMachine(object):
+    """A resumable state machine with a deadline for each phase.
+
+    Subclasses implement a ``step_<state>`` method for every state. A step
+    does a bounded amount of work without blocking and then either stays
+    in its state, moves to another with `enter`, or ends the machine with
+    `finish`. Each state gets a fresh deadline from `timeouts` when it is
+    entered; when it expires the machine finishes with `TIMEOUT`. When
+    `cancel_token` is cancelled the machine finishes with `CANCELED`.
+
+    `step` may be called by any driver; `run` drives the machine to
+    completion on the calling thread, sleeping between steps according to
+    `backoff`.
+    """
+    INITIAL_STATE = 'start'
+    PHASE_TIMEOUTS = {}
+    TIMEOUT = None
+    CANCELED = None
+
+    def __init__(self, timeouts=None, cancel_token=None, backoff=None):
+        self.timeouts = dict(self.PHASE_TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+        self.cancel_token = cancel_token or CancellationToken()
+        self.backoff = backoff or Backoff(0.25, 2, 5, jitter=0.1)
+        self.finished = False
+        self.result = None
+        self.enter(self.INITIAL_STATE)
+
+    def enter(self, state):
+        self.state = state
+        self.deadline = Deadline(self.timeouts.get(state))
+        self.backoff.reset()
+
+    def finish(self, result):
+        self.finished = True
+        self.result = result
+        self.cleanup()
+
+    def cleanup(self):
+        """Releases resources held by the machine. Called once it has
+        finished."""
+        pass
+
+    def on_timeout(self):
+        pass
+
+    def step(self):
+        """Performs the work of the current state. Returns True once the
+        machine has finished."""
+        if self.finished:
+            return True
+        if self.cancel_token.cancelled:
+            self.finish(self.CANCELED)
+        elif self.deadline.expired():
+            self.on_timeout()
+            self.finish(self.TIMEOUT)
+        else:
+            getattr(self, 'step_' + self.state)()
+        return self.finished
+
+    def wait_interval(self):
+        """Returns how long to wait before the next step."""
+        interval = self.backoff.next()
+        remaining = self.deadline.remaining()
+        return interval if remaining is None else min(interval, remaining)
+
+    def wait(self):
+        """Blocks until the next step is due."""
+        self.cancel_token.wait(self.wait_interval())
+
+    def run(self):
+        """Steps the machine until it finishes. Returns its result."""
+        try:
+            while not self.step():
+                self.wait()
+        except BaseException:
+            self.cleanup()
+            raise
+        return self.result
+
+
 class WindowSnapshot(object):
     def __init__(self, window):
         self.hwnd = window.hwnd
         self.title = window.title
         self.pid = window.pid
 
+    def close(self):
+        return Window(self.hwnd).close()
+
+    def exists(self):
+        return Window(self.hwnd).exists()
+
+    def is_hung(self):
+        return Window(self.hwnd).is_hung()
+
     def __repr__(self):
         return 'WindowSnapshot(hwnd={0:#x}, title="{1}", pid={2})'.format(
             self.hwnd, self.title, self.pid)
@@ -47,6 +247,10 @@ class Window(object):
     def exists(self):
         return bool(IsWindow(self.hwnd))
 
+    def is_hung(self):
+        """Returns True if Windows considers the window not responding."""
+        return bool(IsHungAppWindow(self.hwnd))
+
     def __repr__(self):
         return 'Window<{hwnd:#x}>'.format(hwnd=self.hwnd)
 
@@ -68,6 +272,61 @@ def top_level_windows():
     return iter(toplevel_windows)
 
 
+def top_level_window_snapshots():
+    """Returns a list of WindowSnapshot instances of all top-level
+    windows."""
+    return [WindowSnapshot(window) for window in top_level_windows()]
+
+
+class WindowIndex(object):
+    """A snapshot of all top-level windows, indexed by pid.
+
+    The desktop is enumerated at most once every `max_age` seconds no matter
+    how many clients query the index, and each window's title and pid are
+    read once per enumeration. `backend` is a callable returning an iterable
+    of `WindowSnapshot`-like objects (with `hwnd`, `title` and `pid`).
+    """
+
+    def __init__(self, max_age=1, backend=top_level_window_snapshots):
+        self.max_age = max_age
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._timestamp = None
+
+    def _enumerate(self):
+        windows = collections.defaultdict(list)
+        for window in self.backend():
+            windows[window.pid].append(window)
+        return dict(windows)
+
+    def refresh(self):
+        """Re-enumerates all top-level windows and returns the new
+        pid -> [WindowSnapshot] mapping."""
+        with self._lock:
+            self._windows = self._enumerate()
+            self._timestamp = time.time()
+            return self._windows
+
+    def invalidate(self):
+        """Forces the next query to re-enumerate the desktop."""
+        self._timestamp = None
+
+    def snapshot(self):
+        """Returns a pid -> [WindowSnapshot] mapping that is at most
+        `max_age` seconds old. The mapping must not be modified."""
+        with self._lock:
+            if (self._timestamp is None or
+                    time.time() - self._timestamp >= self.max_age):
+                self._windows = self._enumerate()
+                self._timestamp = time.time()
+            return self._windows
+
+    def get_process_windows(self, pid):
+        """Returns a list of WindowSnapshot instances owned by `pid`."""
+        return list(self.snapshot().get(pid, ()))
+
+
 def get_process_windows(pid):
     """Returns a generator of WindowSnapshot instances."""
     for window in top_level_windows():
@@ -79,6 +338,10 @@ def IsWindow(hwnd):
     return ctypes.windll.user32.IsWindow(hwnd)
 
 
+def IsHungAppWindow(hwnd):
+    return ctypes.windll.user32.IsHungAppWindow(hwnd)
+
+
 def GetWindowThreadProcessId(hwnd):
     pid = ctypes.c_ulong()
     try:
@@ -111,8 +374,9 @@ def SetActiveWindow(hwnd):
 def grep(regex_pattern, fileobj):
     """Returns a generator of (line_number, line) tuples that match
     `regex_pattern`."""
+    regex = re.compile(regex_pattern)
     for line_number, line in enumerate(fileobj):
-        if re.search(regex_pattern, line):
+        if regex.search(line):
             yield (line_number, line)
 
 
@@ -0,0 +1,251 @@
+import collections
+import threading
+import time
+
+import psutil
+
+from tf2idle.console import FatalError
+from tf2idle.util import Backoff
+
+
+# What each problem takes to recover from: 'login' restarts Steam, logs in
+# and launches TF2; 'launch' restarts TF2.
+RECOVERIES = {
+    'steam_exited': 'login',
+    'disconnected': 'login',
+    'hl2_exited': 'launch',
+    'fatal_error': 'launch',
+    'silent': 'launch',
+    'not_responding': 'launch',
+    'memory': 'launch',
+}
+
+
+class SupervisedAccount(object):
+    """The health and restart history of one account supervised by a
+    `Watchdog`."""
+
+    def __init__(self, username, steam_client, backoff, now):
+        self.username = username
+        self.steam_client = steam_client
+        self.backoff = backoff
+        # Times of the restarts within the restart window.
+        self.restarts = collections.deque()
+        self.last_restart = None
+        self.next_restart = now
+        self.last_output = now
+        self.fatal_error = None
+        # The time each ongoing condition was first seen, keyed by problem.
+        self.since = {}
+        self.requested = None
+        self.recovery = None
+        self.followed = None
+        self.gave_up = False
+
+
+class Watchdog(object):
+    """Keeps supervised accounts logged in and idling.
+
+    Every `interval` seconds each account is checked for these problems:
+
+    - 'steam_exited': steam.exe is not running;
+    - 'disconnected': Steam has not shown the windows of a logged in client
+      for `disconnect_timeout` seconds;
+    - 'hl2_exited': hl2.exe is not running;
+    - 'fatal_error': TF2 logged a fatal error to its console;
+    - 'silent': TF2 has written nothing to its console.log for
+      `silence_timeout` seconds;
+    - 'not_responding': a window of hl2.exe has not been responding for
+      `not_responding_timeout` seconds.
+
+    A timeout of None disables its check. An account with a problem is
+    recovered by calling `recover` with its username and the recovery in
+    `RECOVERIES`; `recover` returns a ``concurrent.futures.Future``, and the
+    account is not checked again until it is done. Restarts of an account
+    are spaced by exponential backoff from `backoff_initial` to
+    `backoff_maximum` seconds, which is reset once the account has stayed
+    healthy for `restart_window` seconds. An account that needs more than
+    `max_restarts` restarts within `restart_window` seconds is given up on.
+    """
+
+    def __init__(self, recover, log_watcher, interval=30,
+                 disconnect_timeout=120, silence_timeout=30 * 60,
+                 not_responding_timeout=120, max_restarts=5,
+                 restart_window=60 * 60, backoff_initial=30,
+                 backoff_maximum=30 * 60, clock=time.time):
+        self.recover = recover
+        self.log_watcher = log_watcher
+        self.interval = interval
+        self.disconnect_timeout = disconnect_timeout
+        self.silence_timeout = silence_timeout
+        self.not_responding_timeout = not_responding_timeout
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.backoff_initial = backoff_initial
+        self.backoff_maximum = backoff_maximum
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._accounts = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def watch(self, username, steam_client):
+        """Supervises `username`, whose Steam and TF2 are run by the
+        `SteamClient` `steam_client`."""
+        account = SupervisedAccount(
+            username, steam_client,
+            Backoff(self.backoff_initial, 2, self.backoff_maximum,
+                    jitter=0.1),
+            self.clock())
+
+        def on_console_line(line):
+            account.last_output = self.clock()
+            event = steam_client.console_parser.parse_line(line)
+            if isinstance(event, FatalError):
+                account.fatal_error = event.message
+
+        self.unwatch(username)
+        account.followed = self.log_watcher.follow(
+            steam_client.console_log_path(username), on_console_line)
+        with self._lock:
+            self._accounts[username] = account
+
+    def unwatch(self, username):
+        with self._lock:
+            account = self._accounts.pop(username, None)
+        if account is not None:
+            self.log_watcher.unfollow(account.followed)
+
+    def watching(self, username):
+        with self._lock:
+            account = self._accounts.get(username)
+        return account is not None and not account.gave_up
+
+    def request(self, username, problem):
+        """Has `username` recovered from `problem` on the next check, as if
+        it had been detected."""
+        with self._lock:
+            account = self._accounts.get(username)
+        if account is not None:
+            account.requested = problem
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='Watchdog')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        with self._lock:
+            usernames = list(self._accounts)
+        for username in usernames:
+            self.unwatch(username)
+
+    def _persists(self, account, problem, present, timeout, now):
+        """Returns True if the condition `problem` has been `present` for
+        `timeout` seconds."""
+        if not present:
+            account.since.pop(problem, None)
+            return False
+        return now - account.since.setdefault(problem, now) >= timeout
+
+    def check(self, account, now):
+        """Returns the problem of `account`, or None if it is healthy."""
+        client = account.steam_client
+        steam_process = client.get_steam_process()
+        if steam_process is None:
+            return 'steam_exited'
+        if self.disconnect_timeout is not None:
+            try:
+                logged_in = client.is_logged_in(steam_process)
+            except psutil.Error:
+                return 'steam_exited'
+            if self._persists(account, 'disconnected', not logged_in,
+                              self.disconnect_timeout, now):
+                return 'disconnected'
+
+        hl2_process = client.get_hl2_process()
+        if hl2_process is None:
+            return 'hl2_exited'
+        if account.fatal_error is not None:
+            return 'fatal_error'
+        if (self.silence_timeout is not None and
+                now - account.last_output >= self.silence_timeout):
+            return 'silent'
+        if self.not_responding_timeout is not None:
+            try:
+                responding = client.is_responding(hl2_process)
+            except psutil.Error:
+                return 'hl2_exited'
+            if self._persists(account, 'not_responding', not responding,
+                              self.not_responding_timeout, now):
+                return 'not_responding'
+        return None
+
+    def _restart(self, account, problem, now):
+        """Starts the recovery of `account` from `problem`. Returns False
+        if its restart budget is exhausted."""
+        while (account.restarts and
+               now - account.restarts[0] >= self.restart_window):
+            account.restarts.popleft()
+        if len(account.restarts) >= self.max_restarts:
+            account.gave_up = True
+            print('{}: {} after {} restarts in {:.0f} minutes; giving '
+                  'up.'.format(account.username, problem,
+                               len(account.restarts),
+                               self.restart_window / 60))
+            return False
+        recovery = RECOVERIES[problem]
+        print('{}: {}; restarting {}.'.format(
+            account.username, problem,
+            'Steam and TF2' if recovery == 'login' else 'TF2'))
+        account.restarts.append(now)
+        account.last_restart = now
+        account.next_restart = now + account.backoff.next()
+        account.requested = None
+        account.recovery = self.recover(account.username, recovery)
+        return True
+
+    def _recovered(self, account, now):
+        """Forgets the conditions seen before the recovery of `account`."""
+        account.recovery = None
+        account.since = {}
+        account.fatal_error = None
+        account.last_output = now
+
+    def tick(self):
+        """Checks every account once and restarts the ones with a problem.
+        Returns a dict of the problems acted on, keyed by username."""
+        now = self.clock()
+        with self._lock:
+            accounts = list(self._accounts.values())
+        problems = {}
+        for account in accounts:
+            if account.gave_up:
+                continue
+            if account.recovery is not None:
+                if not account.recovery.done():
+                    continue
+                self._recovered(account, now)
+
+            problem = account.requested or self.check(account, now)
+            if problem is None:
+                if (account.last_restart is not None and
+                        now - account.last_restart >= self.restart_window):
+                    account.backoff.reset()
+                    account.last_restart = None
+            elif (now >= account.next_restart and
+                  self._restart(account, problem, now)):
+                problems[account.username] = problem
+        return problems
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.tick()
+            except Exception as e:
+                print('Watchdog failed:', e)
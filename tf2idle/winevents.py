@@ -0,0 +1,293 @@
+import collections
+import ctypes
+import queue
+import sys
+import threading
+import time
+
+from tf2idle.util import WindowIndex
+
+
+WINDOW_CREATED = 'created'
+WINDOW_DESTROYED = 'destroyed'
+WINDOW_TITLE_CHANGED = 'title_changed'
+
+WindowEvent = collections.namedtuple('WindowEvent', 'kind window previous')
+
+
+def diff_windows(old, new):
+    """Returns a list of `WindowEvent` instances describing how the
+    pid -> [WindowSnapshot] mapping `old` became `new`."""
+    old = {window.hwnd: window for windows in old.values()
+           for window in windows}
+    new = {window.hwnd: window for windows in new.values()
+           for window in windows}
+
+    events = []
+    for hwnd, window in old.items():
+        current = new.get(hwnd)
+        if current is None or current.pid != window.pid:
+            events.append(WindowEvent(WINDOW_DESTROYED, window, None))
+    for hwnd, window in new.items():
+        previous = old.get(hwnd)
+        if previous is None or previous.pid != window.pid:
+            events.append(WindowEvent(WINDOW_CREATED, window, None))
+        elif previous.title != window.title:
+            events.append(WindowEvent(WINDOW_TITLE_CHANGED, window,
+                                      previous))
+    return events
+
+
+class PollingEventSource(object):
+    """Wakes the monitor every `interval` seconds so that it can diff
+    snapshots of the desktop."""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._changed = threading.Event()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.wake()
+
+    def wake(self):
+        self._changed.set()
+
+    def wait(self):
+        """Blocks until the desktop may have changed."""
+        self._changed.wait(self.interval)
+        self._changed.clear()
+
+
+class WinEventHookSource(PollingEventSource):
+    """Wakes the monitor whenever a top-level window is created, destroyed,
+    shown, hidden or renamed, using ``SetWinEventHook``. The desktop is
+    still diffed every `interval` seconds in case an event is missed."""
+    EVENT_OBJECT_CREATE = 0x8000
+    EVENT_OBJECT_HIDE = 0x8003
+    EVENT_OBJECT_NAMECHANGE = 0x800C
+    OBJID_WINDOW = 0
+    WINEVENT_OUTOFCONTEXT = 0x0000
+    WINEVENT_SKIPOWNPROCESS = 0x0002
+    WM_QUIT = 0x0012
+
+    def __init__(self, interval=5):
+        super(WinEventHookSource, self).__init__(interval)
+        self._thread = None
+        self._thread_id = None
+        self._ready = threading.Event()
+        self._error = None
+
+    def start(self):
+        """Installs the hooks. Raises ``OSError`` if they could not be
+        installed."""
+        self._thread = threading.Thread(target=self._run,
+                                        name='WinEventHookSource')
+        self._thread.daemon = True
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def stop(self):
+        if self._thread_id is not None:
+            ctypes.windll.user32.PostThreadMessageW(self._thread_id,
+                                                    self.WM_QUIT, 0, 0)
+        super(WinEventHookSource, self).stop()
+
+    def _run(self):
+        try:
+            self._pump_messages()
+        except Exception as e:
+            self._error = OSError(
+                'Could not hook window events: {0}'.format(e))
+        finally:
+            self._thread_id = None
+            self._ready.set()
+
+    def _pump_messages(self):
+        from ctypes import wintypes
+        user32 = ctypes.windll.user32
+
+        WinEventProc = ctypes.WINFUNCTYPE(
+            None, wintypes.HANDLE, wintypes.DWORD, wintypes.HWND,
+            wintypes.LONG, wintypes.LONG, wintypes.DWORD, wintypes.DWORD)
+
+        def callback(hook, event, hwnd, id_object, id_child, thread, ms):
+            if id_object == self.OBJID_WINDOW and id_child == 0:
+                self._changed.set()
+
+        # Keep a reference to the callback for as long as the hooks exist.
+        proc = WinEventProc(callback)
+        user32.SetWinEventHook.restype = wintypes.HANDLE
+        flags = self.WINEVENT_OUTOFCONTEXT | self.WINEVENT_SKIPOWNPROCESS
+        hooks = [user32.SetWinEventHook(first, last, None, proc, 0, 0, flags)
+                 for first, last in ((self.EVENT_OBJECT_CREATE,
+                                      self.EVENT_OBJECT_HIDE),
+                                     (self.EVENT_OBJECT_NAMECHANGE,
+                                      self.EVENT_OBJECT_NAMECHANGE))]
+        try:
+            if not all(hooks):
+                self._error = OSError('Could not install window event hooks.')
+                return
+            self._thread_id = ctypes.windll.kernel32.GetCurrentThreadId()
+            self._ready.set()
+
+            msg = wintypes.MSG()
+            while user32.GetMessageW(ctypes.byref(msg), None, 0, 0) > 0:
+                user32.TranslateMessage(ctypes.byref(msg))
+                user32.DispatchMessageW(ctypes.byref(msg))
+        finally:
+            for hook in hooks:
+                if hook:
+                    user32.UnhookWinEvent(hook)
+
+
+def default_event_source():
+    if sys.platform == 'win32':
+        return WinEventHookSource()
+    return PollingEventSource()
+
+
+class WindowSubscription(object):
+    """A queue of `WindowEvent` instances for the windows of one pid (or of
+    every pid, if `pid` is None)."""
+
+    def __init__(self, monitor, pid):
+        self.monitor = monitor
+        self.pid = pid
+        self._events = queue.Queue()
+
+    def put(self, event):
+        self._events.put(event)
+
+    def get(self, timeout=None):
+        """Returns the next event, or None if none arrives within
+        `timeout` seconds."""
+        try:
+            return self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def wake(self):
+        """Wakes up a thread blocked in `wait`."""
+        self._events.put(None)
+
+    def wait(self, timeout=None):
+        """Blocks until at least one event arrives, `wake` is called, or
+        `timeout` seconds elapse, then discards all pending events. Returns
+        True if an event arrived."""
+        try:
+            events = [self._events.get(timeout=timeout)]
+        except queue.Empty:
+            return False
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except queue.Empty:
+                break
+        return any(event is not None for event in events)
+
+    def close(self):
+        self.monitor.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class WindowMonitor(object):
+    """Pushes window create/destroy/title-change events to subscribers.
+
+    A single thread waits on the event `source` and diffs snapshots taken
+    with `index`. The thread only runs while there are subscribers, so an
+    idle monitor costs nothing.
+    """
+
+    def __init__(self, index=None, source=None, min_interval=0.1):
+        self.index = index or WindowIndex()
+        self.source = source or default_event_source()
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._subscriptions = collections.defaultdict(set)
+        self._active = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._current = None
+
+    def _start(self):
+        try:
+            self.source.start()
+        except OSError:
+            self.source = PollingEventSource()
+            self.source.start()
+        self._thread = threading.Thread(target=self._run,
+                                        name='WindowMonitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def subscribe(self, pid=None):
+        """Returns a `WindowSubscription` for the windows owned by `pid`, or
+        for all windows if `pid` is None."""
+        subscription = WindowSubscription(self, pid)
+        with self._lock:
+            self._subscriptions[pid].add(subscription)
+            if self._thread is None:
+                self._start()
+            self._active.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.pid)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.pid]
+
+    def get_process_windows(self, pid):
+        """Returns a list of WindowSnapshot instances owned by `pid`. While
+        the monitor is running this never enumerates the desktop."""
+        current = self._current
+        if current is not None:
+            return list(current.get(pid, ()))
+        return self.index.get_process_windows(pid)
+
+    def close(self):
+        self._stopped.set()
+        self._active.set()
+        self.source.stop()
+
+    def _dispatch(self, events):
+        with self._lock:
+            for event in events:
+                for pid in (event.window.pid, None):
+                    for subscription in self._subscriptions.get(pid, ()):
+                        subscription.put(event)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                if not self._subscriptions:
+                    self._active.clear()
+                    self._current = None
+            if not self._active.is_set():
+                self._active.wait()
+                continue
+
+            previous = self._current
+            if previous is not None:
+                started = time.time()
+                self.source.wait()
+                elapsed = time.time() - started
+                if elapsed < self.min_interval:
+                    time.sleep(self.min_interval - elapsed)
+
+            current = self.index.refresh()
+            if previous is not None:
+                self._dispatch(diff_windows(previous, current))
+            self._current = current
@@ -1,13 +1,58 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import concurrent.futures
+import configparser
 import contextlib
+import json
 import os
+import queue
+import socket
+import sqlite3
+import subprocess
 import tempfile
+import threading
+import time
 import unittest
 
-from tf2idle.steam import (SteamInstallation, LinkedSteamInstallation,
-                           LinkedInstallationError)
+import psutil
+
+from tf2idle.app import Tf2IdleApp
+from tf2idle.console import (ConsoleLogParser, Connected, FatalError,
+                             ItemDrop, MapChange, ServerInfo)
+from tf2idle.contentstore import ContentStore
+from tf2idle.daemon import DaemonClient, DaemonError, Tf2IdleDaemon
+from tf2idle.fsops import BulkFilesystem
+from tf2idle.logwatch import LogWatcher, StatPollingBackend
+from tf2idle.main import build_arg_parser, given_app_options
+from tf2idle.memory import MemoryGovernor
+from tf2idle.metrics import PhaseMetrics
+from tf2idle.orchestrator import Orchestrator
+from tf2idle.placement import (BELOW_NORMAL_PRIORITY, IDLE_PRIORITY,
+                               CpuPlacement, parse_cores)
+from tf2idle.ports import PortAllocator, PortSet, port_is_free
+from tf2idle.processes import ProcessIndex, ProcessSnapshot, normalize_dir
+from tf2idle.provisioning import ProvisionRegistry
+from tf2idle.registry import Tf2RegistryProfile
+from tf2idle.sandboxes import (MemoryConfigBackend, SandboxConfigBatch,
+                               SandboxieConfigBackend)
+from tf2idle.scheduler import HostLoad, LaunchScheduler
+from tf2idle.statestore import FleetStateStore
+from tf2idle.status import fleet_status
+from tf2idle.statuscache import InstallationStatusCache
+from tf2idle.steam import (SteamAccount, SteamClient,
+                           SteamClientStateMachine, SteamInstallation,
+                           LinkedSteamInstallation, LinkedInstallationError,
+                           LoginResult, LoginStateMachine, Tf2Installation,
+                           Tf2LaunchResult, Tf2LaunchStateMachine)
+from tf2idle.templates import Tf2Template
+from tf2idle.trash import TrashQueue
+from tf2idle.util import (Backoff, CancellationToken, Cancelled,
+                          StateMachine, WindowIndex, wait_until)
+from tf2idle.watchdog import Watchdog
+from tf2idle.winevents import (WindowMonitor, PollingEventSource,
+                               diff_windows, WINDOW_CREATED,
+                               WINDOW_DESTROYED, WINDOW_TITLE_CHANGED)
 
 
 @contextlib.contextmanager
@@ -46,6 +91,187 @@ def create_linked_steam_installation(already_linked=False):
     return build_installation(LinkedSteamInstallation, already_linked)
 
 
+class FakeInstallation(object):
+    def __init__(self, installed=True):
+        self._installed = installed
+
+    def installed(self):
+        return self._installed
+
+
+class FakeProcess(object):
+    """A `psutil.Process`, with the `info` of `psutil.process_iter`."""
+
+    def __init__(self, pid, name=None, ppid=0, cwd=None, create_time=0.0):
+        self.pid = pid
+        self.info = {'name': name, 'ppid': ppid, 'create_time': create_time}
+        self._cwd = cwd
+        self.cwd_calls = 0
+        self.running = True
+        self.cpu = 0.0
+        self.priority = None
+        self.affinity = None
+
+    def cwd(self):
+        self.cwd_calls += 1
+        return self._cwd
+
+    def create_time(self):
+        return self.info['create_time']
+
+    def is_running(self):
+        return self.running
+
+    def terminate(self):
+        self.running = False
+
+    def nice(self, value):
+        self.priority = value
+
+    def cpu_affinity(self, cpus):
+        self.affinity = cpus
+
+    def cpu_percent(self, interval=None):
+        return self.cpu
+
+
+class FakeProcessTable(object):
+    def __init__(self, processes):
+        self.processes = processes
+        self.scans = 0
+
+    def __call__(self, attrs=None, ad_value=None):
+        self.scans += 1
+        return iter(self.processes)
+
+
+class FakeWindow(object):
+    def __init__(self, hwnd, title, pid):
+        self.hwnd = hwnd
+        self.title = title
+        self.pid = pid
+
+
+class FakeDesktop(object):
+    def __init__(self, windows):
+        self.windows = windows
+        self.enumerations = 0
+
+    def __call__(self):
+        self.enumerations += 1
+        return list(self.windows)
+
+
+class FakeLogWatcher(object):
+    """Calls `on_follow` with the consumer of a followed file."""
+
+    def __init__(self, on_follow=None):
+        self.consumers = {}
+        self.on_follow = on_follow
+
+    def follow(self, path, consumer):
+        self.consumers[path] = consumer
+        if self.on_follow is not None:
+            self.on_follow(consumer)
+        return path
+
+    def unfollow(self, followed):
+        self.consumers.pop(followed, None)
+
+
+class FakePlacement(object):
+    def add(self, process, kind):
+        pass
+
+
+class FakeLoadSampler(object):
+    def __init__(self):
+        self.load = HostLoad(cpu_percent=10, available_memory=4096,
+                             disk_queue=0)
+
+    def sample(self):
+        return self.load
+
+
+class FakeLaunchGate(object):
+    def __init__(self):
+        self.refusals = set()
+
+    def refuse(self, reason):
+        self.refusals.add(reason)
+
+    def allow(self, reason):
+        self.refusals.discard(reason)
+
+
+class FakeMemoryBackend(object):
+    def __init__(self, usage):
+        self.usage = usage
+        self.trimmed = []
+        self.restarted = []
+
+    def memory(self, process):
+        return self.usage[process]
+
+    def trim(self, process):
+        self.trimmed.append(process)
+        self.usage[process] //= 2
+        return True
+
+    def restart(self, username):
+        self.restarted.append(username)
+
+
+class FakeSupervisedClient(object):
+    def __init__(self):
+        self.console_parser = ConsoleLogParser()
+        self.steam_process = FakeProcess(1, 'Steam.exe')
+        self.hl2_process = FakeProcess(2, 'hl2.exe')
+        self.logged_in = True
+        self.responding = True
+
+    def console_log_path(self, username):
+        return username + '.log'
+
+    def get_steam_process(self):
+        return self.steam_process
+
+    def get_hl2_process(self):
+        return self.hl2_process
+
+    def is_logged_in(self, steam_process):
+        return self.logged_in
+
+    def is_responding(self, process):
+        return self.responding
+
+
+class FakeDaemonApp(object):
+    def __init__(self):
+        self.calls = []
+        self.received = threading.Event()
+        self.cancel_token = CancellationToken()
+        self.cancel_tokens = []
+
+    def login(self, accounts, cancel_token=None):
+        self.calls.append(('login', list(accounts)))
+        return {index: 1 for index in range(len(accounts))}
+
+    def up(self, accounts, launch_options=None, autoexec_cfg=None,
+           cancel_token=None):
+        self.calls.append(('up', launch_options, autoexec_cfg))
+        self.cancel_tokens.append(cancel_token)
+        for index, account in enumerate(accounts):
+            if index:
+                # The next account only finishes once the first one was
+                # received.
+                self.received.wait(5)
+            yield account, 1, (1, None, '27400', '27100')
+
+    def close_tf2(self, accounts):
+        raise RuntimeError('Sandboxie is not running.')
+
+
 class SteamInstallationTests(unittest.TestCase):
     def test_installation_installed(self):
         with create_steam_installation(installed=True) as ins:
@@ -99,5 +325,1254 @@ class LinkedSteamInstallationTests(unittest.TestCase):
             self.assertFalse(l.installed())
 
 
+class ProcessIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.steam = FakeProcess(10, 'Steam.exe', cwd=os.path.join('a', 'b'))
+        self.hl2 = FakeProcess(11, 'hl2.exe', ppid=10)
+        self.other = FakeProcess(12, 'hl2.exe', ppid=99)
+        self.table = FakeProcessTable([self.steam, self.hl2, self.other])
+
+    def test_processes_indexed_by_steam_dir(self):
+        index = ProcessIndex(process_iter=self.table)
+        steam_dir = os.path.join('a', 'b')
+        self.assertIs(index.get_steam_process(steam_dir), self.steam)
+        self.assertIs(index.get_hl2_process(steam_dir), self.hl2)
+        self.assertIsNone(index.get_steam_process('c'))
+        self.assertIsNone(index.get_hl2_process('c'))
+
+    def test_snapshot_shared_within_max_age(self):
+        index = ProcessIndex(max_age=60, process_iter=self.table)
+        for _ in range(5):
+            index.get_steam_process('a')
+            index.get_hl2_process('a')
+        self.assertEqual(self.table.scans, 1)
+
+        index.invalidate()
+        index.get_steam_process('a')
+        self.assertEqual(self.table.scans, 2)
+        # The working directory is remembered for the process' lifetime.
+        self.assertEqual(self.steam.cwd_calls, 1)
+
+
+class WindowIndexTests(unittest.TestCase):
+    def test_windows_indexed_by_pid(self):
+        desktop = FakeDesktop([FakeWindow(1, 'Steam', 10),
+                               FakeWindow(2, 'Friends', 10),
+                               FakeWindow(3, 'Team Fortress 2', 11)])
+        index = WindowIndex(max_age=60, backend=desktop)
+        self.assertEqual([w.title for w in index.get_process_windows(10)],
+                         ['Steam', 'Friends'])
+        self.assertEqual([w.hwnd for w in index.get_process_windows(11)],
+                         [3])
+        self.assertEqual(index.get_process_windows(12), [])
+        self.assertEqual(desktop.enumerations, 1)
+
+    def test_refresh_after_invalidate(self):
+        desktop = FakeDesktop([FakeWindow(1, 'Steam', 10)])
+        index = WindowIndex(max_age=60, backend=desktop)
+        index.get_process_windows(10)
+        desktop.windows.append(FakeWindow(2, 'Servers', 10))
+        self.assertEqual(len(index.get_process_windows(10)), 1)
+        index.invalidate()
+        self.assertEqual(len(index.get_process_windows(10)), 2)
+
+
+class WindowMonitorTests(unittest.TestCase):
+    def test_diff_windows(self):
+        old = {10: [FakeWindow(1, 'Steam', 10), FakeWindow(2, 'Login', 10)]}
+        new = {10: [FakeWindow(1, 'Steam - Updating', 10)],
+               11: [FakeWindow(3, 'Team Fortress 2', 11)]}
+        events = {(e.kind, e.window.hwnd) for e in diff_windows(old, new)}
+        self.assertEqual(events, {(WINDOW_TITLE_CHANGED, 1),
+                                  (WINDOW_DESTROYED, 2),
+                                  (WINDOW_CREATED, 3)})
+
+    def test_events_pushed_to_pid_subscribers(self):
+        desktop = FakeDesktop([FakeWindow(1, 'Steam', 10)])
+        monitor = WindowMonitor(WindowIndex(backend=desktop),
+                                source=PollingEventSource(interval=0.01),
+                                min_interval=0)
+        try:
+            steam_events = monitor.subscribe(10)
+            other_events = monitor.subscribe(11)
+            time.sleep(0.1)
+            desktop.windows.append(FakeWindow(2, 'Friends', 10))
+
+            event = steam_events.get(timeout=5)
+            self.assertEqual(event.kind, WINDOW_CREATED)
+            self.assertEqual(event.window.title, 'Friends')
+            self.assertEqual(
+                [w.title for w in monitor.get_process_windows(10)],
+                ['Steam', 'Friends'])
+            self.assertFalse(other_events.wait(timeout=0.1))
+        finally:
+            monitor.close()
+
+
+class LogWatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.watcher = LogWatcher(StatPollingBackend(interval=0.01))
+        self.lines = queue.Queue()
+
+    def tearDown(self):
+        self.watcher.close()
+
+    def next_line(self):
+        return self.lines.get(timeout=5)
+
+    def test_follow_file_created_later_with_partial_lines(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'tf', 'console.log')
+            self.watcher.follow(path, self.lines.put)
+            time.sleep(0.05)
+
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as log:
+                log.write(b'first\r\nsec')
+                log.flush()
+                self.assertEqual(self.next_line(), 'first')
+                time.sleep(0.05)
+                log.write(b'ond\n')
+            self.assertEqual(self.next_line(), 'second')
+
+    def test_truncated_file_is_read_from_start(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'console.log')
+            with open(path, 'wb') as log:
+                log.write(b'a long first line\n')
+            followed = self.watcher.follow(path, self.lines.put)
+            self.assertEqual(self.next_line(), 'a long first line')
+
+            with open(path, 'wb') as log:
+                log.write(b'new\n')
+            self.assertEqual(self.next_line(), 'new')
+
+            self.watcher.unfollow(followed)
+            with open(path, 'ab') as log:
+                log.write(b'ignored\n')
+            with self.assertRaises(queue.Empty):
+                self.lines.get(timeout=0.1)
+
+
+class ConsoleLogParserTests(unittest.TestCase):
+    LOG = (b'Redownloading all lightmaps\r\n'
+           b'Map: itemtest\r\n'
+           b'Network: IP 10.0.0.2, mode MP, dedicated No, '
+           b'ports 27015 SV / 27005 CL\r\n'
+           b'Bob connected\r\n'
+           b'Bob disconnected\r\n'
+           b'Bob has found: Strange Shotgun\r\n'
+           b'Host_Error: Map missing\r\n')
+
+    EVENTS = [MapChange('itemtest'),
+              ServerInfo('10.0.0.2', '27015', '27005'),
+              Connected('Bob connected'),
+              ItemDrop('Bob', 'Strange Shotgun'),
+              FatalError('Map missing')]
+
+    def test_feed_in_arbitrary_chunks(self):
+        for chunk_size in (1, 7, 64, len(self.LOG)):
+            parser = ConsoleLogParser()
+            events = []
+            for i in range(0, len(self.LOG), chunk_size):
+                events.extend(parser.feed(self.LOG[i:i + chunk_size]))
+            self.assertEqual(events + parser.flush(), self.EVENTS)
+
+    def test_flush_parses_unterminated_line(self):
+        parser = ConsoleLogParser()
+        self.assertEqual(parser.feed(b'Map: ctf_2fort'), [])
+        self.assertEqual(parser.flush(), [MapChange('ctf_2fort')])
+
+    def test_overlong_lines_are_discarded(self):
+        parser = ConsoleLogParser(max_line_length=16)
+        events = parser.feed(b'Map: ' + b'x' * 32)
+        events += parser.feed(b'x' * 32 + b'\nMap: a\n')
+        self.assertEqual(events, [MapChange('a')])
+
+    def test_parse_line(self):
+        parser = ConsoleLogParser()
+        lines = self.LOG.decode('ascii').splitlines()
+        events = [parser.parse_line(line) for line in lines]
+        self.assertEqual([e for e in events if e is not None], self.EVENTS)
+
+
+class OrchestratorTests(unittest.TestCase):
+    def setUp(self):
+        self.orchestrator = Orchestrator(concurrency={'launch_tf2': 2},
+                                         max_workers=8)
+        self.lock = threading.Lock()
+        self.running = self.peak = 0
+
+    def tearDown(self):
+        self.orchestrator.close()
+
+    def task(self, result):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.02)
+        with self.lock:
+            self.running -= 1
+        return result
+
+    def test_results_keyed_by_task_index(self):
+        tasks = [lambda i=i: self.task(i * i) for i in range(10)]
+        results = self.orchestrator.run('login', tasks)
+        self.assertEqual(results, {i: i * i for i in range(10)})
+
+    def test_chain_stops_when_step_does_not_proceed(self):
+        steps = [('login', lambda: 'failed', lambda r: r == 'ok'),
+                 ('launch_tf2', lambda: self.fail('launched'), None)]
+        future = self.orchestrator.submit_chain(steps)
+        self.assertEqual(future.result(timeout=5), ['failed'])
+
+        steps[0] = ('login', lambda: 'ok', lambda r: r == 'ok')
+        steps[1] = ('launch_tf2', lambda: 'launched', None)
+        future = self.orchestrator.submit_chain(steps)
+        self.assertEqual(future.result(timeout=5), ['ok', 'launched'])
+
+    def test_concurrency_limited_per_operation(self):
+        tasks = [lambda i=i: self.task(i) for i in range(8)]
+        self.orchestrator.run('launch_tf2', tasks)
+        self.assertEqual(self.peak, 2)
+
+    def test_launches_limited_by_launch_scheduler(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        app = Tf2IdleApp(working_dir=temp_dir.name,
+                         concurrency={'login': 2, 'launch_tf2': 10},
+                         launch_options={'max_in_flight': 3,
+                                         'sampler': FakeLoadSampler()})
+        self.addCleanup(app.close)
+        self.assertEqual(app.orchestrator.concurrency['login'], 2)
+        self.assertEqual(app.orchestrator.concurrency['launch_tf2'], 3)
+
+
+class LaunchSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.sampler = FakeLoadSampler()
+        self.scheduler = LaunchScheduler(max_in_flight=1, ramp_up=0,
+                                         max_cpu_percent=50,
+                                         min_available_memory=1024,
+                                         max_disk_queue=1, poll_interval=0.01,
+                                         sampler=self.sampler)
+
+    def admit_in_thread(self, username, admitted):
+        def launch():
+            with self.scheduler.admit(username):
+                admitted.set()
+        thread = threading.Thread(target=launch)
+        thread.start()
+        return thread
+
+    def test_max_in_flight(self):
+        admitted = threading.Event()
+        self.scheduler.acquire('a')
+        thread = self.admit_in_thread('b', admitted)
+        self.assertFalse(admitted.wait(0.1))
+        self.scheduler.release('a')
+        self.assertTrue(admitted.wait(5))
+        thread.join()
+        self.assertGreaterEqual(self.scheduler.wait_times['b'], 0.1)
+
+    def test_not_admitted_while_overloaded(self):
+        for load in (HostLoad(90, 4096, 0), HostLoad(10, 100, 0),
+                     HostLoad(10, 4096, 5)):
+            admitted = threading.Event()
+            self.sampler.load = load
+            thread = self.admit_in_thread('a', admitted)
+            self.assertFalse(admitted.wait(0.05))
+            self.sampler.load = HostLoad(10, 4096, 0)
+            self.assertTrue(admitted.wait(5))
+            thread.join()
+
+    def test_cancel_while_queued(self):
+        token = CancellationToken()
+        self.scheduler.acquire('a')
+        token.cancel()
+        with self.assertRaises(Cancelled):
+            self.scheduler.acquire('b', token)
+        self.scheduler.release('a')
+        self.assertLess(self.scheduler.acquire('c'), 1)
+
+    def test_refused(self):
+        admitted = threading.Event()
+        self.scheduler.refuse('memory')
+        thread = self.admit_in_thread('a', admitted)
+        self.assertFalse(admitted.wait(0.05))
+        self.scheduler.allow('memory')
+        self.assertTrue(admitted.wait(5))
+        thread.join()
+
+
+class CountingStateMachine(StateMachine):
+    PHASE_TIMEOUTS = {'counting': 0.2}
+    TIMEOUT = 'timeout'
+    CANCELED = 'canceled'
+
+    def __init__(self, target, **kwargs):
+        super(CountingStateMachine, self).__init__(
+            backoff=Backoff(0.01), **kwargs)
+        self.target = target
+        self.count = 0
+        self.cleaned_up = False
+
+    def step_start(self):
+        self.enter('counting')
+
+    def step_counting(self):
+        self.count += 1
+        if self.count == self.target:
+            self.finish('done')
+
+    def cleanup(self):
+        self.cleaned_up = True
+
+
+class StateMachineTests(unittest.TestCase):
+    def test_runs_to_completion(self):
+        machine = CountingStateMachine(3)
+        self.assertEqual(machine.run(), 'done')
+        self.assertTrue(machine.cleaned_up)
+
+    def test_phase_timeout(self):
+        machine = CountingStateMachine(None)
+        self.assertEqual(machine.run(), 'timeout')
+        self.assertEqual(machine.state, 'counting')
+        machine = CountingStateMachine(None, timeouts={'counting': 0.05})
+        started = time.time()
+        machine.run()
+        self.assertLess(time.time() - started, 0.2)
+
+    def test_cancel(self):
+        token = CancellationToken()
+        machine = CountingStateMachine(None, timeouts={'counting': None},
+                                       cancel_token=token)
+        threading.Timer(0.05, token.cancel).start()
+        self.assertEqual(machine.run(), 'canceled')
+        self.assertTrue(machine.cleaned_up)
+
+    def test_wait_until(self):
+        polls = []
+        self.assertTrue(wait_until(lambda: polls.append(1) or len(polls) == 3,
+                                   timeout=5, poll_interval=0.01, backoff=2))
+        self.assertFalse(wait_until(lambda: False, timeout=0.05,
+                                    poll_interval=0.01))
+        token = CancellationToken()
+        token.cancel()
+        self.assertFalse(wait_until(lambda: False, timeout=5,
+                                    cancel_token=token))
+
+
+class SteamStateMachineTests(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        steam_dir = os.path.join(temp_dir.name, 'steam')
+        self.steam = FakeProcess(10, 'Steam.exe', cwd=steam_dir,
+                                 create_time=1.5)
+        self.hl2 = FakeProcess(11, 'hl2.exe', ppid=10, create_time=1.5)
+        self.processes = []
+        self.desktop = FakeDesktop([])
+        monitor = WindowMonitor(WindowIndex(max_age=0, backend=self.desktop),
+                                source=PollingEventSource(interval=0.01),
+                                min_interval=0)
+        self.addCleanup(monitor.close)
+        self.log_watcher = FakeLogWatcher()
+        self.client = SteamClient(
+            SteamInstallation(steam_dir), shell_executer=self.execute,
+            process_index=ProcessIndex(
+                max_age=0, process_iter=FakeProcessTable(self.processes)),
+            window_monitor=monitor, log_watcher=self.log_watcher,
+            registry_profile=Tf2RegistryProfile(temp_dir.name),
+            placement=FakePlacement())
+
+    def execute(self, command, wait=False):
+        if '-login' in command:
+            self.processes.append(self.steam)
+        elif '-applaunch' in command:
+            self.processes.append(self.hl2)
+
+    def show(self, title, pid=10):
+        self.desktop.windows.append(FakeWindow(len(self.desktop.windows),
+                                               title, pid))
+
+    def login(self, **kwargs):
+        return LoginStateMachine(self.client, 'a', 'secret', **kwargs).run()
+
+    def launch(self, **kwargs):
+        self.processes.append(self.steam)
+        return Tf2LaunchStateMachine(self.client, 'a', ['-novid'],
+                                     **kwargs).run()
+
+    def test_login_times_out_without_windows(self):
+        self.show('Steam - Updating', pid=99)
+        self.assertEqual(self.login(timeouts={'login': 0.2}),
+                         LoginResult.TIMEOUT)
+
+    def test_login_error_window(self):
+        self.show('Steam - Error')
+        self.assertEqual(self.login(), LoginResult.LOGIN_FAILED)
+        self.assertFalse(self.steam.running)
+
+    def test_login_succeeds_with_logged_in_windows(self):
+        for title in SteamClient.LOGGED_IN_WINDOWS:
+            self.show(title)
+        self.assertEqual(self.login(), LoginResult.LOGIN_SUCCEEDED)
+
+    def test_launch_times_out_without_connected_line(self):
+        self.log_watcher.on_follow = lambda consumer: consumer(
+            'Network: IP 10.0.0.2, mode MP, dedicated No, '
+            'ports 27015 SV / 27005 CL')
+        self.assertEqual(self.launch(timeouts={'connection': 0.2}),
+                         Tf2LaunchResult.TIMEOUT)
+        self.assertEqual(self.log_watcher.consumers, {})
+
+    def test_launch_succeeds_on_connected_line(self):
+        def on_follow(consumer):
+            consumer('Network: IP 10.0.0.2, mode MP, dedicated No, '
+                     'ports 27015 SV / 27005 CL\r\n')
+            consumer('Bob connected\r\n')
+
+        self.log_watcher.on_follow = on_follow
+        self.assertEqual(self.launch(), (Tf2LaunchResult.LAUNCH_SUCCEEDED,
+                                         '10.0.0.2', '27015', '27005'))
+        self.assertEqual(self.log_watcher.consumers, {})
+
+    def test_cancel_runs_cleanup(self):
+        token = CancellationToken()
+        self.log_watcher.on_follow = lambda consumer: token.cancel()
+        self.assertEqual(self.launch(cancel_token=token),
+                         Tf2LaunchResult.LAUNCH_CANCELED)
+        self.assertEqual(self.log_watcher.consumers, {})
+
+        token = CancellationToken()
+        threading.Timer(0.05, token.cancel).start()
+        machine = LoginStateMachine(self.client, 'a', cancel_token=token)
+        self.assertEqual(machine.run(), LoginResult.LOGIN_CANCELED)
+        self.assertIsNone(machine.events)
+
+
+class IncrementalLinkTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.base = SteamInstallation(os.path.join(self.dir.name, 'base'))
+        for path, content in (('steam.exe', b'exe'), ('Steam.dll', b'dll'),
+                              ('bin/a.dll', b'a'), ('bin/sub/b.dll', b'b'),
+                              ('steamapps/x.gcf', b'gcf'),
+                              ('userdata/skipped', b'')):
+            self.write(path, content)
+        self.store = ContentStore(os.path.join(self.dir.name, 'store'))
+
+    def write(self, path, content):
+        path = os.path.join(self.base.steam_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def linked(self, username):
+        installation = LinkedSteamInstallation(
+            os.path.join(self.dir.name, username), content_store=self.store)
+        installation.link(self.base)
+        return installation
+
+    def test_files_copied_privately(self):
+        a, b = self.linked('a'), self.linked('b')
+        self.assertTrue(a.installed())
+        path_a = os.path.join(a.steam_dir, 'bin', 'sub', 'b.dll')
+        path_b = os.path.join(b.steam_dir, 'bin', 'sub', 'b.dll')
+        self.assertFalse(os.path.samefile(path_a, path_b))
+        self.assertTrue(os.path.islink(os.path.join(a.steamapps_dir,
+                                                    'x.gcf')))
+        self.assertFalse(os.path.exists(os.path.join(a.steam_dir,
+                                                     'userdata')))
+
+    def test_write_in_one_installation_does_not_leak(self):
+        a, b = self.linked('a'), self.linked('b')
+        # Steam updating itself in a's sandbox writes the real file.
+        with open(os.path.join(a.steam_dir, 'bin', 'a.dll'), 'wb') as f:
+            f.write(b'updated')
+        with open(os.path.join(b.steam_dir, 'bin', 'a.dll'), 'rb') as f:
+            self.assertEqual(f.read(), b'a')
+        with open(os.path.join(self.base.steam_dir, 'bin', 'a.dll'),
+                  'rb') as f:
+            self.assertEqual(f.read(), b'a')
+        self.assertEqual(self.store.prune(), 0)
+        # The update is kept until the base installation changes.
+        a.link(self.base)
+        with open(os.path.join(a.steam_dir, 'bin', 'a.dll'), 'rb') as f:
+            self.assertEqual(f.read(), b'updated')
+
+    def test_relink_only_updates_changed_files(self):
+        installation = self.linked('a')
+        dll = os.path.join(installation.steam_dir, 'bin', 'a.dll')
+        exe_inode = os.stat(installation.steam_exe_path).st_ino
+        self.write('bin/a.dll', b'changed')
+        os.remove(os.path.join(self.base.steam_dir, 'Steam.dll'))
+        installation.link(self.base)
+        with open(dll, 'rb') as f:
+            self.assertEqual(f.read(), b'changed')
+        self.assertEqual(os.stat(installation.steam_exe_path).st_ino,
+                         exe_inode)
+        self.assertFalse(os.path.exists(os.path.join(installation.steam_dir,
+                                                     'Steam.dll')))
+
+    def test_prune_removes_unreferenced_content(self):
+        digest = self.store.add(self.base.steam_exe_path)
+        placed = os.path.join(self.dir.name, 'placed', 'steam.exe')
+        self.store.place(digest, placed)
+        self.assertEqual(self.store.prune(), 0)
+        os.remove(placed)
+        self.assertEqual(self.store.prune(), len(b'exe'))
+
+    def test_bulk_link_and_unlink_report_stats(self):
+        installations = [LinkedSteamInstallation(
+            os.path.join(self.dir.name, username),
+            content_store=self.store) for username in ('a', 'b', 'c')]
+        bulk_fs = BulkFilesystem(max_workers=2)
+        results = bulk_fs.link(installations, self.base)
+        for installation in installations:
+            # steam.exe, Steam.dll, a.dll, b.dll and the x.gcf symlink.
+            self.assertEqual(results[installation].files, 5)
+            self.assertEqual(results[installation].bytes, 8)
+        self.assertEqual(bulk_fs.link(installations, self.base)[
+            installations[0]].files, 0)
+        missing = LinkedSteamInstallation(os.path.join(self.dir.name, 'd'),
+                                          content_store=self.store)
+        results = bulk_fs.link([missing], SteamInstallation('nonexistent'))
+        self.assertIsInstance(results[missing], LinkedInstallationError)
+
+        results = bulk_fs.unlink(installations)
+        for installation in installations:
+            # The manifest is removed too.
+            self.assertEqual(results[installation].files, 6)
+            self.assertFalse(os.path.exists(installation.steam_dir))
+
+
+class TrashQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.trash_dir = os.path.join(self.dir.name, 'trash')
+
+    def create_tree(self, name, files=10):
+        path = os.path.join(self.dir.name, name)
+        os.makedirs(os.path.join(path, 'sub'))
+        for i in range(files):
+            with open(os.path.join(path, 'sub', str(i)), 'wb') as f:
+                f.write(b'x' * 100)
+        return path
+
+    def test_trash_moves_then_deletes_in_batches(self):
+        trash = TrashQueue(self.trash_dir, batch_files=3)
+        self.addCleanup(trash.close)
+        path = self.create_tree('tf2')
+        self.assertTrue(trash.trash(path))
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(trash.trash(path))
+        self.assertTrue(trash.drain(5))
+        self.assertEqual(trash.pending(), (0, 0))
+        self.assertEqual(os.listdir(self.trash_dir), [])
+
+    def test_rate_limit_and_leftovers(self):
+        os.makedirs(self.trash_dir)
+        os.rename(self.create_tree('leftover'),
+                  os.path.join(self.trash_dir, 'leftover'))
+        trash = TrashQueue(self.trash_dir, max_bytes_per_second=2000,
+                           batch_files=2)
+        self.addCleanup(trash.close)
+        self.assertEqual(trash.pending(), (1, 0))
+        trash.start()
+        self.assertFalse(trash.drain(0.1))
+        self.assertEqual(trash.pending()[0], 1)
+        self.assertGreater(trash.pending()[1], 0)
+        self.assertTrue(trash.drain(5))
+
+
+class Tf2TemplateTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        base = SteamInstallation(os.path.join(self.dir.name, 'base'))
+        self.source_dir = os.path.join(base.steamapps_dir, 'someone',
+                                       'team fortress 2')
+        for path in ('hl2.exe', 'tf/bin/client.dll', 'tf/cfg/config.cfg',
+                     'tf/console.log'):
+            path = os.path.join(self.source_dir, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(path.encode('utf-8'))
+        self.assertEqual(Tf2Template.find_source_dir(base), self.source_dir)
+        self.template = Tf2Template(
+            self.source_dir,
+            ContentStore(os.path.join(self.dir.name, 'store')))
+
+    def test_materialize(self):
+        dest_a = os.path.join(self.dir.name, 'a')
+        dest_b = os.path.join(self.dir.name, 'b')
+        self.assertEqual(self.template.materialize(dest_a).files, 3)
+        self.template.materialize(dest_b)
+        self.assertTrue(os.path.samefile(
+            os.path.join(dest_a, 'tf', 'bin', 'client.dll'),
+            os.path.join(dest_b, 'tf', 'bin', 'client.dll')))
+        cfg = os.path.join(dest_a, 'tf', 'cfg', 'config.cfg')
+        self.assertFalse(os.path.samefile(
+            cfg, os.path.join(dest_b, 'tf', 'cfg', 'config.cfg')))
+        self.assertFalse(os.path.exists(os.path.join(dest_a, 'tf',
+                                                     'console.log')))
+
+        # Local changes to writable files are kept; missing files are
+        # restored.
+        with open(cfg, 'w') as f:
+            f.write('changed')
+        os.remove(os.path.join(dest_a, 'hl2.exe'))
+        self.assertEqual(self.template.materialize(dest_a).files, 1)
+        with open(cfg) as f:
+            self.assertEqual(f.read(), 'changed')
+
+    def test_writable_files_copied(self):
+        custom = os.path.join(self.source_dir, 'tf', 'custom', 'hud.vpk')
+        os.makedirs(os.path.dirname(custom))
+        with open(custom, 'wb') as f:
+            f.write(b'hud')
+        dest_a = os.path.join(self.dir.name, 'a')
+        dest_b = os.path.join(self.dir.name, 'b')
+        self.template.materialize(dest_a)
+        self.template.materialize(dest_b)
+        with open(os.path.join(dest_a, 'tf', 'custom', 'hud.vpk'),
+                  'wb') as f:
+            f.write(b'changed')
+        with open(os.path.join(dest_b, 'tf', 'custom', 'hud.vpk'),
+                  'rb') as f:
+            self.assertEqual(f.read(), b'hud')
+        with open(custom, 'rb') as f:
+            self.assertEqual(f.read(), b'hud')
+
+    def test_template_changes_picked_up(self):
+        dest = os.path.join(self.dir.name, 'a')
+        self.template.materialize(dest)
+        added = os.path.join(self.source_dir, 'tf', 'bin', 'server.dll')
+        with open(added, 'wb') as f:
+            f.write(b'server')
+        # Make sure the directory's mtime changes on coarse filesystems.
+        st = os.stat(os.path.dirname(added))
+        os.utime(os.path.dirname(added),
+                 ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.assertEqual(self.template.materialize(dest).files, 1)
+        self.assertTrue(os.path.exists(os.path.join(dest, 'tf', 'bin',
+                                                    'server.dll')))
+
+
+class CountingTf2Installation(Tf2Installation):
+    computed = 0
+
+    def compute_status(self):
+        CountingTf2Installation.computed += 1
+        return super(CountingTf2Installation, self).compute_status()
+
+
+class InstallationStatusCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.gcf_dir = os.path.join(self.dir.name, 'gcfs')
+        os.makedirs(self.gcf_dir)
+        steamapps_dir = os.path.join(self.dir.name, 'steam', 'steamapps')
+        os.makedirs(steamapps_dir)
+        open(os.path.join(self.dir.name, 'steam', 'steam.exe'), 'w').close()
+        for gcf in Tf2Installation.REQUIRED_GCFS[1:]:
+            open(os.path.join(self.gcf_dir, gcf), 'w').close()
+            os.symlink(os.path.join(self.gcf_dir, gcf),
+                       os.path.join(steamapps_dir, gcf))
+        self.cache_path = os.path.join(self.dir.name, 'cache.json')
+        CountingTf2Installation.computed = 0
+
+    def installation(self, cache):
+        return CountingTf2Installation(os.path.join(self.dir.name, 'steam'),
+                                       status_cache=cache)
+
+    def test_status_cached_until_directories_change(self):
+        cache = InstallationStatusCache(self.cache_path)
+        status = self.installation(cache).status()
+        self.assertFalse(status.installed)
+        self.assertEqual(status.missing, Tf2Installation.REQUIRED_GCFS[:1])
+        self.assertEqual(status.dangling, ())
+        self.assertEqual(self.installation(cache).status(), status)
+        self.assertEqual(CountingTf2Installation.computed, 1)
+
+        cache.save()
+        cache = InstallationStatusCache(self.cache_path)
+        self.assertEqual(self.installation(cache).status(), status)
+        self.assertEqual(CountingTf2Installation.computed, 1)
+
+        # Removing a symlink target changes the target directory's mtime.
+        time.sleep(0.01)
+        os.remove(os.path.join(self.gcf_dir,
+                               Tf2Installation.REQUIRED_GCFS[1]))
+        status = self.installation(cache).status()
+        self.assertEqual(status.dangling, Tf2Installation.REQUIRED_GCFS[1:2])
+        self.assertEqual(CountingTf2Installation.computed, 2)
+
+
+class ProvisionRegistryTests(unittest.TestCase):
+    OPTIONS = {'Enabled': 'y', 'OpenPipePath': 'C:'}
+
+    def test_provisioned_accounts_are_validated(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'provisioned.json')
+            registry = ProvisionRegistry(path)
+            for username in ('a', 'b', 'c', 'd'):
+                registry.record(username, self.OPTIONS)
+            registry.save()
+
+            config = configparser.ConfigParser()
+            for username in ('a', 'b', 'd', 'e'):
+                config[username] = self.OPTIONS
+            config['d']['Enabled'] = 'n'
+            installations = {'a': FakeInstallation(),
+                             'b': FakeInstallation(installed=False),
+                             'c': FakeInstallation(),
+                             'd': FakeInstallation(),
+                             'e': FakeInstallation()}
+
+            registry = ProvisionRegistry(path)
+            self.assertEqual(registry.provisioned(installations, config,
+                                                  self.OPTIONS), {'a'})
+            self.assertEqual(registry.provisioned(
+                installations, config, dict(self.OPTIONS, Enabled='n')),
+                set())
+            registry.remove('a')
+            self.assertEqual(registry.provisioned(installations, config,
+                                                  self.OPTIONS), set())
+
+
+class SandboxConfigBatchTests(unittest.TestCase):
+    def test_changes_applied_with_one_write_and_reload(self):
+        backend = MemoryConfigBackend('[GlobalSettings]\nFileRootPath = x\n'
+                                      '[old]\nEnabled = y\n')
+        with SandboxConfigBatch(backend) as batch:
+            for box in ('box{}'.format(i) for i in range(100)):
+                batch.create_sandbox(box, {'Enabled': 'y', 'AutoDelete': 'y'})
+            batch.set_options('box1', {'Enabled': 'n', 'AutoDelete': None})
+            batch.destroy_sandbox('old')
+            self.assertEqual(backend.writes, 0)
+        self.assertEqual((backend.writes, backend.reloads), (1, 1))
+
+        config = backend.read()
+        self.assertEqual(len(config.sections()), 101)
+        self.assertFalse(config.has_section('old'))
+        self.assertEqual(dict(config['box1']), {'enabled': 'n'})
+        self.assertEqual(config['GlobalSettings']['FileRootPath'], 'x')
+
+        with SandboxConfigBatch(backend):
+            pass
+        with self.assertRaises(ValueError):
+            with SandboxConfigBatch(backend) as batch:
+                batch.destroy_sandbox('box0')
+                raise ValueError()
+        self.assertEqual(backend.writes, 1)
+
+    def test_config_written_as_utf16(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+
+        class FakeSandboxie(object):
+            config_path = os.path.join(temp_dir.name, 'Sandboxie.ini')
+
+        config = configparser.ConfigParser(strict=False)
+        config['box'] = {'Enabled': 'y'}
+        SandboxieConfigBackend(FakeSandboxie()).write(config)
+        with open(FakeSandboxie.config_path, 'rb') as f:
+            text = f.read().decode('utf-16-le')
+        self.assertIn('[box]', text)
+        self.assertEqual(os.listdir(temp_dir.name), ['Sandboxie.ini'])
+
+
+class RegistrySettingsTests(unittest.TestCase):
+    def test_profile_payload(self):
+        with tempfile.TemporaryDirectory() as d:
+            profile = Tf2RegistryProfile(d)
+            self.assertIn('"mat_picmip"=dword:00000002\r\n', profile.payload)
+            self.assertIn('"ScreenMonitorGamma"="2.2"\r\n', profile.payload)
+            path = profile.write()
+            self.assertEqual(os.path.basename(path), profile.digest + '.reg')
+            self.assertEqual(Tf2RegistryProfile(d).digest, profile.digest)
+            self.assertNotEqual(
+                Tf2RegistryProfile(d, {'mat_picmip': 4}).digest,
+                profile.digest)
+
+    def test_applied_once_per_steam_session_and_profile(self):
+        with tempfile.TemporaryDirectory() as d:
+            commands = []
+            failures = []
+
+            def shell_executer(command, wait=False):
+                self.assertTrue(wait)
+                commands.append(command)
+                if failures:
+                    raise subprocess.CalledProcessError(failures.pop(),
+                                                        command)
+
+            client = SteamClient(SteamInstallation(os.path.join(d, 'steam')),
+                                 shell_executer=shell_executer,
+                                 registry_profile=Tf2RegistryProfile(d))
+            steam = FakeProcess(10, create_time=1.5)
+            # A failed import is retried.
+            failures.append(1)
+            self.assertFalse(client._apply_tf2_registry_settings(steam))
+            del commands[:]
+            self.assertTrue(client._apply_tf2_registry_settings(steam))
+            self.assertFalse(client._apply_tf2_registry_settings(steam))
+            self.assertEqual(len(commands), 1)
+            self.assertIn(client.registry_profile.reg_path, commands[0])
+
+            self.assertTrue(client._apply_tf2_registry_settings(
+                FakeProcess(10, create_time=2.5)))
+            client.registry_profile = Tf2RegistryProfile(
+                d, {'ScreenWidth': 640})
+            self.assertTrue(client._apply_tf2_registry_settings(
+                FakeProcess(10, create_time=2.5)))
+            self.assertEqual(len(commands), 3)
+
+
+class PortAllocatorTests(unittest.TestCase):
+    def test_unique_stable_free_ports(self):
+        busy = {27101}
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'ports.json')
+            allocator = PortAllocator(path, is_free=lambda p: p not in busy)
+            self.assertEqual(allocator.allocate('a'),
+                             PortSet(27100, 27400, 27700))
+            # Slot 1 is skipped because its client port is in use.
+            self.assertEqual(allocator.allocate('b'),
+                             PortSet(27102, 27402, 27702))
+            self.assertEqual(allocator.allocate('a'),
+                             PortSet(27100, 27400, 27700))
+            allocator.save()
+
+            allocator = PortAllocator(path, is_free=lambda p: p not in busy)
+            self.assertEqual(allocator.get('b'), PortSet(27102, 27402, 27702))
+            busy.add(27402)
+            self.assertEqual(allocator.allocate('b'),
+                             PortSet(27103, 27403, 27703))
+            allocator.release('a')
+            self.assertIsNone(allocator.get('a'))
+            self.assertEqual(allocator.allocate('c'),
+                             PortSet(27100, 27400, 27700))
+
+            allocator = PortAllocator(slots=1, is_free=lambda p: True)
+            allocator.allocate('a')
+            with self.assertRaises(RuntimeError):
+                allocator.allocate('b')
+
+    def test_port_is_free(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.bind(('', 0))
+        self.assertFalse(port_is_free(sock.getsockname()[1]))
+
+
+class CpuPlacementTests(unittest.TestCase):
+    def setUp(self):
+        self.placement = CpuPlacement(cores=parse_cores('1-2'), interval=60)
+        self.addCleanup(self.placement.close)
+
+    def test_processes_spread_and_rebalanced(self):
+        steam, a, b, c = (FakeProcess(pid) for pid in range(4))
+        self.placement.add(steam, 'steam')
+        for hl2 in (a, b, c):
+            self.placement.add(hl2, 'hl2')
+        self.assertEqual([p.affinity for p in (steam, a, b, c)],
+                         [[1], [2], [1], [2]])
+        self.assertEqual(a.priority, BELOW_NORMAL_PRIORITY)
+
+        # Both hl2.exe on core 2 remain once the one on core 1 exits.
+        b.running = False
+        self.placement.tick()
+        self.assertEqual(sorted(p.affinity[0] for p in (a, c)), [1, 2])
+        self.assertNotIn(b.pid, self.placement.assignments())
+
+    def test_priority_follows_cpu_use(self):
+        hl2 = FakeProcess(1)
+        self.placement.add(hl2, 'hl2')
+        hl2.cpu = 90
+        self.placement.tick()
+        self.assertEqual(hl2.priority, IDLE_PRIORITY)
+        hl2.cpu = 20
+        self.placement.tick()
+        self.assertEqual(hl2.priority, IDLE_PRIORITY)
+        hl2.cpu = 1
+        self.placement.tick()
+        self.assertEqual(hl2.priority, BELOW_NORMAL_PRIORITY)
+
+
+class MemoryGovernorTests(unittest.TestCase):
+    def setUp(self):
+        self.backend = FakeMemoryBackend({'steam_a': 100, 'hl2_a': 500,
+                                          'steam_b': 100, 'hl2_b': 300})
+        self.instances = {'a': ['steam_a', 'hl2_a'],
+                          'b': ['steam_b', 'hl2_b']}
+        self.gate = FakeLaunchGate()
+
+    def governor(self, **kwargs):
+        return MemoryGovernor(lambda: self.instances, self.backend,
+                              launch_gate=self.gate, **kwargs)
+
+    def test_instance_trimmed_then_restarted(self):
+        governor = self.governor(instance_limit=250)
+        self.assertEqual(governor.tick(), ['a', 'b'])
+        self.assertEqual(self.backend.trimmed,
+                         ['steam_a', 'hl2_a', 'steam_b', 'hl2_b'])
+        self.assertEqual(governor.usage, {'a': 600, 'b': 400})
+        # a is still over budget once trimmed; b is not.
+        self.assertEqual(governor.tick(), ['a'])
+        self.assertEqual(self.backend.restarted, ['a'])
+        self.assertFalse(self.gate.refusals)
+
+    def test_fleet_budget_refuses_launches(self):
+        governor = self.governor(fleet_limit=800, actions=('trim', 'refuse'))
+        # Only the largest instance is trimmed to cover the excess.
+        self.assertEqual(governor.tick(), ['a'])
+        self.assertEqual(self.backend.trimmed, ['steam_a', 'hl2_a'])
+        self.assertEqual(self.gate.refusals, {'memory'})
+        # 700 bytes is within budget, but launches resume below 720.
+        self.backend.usage['hl2_b'] = 340
+        self.assertEqual(governor.tick(), [])
+        self.assertEqual(self.gate.refusals, {'memory'})
+        self.backend.usage['hl2_b'] = 300
+        governor.tick()
+        self.assertFalse(self.gate.refusals)
+        self.assertEqual(self.backend.restarted, [])
+
+
+class WatchdogTests(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.recoveries = []
+        self.log_watcher = FakeLogWatcher()
+        self.watchdog = Watchdog(self.recover, self.log_watcher,
+                                 disconnect_timeout=60, silence_timeout=600,
+                                 not_responding_timeout=60, max_restarts=3,
+                                 restart_window=3600, backoff_initial=100,
+                                 clock=lambda: self.now)
+        self.client = FakeSupervisedClient()
+        self.watchdog.watch('a', self.client)
+
+    def recover(self, username, recovery):
+        self.recoveries.append((username, recovery))
+        future = concurrent.futures.Future()
+        future.set_result(None)
+        return future
+
+    def tick_at(self, now):
+        self.now = now
+        return self.watchdog.tick()
+
+    def test_problems_detected(self):
+        self.assertEqual(self.tick_at(10), {})
+        self.client.logged_in = False
+        self.assertEqual(self.tick_at(20), {})
+        self.assertEqual(self.tick_at(80), {'a': 'disconnected'})
+        self.client.logged_in = True
+
+        # Restarts are spaced by the backoff, doubling with jitter.
+        self.client.hl2_process = None
+        self.assertEqual(self.tick_at(150), {})
+        self.assertEqual(self.tick_at(200), {'a': 'hl2_exited'})
+        self.client.hl2_process = FakeProcess(3, 'hl2.exe')
+        self.assertEqual(self.tick_at(300), {})
+
+        self.log_watcher.consumers['a.log']('Host_Error: bad map')
+        self.assertEqual(self.tick_at(500), {'a': 'fatal_error'})
+        self.assertEqual(self.recoveries, [('a', 'login'), ('a', 'launch'),
+                                           ('a', 'launch')])
+
+    def test_silence_and_restart_budget(self):
+        for restart, recovered in ((700, 800), (1400, 1500), (2100, 2200)):
+            self.assertEqual(self.tick_at(restart), {'a': 'silent'})
+            self.assertEqual(self.tick_at(recovered), {})
+        # Console output keeps the account healthy.
+        self.now = 2600
+        self.log_watcher.consumers['a.log']('Map: itemtest')
+        self.assertEqual(self.tick_at(3000), {})
+        # A fourth restart within the hour exceeds the budget.
+        self.watchdog.request('a', 'memory')
+        self.assertEqual(self.tick_at(3100), {})
+        self.assertFalse(self.watchdog.watching('a'))
+        self.assertEqual(len(self.recoveries), 3)
+
+
+class DaemonTests(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, '.daemon.json')
+        self.app = FakeDaemonApp()
+        self.daemon = Tf2IdleDaemon(self.app, self.path)
+        self.addCleanup(self.daemon.close)
+        thread = threading.Thread(target=self.daemon.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.daemon.shutdown)
+        self.client = None
+        for _ in range(100):
+            self.client = DaemonClient.find(self.path)
+            if self.client is not None:
+                break
+            time.sleep(0.01)
+
+    def test_commands_run_in_daemon(self):
+        self.assertEqual(self.client.login([SteamAccount('a', 'pw')]),
+                         {0: 1})
+        self.assertEqual(self.app.calls,
+                         [('login', [SteamAccount('a', 'pw')])])
+        (account, login_result, launch_result), = self.client.up(
+            [SteamAccount('a', 'pw')], '-textmode', 'autoexec.cfg')
+        self.assertEqual((account.username, login_result, launch_result),
+                         ('a', 1, (1, None, '27400', '27100')))
+        self.assertEqual(self.app.calls[1][2],
+                         os.path.abspath('autoexec.cfg'))
+        with self.assertRaises(DaemonError):
+            self.client.close_tf2([SteamAccount('a', None)])
+
+    def test_up_results_streamed(self):
+        results = self.client.up([SteamAccount('a', 'pw'),
+                                  SteamAccount('b', 'pw')])
+        account, _, _ = next(results)
+        self.assertEqual(account.username, 'a')
+        self.app.received.set()
+        self.assertEqual([account.username for account, _, _ in results],
+                         ['b'])
+
+    def test_mutating_commands_run_one_at_a_time(self):
+        results = self.client.up([SteamAccount('a', 'pw'),
+                                  SteamAccount('b', 'pw')])
+        next(results)
+        with self.assertRaises(DaemonError):
+            self.client.login([SteamAccount('a', 'pw')])
+        self.assertEqual(self.client.call('ping')['pid'], os.getpid())
+        self.app.received.set()
+        list(results)
+        self.assertEqual(self.client.login([SteamAccount('a', 'pw')]),
+                         {0: 1})
+
+    def test_invalid_params_do_not_block_later_commands(self):
+        for params in (5, 'x', ['a']):
+            with self.assertRaises(DaemonError):
+                self.client.call('login', params)
+        with self.assertRaises(DaemonError):
+            self.client.call('login', {'unexpected': 1})
+        self.assertEqual(self.client.login([SteamAccount('a', 'pw')]),
+                         {0: 1})
+
+    def test_cancel_interrupted_request(self):
+        results = self.client.up([SteamAccount('a', 'pw'),
+                                  SteamAccount('b', 'pw')])
+        next(results)
+        cancel_token, = self.app.cancel_tokens
+        self.assertFalse(cancel_token.cancelled)
+        self.client.cancel()
+        self.assertTrue(cancel_token.cancelled)
+        self.assertFalse(self.app.cancel_token.cancelled)
+        self.app.received.set()
+        results.close()
+
+    def test_token_required(self):
+        client = DaemonClient(self.client.port, 'wrong')
+        with self.assertRaises(DaemonError):
+            client.call('ping')
+        self.daemon.shutdown()
+        self.daemon.close()
+        self.assertIsNone(DaemonClient.find(self.path))
+
+    def test_app_options_detected(self):
+        parser = build_arg_parser()
+        args = parser.parse_args(['status', '--all'])
+        self.assertEqual(given_app_options(parser, args), [])
+        args = parser.parse_args(['--timeout', 'login=5', '--max-launches',
+                                  '4', 'status', '--all'])
+        self.assertEqual(given_app_options(parser, args), ['--timeout'])
+
+
+class FleetStateStoreTests(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, 'state.sqlite3')
+        self.steam_dir = os.path.join(temp_dir.name, 'a')
+
+    def open_store(self):
+        store = FleetStateStore(self.path, flush_interval=60)
+        self.addCleanup(store.close)
+        return store
+
+    def test_state_survives_reopening(self):
+        store = self.open_store()
+        store.record_process(self.steam_dir, 'hl2', psutil.Process())
+        store.record_connection('a', '10.0.0.1', 27400, 27100)
+        store.record_outcome('a', 'launch_tf2', (1, '10.0.0.1', '27400',
+                                                 '27100'), 12.5)
+        store.record_outcome('a', 'close_tf2', True, 0.5)
+        store.close()
+
+        store = self.open_store()
+        self.assertEqual(store.process(self.steam_dir, 'hl2').pid,
+                         os.getpid())
+        self.assertIsNone(store.process(self.steam_dir, 'steam'))
+        self.assertEqual(store.connection('a')[1:4],
+                         ('10.0.0.1', 27400, 27100))
+        outcome = store.last_outcome('a', 'launch_tf2')
+        self.assertEqual((outcome.result, outcome.seconds),
+                         ((1, '10.0.0.1', '27400', '27100'), 12.5))
+        store.forget('a', self.steam_dir)
+        self.assertIsNone(store.process(self.steam_dir, 'hl2'))
+        self.assertIsNone(store.connection('a'))
+
+    def test_writes_batched_and_pids_validated(self):
+        store = self.open_store()
+        # Reading creates no database.
+        self.assertIsNone(store.last_outcome('a', 'login'))
+        store.record_outcome('a', 'login', 1, 3.0)
+        self.assertFalse(os.path.exists(self.path))
+        store.flush()
+        reader = sqlite3.connect(self.path)
+        self.addCleanup(reader.close)
+        count = 'SELECT COUNT(*) FROM outcomes'
+        self.assertEqual(reader.execute(count).fetchone(), (1,))
+
+        # Writes after closing are not lost.
+        store.close()
+        store.record_outcome('a', 'login', 2, 4.0)
+        self.assertEqual(reader.execute(count).fetchone(), (2,))
+        self.assertIsNone(store._db)
+
+        # A pid that was reused by another process is not trusted.
+        exited = FakeProcess(
+            os.getpid(), create_time=psutil.Process().create_time() - 1)
+        store.record_process(self.steam_dir, 'steam', exited)
+        self.assertIsNone(store.process(self.steam_dir, 'steam'))
+
+
+class FleetStatusTests(unittest.TestCase):
+    def test_status_from_one_snapshot(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        store = FleetStateStore(os.path.join(temp_dir.name, 'state.sqlite3'))
+        self.addCleanup(store.close)
+        allocator = PortAllocator(is_free=lambda port: True)
+        allocator.allocate('a')
+        allocator.allocate('b')
+        store.record_connection('a', '10.0.0.1', 27015, 27005)
+
+        process = psutil.Process()
+        snapshot = ProcessSnapshot({normalize_dir('a'): process},
+                                   {normalize_dir('a'): process}, 0)
+        windows = {process.pid: [FakeWindow(1, title, process.pid)
+                                 for title in ('Steam', 'Friends',
+                                               'Servers')]}
+        a, b = fleet_status([('a', 'a'), ('b', 'b')], snapshot, windows,
+                            store, allocator,
+                            now=process.create_time() + 10)
+
+        self.assertEqual((a.steam_running, a.logged_in, a.hl2_running,
+                          a.connected), (True, True, True, True))
+        self.assertEqual((a.uptime, a.ip, a.server_port, a.client_port),
+                         (10, '10.0.0.1', 27015, 27005))
+        self.assertGreater(a.rss, 0)
+        self.assertGreaterEqual(a.cpu_percent, 0)
+        self.assertEqual(b._replace(server_port=None, client_port=None),
+                         ('b', False, False, False, False, None, None, None,
+                          None, None, None))
+        self.assertEqual((b.server_port, b.client_port), (27401, 27101))
+
+    def test_status_builds_no_launch_collaborators(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        app = Tf2IdleApp(steam_base_dir=os.path.join(temp_dir.name, 'steam'),
+                         working_dir=temp_dir.name)
+        self.addCleanup(app.close)
+        app.window_monitor.index.backend = FakeDesktop([])
+        self.assertEqual(app.status(), [])
+        self.assertEqual(app._collaborators, {})
+        self.assertEqual(os.listdir(temp_dir.name), [])
+
+
+class PhaseMetricsTests(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = temp_dir.name
+
+    def open_metrics(self):
+        metrics = PhaseMetrics(
+            prometheus_path=os.path.join(self.dir, 'tf2idle.prom'),
+            events_path=os.path.join(self.dir, 'phases.jsonl'),
+            state_path=os.path.join(self.dir, 'metrics.json'),
+            buckets=(1, 10), flush_interval=60)
+        self.addCleanup(metrics.close)
+        return metrics
+
+    def test_histograms_exported_and_kept(self):
+        metrics = self.open_metrics()
+        metrics.observe('steam_spawn', 0.5, username='a')
+        metrics.observe('steam_spawn', 5, username='b')
+        metrics.observe('steam_spawn', 20, 'timeout', 'c')
+        with self.assertRaises(OSError):
+            with metrics.timer('sandbox_create'):
+                raise OSError()
+        self.assertEqual(metrics.histogram('steam_spawn'), ([1, 2], 5.5, 2))
+        self.assertEqual(metrics.histogram('steam_spawn', 'timeout'),
+                         ([0, 0], 20, 1))
+        self.assertEqual(metrics.histogram('sandbox_create', 'failed')[2], 1)
+        metrics.close()
+
+        with open(os.path.join(self.dir, 'tf2idle.prom')) as f:
+            prometheus = f.read().splitlines()
+        self.assertIn('tf2idle_phase_seconds_bucket{phase="steam_spawn",'
+                      'outcome="ok",le="10"} 2', prometheus)
+        self.assertIn('tf2idle_phase_seconds_bucket{phase="steam_spawn",'
+                      'outcome="ok",le="+Inf"} 2', prometheus)
+        self.assertIn('tf2idle_phase_seconds_count{phase="steam_spawn",'
+                      'outcome="timeout"} 1', prometheus)
+        with open(os.path.join(self.dir, 'phases.jsonl')) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([(event['phase'], event['outcome'],
+                           event['username']) for event in events],
+                         [('steam_spawn', 'ok', 'a'),
+                          ('steam_spawn', 'ok', 'b'),
+                          ('steam_spawn', 'timeout', 'c'),
+                          ('sandbox_create', 'failed', None)])
+
+        metrics = self.open_metrics()
+        metrics.observe('steam_spawn', 0.1)
+        self.assertEqual(metrics.histogram('steam_spawn'), ([2, 3], 5.6, 3))
+
+    def test_state_machine_phases(self):
+        metrics = self.open_metrics()
+
+        class FakeClient(object):
+            pass
+
+        class Machine(SteamClientStateMachine):
+            PHASES = {'spawn': 'steam_spawn', 'login': 'login_windows'}
+            SUCCEEDED = 1
+
+            def step_start(self):
+                self.enter('spawn')
+
+            def step_spawn(self):
+                self.enter('login')
+
+            def step_login(self):
+                self.finish(2)
+
+        client = FakeClient()
+        client.metrics = metrics
+        self.assertEqual(Machine(client, 'a').run(), 2)
+        self.assertEqual(metrics.histogram('steam_spawn')[2], 1)
+        self.assertEqual(metrics.histogram('login_windows', 'failed')[2], 1)
+
+
 if __name__ == '__main__':
     unittest.main()